@@ -18,8 +18,9 @@ T = 250
 L = 44
 N = 80
 B = int(sys.argv[1])
-inputs = torch.randn(B, T, N, dtype=torch.float, requires_grad=True).cuda()
-transitions = torch.randn(N + 1, N, dtype=torch.float, requires_grad=True).cuda()
+device = "cuda" if torch.cuda.is_available() else "cpu"
+inputs = torch.randn(B, T, N, dtype=torch.float, requires_grad=True, device=device)
+transitions = torch.randn(N + 1, N, dtype=torch.float, requires_grad=True, device=device)
 tgt = torch.randint(N - 2, (B, L)).split(1)
 tgt = [t.tolist()[0] for t in tgt]
 
@@ -0,0 +1,317 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import torch
+
+sys.path.append("..")
+import transducer
+import utils
+
+from time_utils import measure_func, summarize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the GTN losses, decoders and layers."
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=["ctc", "asg", "transducer", "conv"],
+        choices=["ctc", "asg", "transducer", "conv"],
+        help="Which benchmarks to run.",
+    )
+    parser.add_argument("--B", nargs="+", type=int, default=[1, 8], help="Batch sizes.")
+    parser.add_argument("--T", nargs="+", type=int, default=[250], help="Input lengths.")
+    parser.add_argument(
+        "--C", nargs="+", type=int, default=[81], help="Number of classes."
+    )
+    parser.add_argument(
+        "--L", nargs="+", type=int, default=[44], help="Target lengths."
+    )
+    parser.add_argument(
+        "--ngram",
+        nargs="+",
+        type=int,
+        default=[0, 1],
+        help="Transition model orders for the transducer.",
+    )
+    parser.add_argument(
+        "--blank",
+        nargs="+",
+        default=["none", "optional"],
+        choices=["none", "optional", "forced"],
+        help="Blank modes for the transducer.",
+    )
+    parser.add_argument(
+        "--recompute",
+        nargs="+",
+        type=int,
+        default=[0],
+        choices=[0, 1],
+        help="Whether the transducer recomputes its graphs in the backward.",
+    )
+    parser.add_argument(
+        "--dense_normalizer",
+        nargs="+",
+        type=int,
+        default=[1],
+        choices=[0, 1],
+        help="Whether the transducer computes its normalizer with tensor operations.",
+    )
+    parser.add_argument(
+        "--dense_bigram",
+        nargs="+",
+        type=int,
+        default=[1],
+        choices=[0, 1],
+        help="Whether the transducer scores bigram models with tensor operations.",
+    )
+    parser.add_argument(
+        "--asg_use_pt",
+        nargs="+",
+        type=int,
+        default=[0],
+        choices=[0, 1],
+        help="Whether to benchmark the pytorch implementation of ASG instead of GTN.",
+    )
+    parser.add_argument(
+        "--lexicon_size",
+        type=int,
+        default=100,
+        help="Number of output tokens of the convolutional transducer.",
+    )
+    parser.add_argument(
+        "--kernel_size",
+        type=int,
+        default=5,
+        help="Kernel size of the convolutional transducer.",
+    )
+    parser.add_argument(
+        "--stride", type=int, default=2, help="Stride of the convolutional transducer."
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=20, help="Timed iterations per benchmark."
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="Warmup iterations per benchmark."
+    )
+    parser.add_argument(
+        "--device", default="cpu", choices=["cpu", "cuda"], help="Input device."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of the JSON file to save the results in.",
+    )
+    return parser.parse_args()
+
+
+def random_targets(B, L, C):
+    return [t.squeeze(0) for t in torch.randint(C, size=(B, L)).split(1)]
+
+
+def bench_ctc(args, B, T, C, L):
+    inputs = torch.randn(B, T, C, device=args.device, requires_grad=True)
+    log_probs = torch.nn.functional.log_softmax(inputs, dim=2).detach()
+    log_probs.requires_grad_(True)
+    targets = [t.tolist() for t in random_targets(B, L, C - 1)]
+
+    def fwd():
+        return utils.CTCLoss(log_probs, targets, C - 1, "mean")
+
+    yield "ctc_fwd", fwd, None
+    yield "ctc_bwd", lambda loss: loss.backward(), fwd
+
+
+def bench_asg(args, B, T, C, L, use_pt):
+    inputs = torch.randn(B, T, C, device=args.device, requires_grad=True)
+    transitions = torch.randn(C + 1, C, device=args.device, requires_grad=True)
+    targets = [t.tolist() for t in random_targets(B, L, C)]
+    asg_loss = utils.asg_loss if use_pt else utils.ASGLoss
+
+    def fwd():
+        return asg_loss(inputs, transitions, targets, "mean")
+
+    yield "asg_fwd", fwd, None
+    yield "asg_bwd", lambda loss: loss.backward(), fwd
+
+
+def bench_transducer(
+    args, B, T, C, L, ngram, blank, recompute, dense_normalizer, dense_bigram
+):
+    num_tokens = C - int(blank != "none")
+    tokens = [(i,) for i in range(num_tokens)]
+    graphemes_to_index = {i: i for i in range(num_tokens)}
+    inputs = torch.randn(B, T, C, device=args.device, requires_grad=True)
+    targets = random_targets(B, L, num_tokens)
+    crit = transducer.Transducer(
+        tokens,
+        graphemes_to_index,
+        ngram=ngram,
+        blank=blank,
+        allow_repeats=blank != "optional",
+        reduction="mean",
+        recompute=bool(recompute),
+        dense_normalizer=bool(dense_normalizer),
+        dense_bigram=bool(dense_bigram),
+    ).to(args.device)
+
+    def fwd():
+        return crit(inputs, targets)
+
+    yield "transducer_fwd", fwd, None
+    yield "transducer_bwd", lambda loss: loss.backward(), fwd
+    yield "transducer_viterbi", lambda: crit.viterbi(inputs.detach()), None
+
+
+def bench_conv(args, B, T, C):
+    num_graphemes = C - 1
+    max_len = (args.kernel_size + 1) // 2
+    lexicon = set()
+    while len(lexicon) < args.lexicon_size:
+        length = random.randint(1, max_len)
+        lexicon.add(tuple(random.randrange(num_graphemes) for _ in range(length)))
+    conv = transducer.ConvTransduce1D(
+        sorted(lexicon), args.kernel_size, args.stride, num_graphemes
+    ).to(args.device)
+    inputs = torch.randn(B, T, C, device=args.device, requires_grad=True)
+
+    def fwd():
+        return conv(inputs).sum()
+
+    yield "conv_fwd", fwd, None
+    yield "conv_bwd", lambda loss: loss.backward(), fwd
+
+
+def benchmark_configs(args):
+    """
+    Yields the benchmark functions and their parameters for every point
+    of the sweep.
+    """
+    if "ctc" in args.benchmarks:
+        for B, T, C, L in itertools.product(args.B, args.T, args.C, args.L):
+            params = {"B": B, "T": T, "C": C, "L": L}
+            yield params, bench_ctc(args, **params)
+    if "asg" in args.benchmarks:
+        for B, T, C, L, use_pt in itertools.product(
+            args.B, args.T, args.C, args.L, args.asg_use_pt
+        ):
+            params = {"B": B, "T": T, "C": C, "L": L, "use_pt": use_pt}
+            yield params, bench_asg(args, **params)
+    if "transducer" in args.benchmarks:
+        for (
+            B,
+            T,
+            C,
+            L,
+            ngram,
+            blank,
+            recompute,
+            dense_normalizer,
+            dense_bigram,
+        ) in itertools.product(
+            args.B,
+            args.T,
+            args.C,
+            args.L,
+            args.ngram,
+            args.blank,
+            args.recompute,
+            args.dense_normalizer,
+            args.dense_bigram,
+        ):
+            params = {
+                "B": B,
+                "T": T,
+                "C": C,
+                "L": L,
+                "ngram": ngram,
+                "blank": blank,
+                "recompute": recompute,
+                "dense_normalizer": dense_normalizer,
+                "dense_bigram": dense_bigram,
+            }
+            yield params, bench_transducer(args, **params)
+    if "conv" in args.benchmarks:
+        for B, T, C in itertools.product(args.B, args.T, args.C):
+            params = {
+                "B": B,
+                "T": T,
+                "C": C,
+                "lexicon_size": args.lexicon_size,
+                "kernel_size": args.kernel_size,
+                "stride": args.stride,
+            }
+            yield params, bench_conv(args, B, T, C)
+
+
+def metadata(args):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "hostname": platform.node(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": args.device,
+        "num_threads": torch.get_num_threads(),
+        "num_cores": len(os.sched_getaffinity(0)),
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+    }
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    sync = torch.cuda.synchronize if args.device == "cuda" else None
+
+    results = []
+    for params, benchmarks in benchmark_configs(args):
+        for name, func, setup in benchmarks:
+            utils.peak_rss_mb(reset=True)
+            times = measure_func(
+                func, args.iterations, args.warmup, setup=setup, sync=sync
+            )
+            result = {"name": name, "params": params}
+            result.update(summarize(times))
+            result["peak_rss_mb"] = utils.peak_rss_mb(reset=True)
+            if args.device == "cuda":
+                result["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+            result["times_ms"] = times
+            results.append(result)
+            logging.info(
+                "{} {}: mean {:.3f} (ms), p50 {:.3f} (ms), p95 {:.3f} (ms), "
+                "peak RSS {:.1f} (MB)".format(
+                    name,
+                    " ".join(f"{k}={v}" for k, v in params.items()),
+                    result["mean_ms"],
+                    result["p50_ms"],
+                    result["p95_ms"],
+                    result["peak_rss_mb"],
+                )
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as fid:
+            json.dump({"metadata": metadata(args), "results": results}, fid, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import json
+import logging
+import numpy as np
+import sys
+
+from time_utils import summarize
+
+# The timings are only comparable if these match between the runs:
+MATCH_KEYS = ["device", "num_threads", "num_cores", "torch"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare benchmark results against a baseline."
+    )
+    parser.add_argument(
+        "results",
+        nargs="+",
+        type=str,
+        help="JSON files written by `benchmark.py`. Pass the files of repeated "
+        "runs to account for the variance between runs.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        required=True,
+        help="The baseline JSON file, saved on the same machine.",
+    )
+    parser.add_argument(
+        "--update_baseline",
+        action="store_true",
+        help="Write the results to the baseline file instead of comparing.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative slowdown tolerated before flagging a regression.",
+    )
+    parser.add_argument(
+        "--min_runs",
+        type=int,
+        default=3,
+        help="Minimum number of runs of a benchmark in both the baseline and "
+        "the results to compare it.",
+    )
+    parser.add_argument(
+        "--allow_mismatch",
+        action="store_true",
+        help="Only warn instead of failing when the machine or settings of the "
+        "results differ from the baseline.",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the interval on the relative change.",
+    )
+    parser.add_argument(
+        "--statistic",
+        default="median",
+        choices=["mean", "median"],
+        help="Statistic of the timings to compare.",
+    )
+    parser.add_argument(
+        "--num_bootstrap",
+        type=int,
+        default=2000,
+        help="Number of bootstrap samples for the confidence interval.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    return parser.parse_args()
+
+
+def result_key(result):
+    params = ", ".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['name']} ({params})"
+
+
+def load_results(paths):
+    """
+    Returns the metadata of the first file and a dictionary mapping each
+    benchmark to its results. The timings of each run of a benchmark are kept
+    separately in "runs_ms" and pooled in "times_ms".
+    """
+    metadata = None
+    results = {}
+    for path in paths:
+        with open(path, "r") as fid:
+            data = json.load(fid)
+        if metadata is None:
+            metadata = data["metadata"]
+        mismatches = check_metadata(metadata, data["metadata"])
+        if len(mismatches) > 0:
+            raise ValueError(f"{path} differs from {paths[0]}: {', '.join(mismatches)}")
+        for result in data["results"]:
+            key = result_key(result)
+            runs = result.get("runs_ms", [result["times_ms"]])
+            if key in results:
+                results[key]["runs_ms"].extend(runs)
+                results[key]["times_ms"].extend(result["times_ms"])
+            else:
+                results[key] = dict(
+                    result, runs_ms=list(runs), times_ms=list(result["times_ms"])
+                )
+    return metadata, results
+
+
+def check_metadata(baseline, current):
+    """
+    Returns a description of each setting for which the timings of `current`
+    are not comparable to those of `baseline`.
+    """
+    mismatches = [
+        f"{k} {baseline.get(k)} != {current.get(k)}"
+        for k in MATCH_KEYS
+        if baseline.get(k) != current.get(k)
+    ]
+    iterations = current.get("iterations", 0)
+    if iterations < baseline.get("iterations", 0):
+        mismatches.append(f"iterations {iterations} < {baseline['iterations']}")
+    return mismatches
+
+
+def bootstrap(runs, stat, num_bootstrap, rng):
+    """
+    Returns bootstrap samples of the statistic of the timings. The runs are
+    resampled first and then the timings within each run, so that the
+    variance between runs is accounted for.
+    """
+    runs = [np.array(r) for r in runs]
+    samples = np.empty(num_bootstrap)
+    for i in range(num_bootstrap):
+        chosen = rng.integers(len(runs), size=len(runs))
+        times = [rng.choice(runs[r], size=len(runs[r])) for r in chosen]
+        samples[i] = stat(np.concatenate(times))
+    return samples
+
+
+def relative_change_ci(baseline, current, statistic, confidence, num_bootstrap, rng):
+    """
+    Returns the statistic of the baseline and current timings, their ratio
+    and a bootstrap confidence interval for the ratio.
+    """
+    stat = np.mean if statistic == "mean" else np.median
+    ratios = bootstrap(current, stat, num_bootstrap, rng) / bootstrap(
+        baseline, stat, num_bootstrap, rng
+    )
+    alpha = 100 * (1 - confidence) / 2
+    low, high = np.percentile(ratios, [alpha, 100 - alpha])
+    base_stat = stat(np.concatenate(baseline))
+    cur_stat = stat(np.concatenate(current))
+    return base_stat, cur_stat, cur_stat / base_stat, low, high
+
+
+def compare(baseline, current, args):
+    """
+    Compares each benchmark in `current` to `baseline`, logs a report and
+    returns the list of regressed benchmarks.
+    """
+    rng = np.random.default_rng(args.seed)
+    regressions = []
+    for key, result in current.items():
+        if key not in baseline:
+            logging.warning(f"{key}: no baseline")
+            continue
+        num_runs = min(len(baseline[key]["runs_ms"]), len(result["runs_ms"]))
+        if num_runs < args.min_runs:
+            logging.warning(f"{key}: only {num_runs} run(s), need {args.min_runs}")
+            continue
+        base_stat, cur_stat, ratio, low, high = relative_change_ci(
+            baseline[key]["runs_ms"],
+            result["runs_ms"],
+            args.statistic,
+            args.confidence,
+            args.num_bootstrap,
+            rng,
+        )
+        # Only flag changes for which the whole interval is outside the tolerance:
+        if low > 1 + args.tolerance:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif high < 1 - args.tolerance:
+            status = "improvement"
+        else:
+            status = "ok"
+        logging.info(
+            "{}: {} {:.3f} -> {:.3f} (ms), change {:+.1f}% [{:+.1f}%, {:+.1f}%] {}".format(
+                key,
+                args.statistic,
+                base_stat,
+                cur_stat,
+                100 * (ratio - 1),
+                100 * (low - 1),
+                100 * (high - 1),
+                status,
+            )
+        )
+    for key in baseline:
+        if key not in current:
+            logging.warning(f"{key}: missing from the results")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    metadata, current = load_results(args.results)
+
+    if args.update_baseline:
+        for result in current.values():
+            result.update(summarize(result["times_ms"]))
+        with open(args.baseline, "w") as fid:
+            json.dump(
+                {"metadata": metadata, "results": list(current.values())},
+                fid,
+                indent=2,
+            )
+        logging.info(f"Saved {len(current)} baseline results to {args.baseline}")
+        return
+
+    baseline_metadata, baseline = load_results([args.baseline])
+    mismatches = check_metadata(baseline_metadata, metadata)
+    for mismatch in mismatches:
+        logging.warning(f"Results not comparable to the baseline: {mismatch}")
+    if len(mismatches) > 0 and not args.allow_mismatch:
+        logging.error("Save a baseline with the same settings on this machine.")
+        sys.exit(2)
+    regressions = compare(baseline, current, args)
+    compared = [
+        k
+        for k, r in current.items()
+        if k in baseline
+        and min(len(baseline[k]["runs_ms"]), len(r["runs_ms"])) >= args.min_runs
+    ]
+    if len(compared) == 0:
+        logging.error("No benchmarks with enough runs to compare.")
+        sys.exit(2)
+    if len(regressions) > 0:
+        logging.error(f"Found {len(regressions)} regression(s).")
+        sys.exit(1)
+    logging.info("No regressions found.")
+
+
+if __name__ == "__main__":
+    main()
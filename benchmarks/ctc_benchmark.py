@@ -19,7 +19,8 @@ L = 44
 N = 80
 B = int(sys.argv[1])
 ITERATIONS = 100
-inputs = torch.randn(B, T, N, dtype=torch.float, requires_grad=True).cuda()
+device = "cuda" if torch.cuda.is_available() else "cpu"
+inputs = torch.randn(B, T, N, dtype=torch.float, requires_grad=True, device=device)
 tgt = torch.randint(N - 2, (B, L)).split(1)
 tgt = [t.tolist()[0] for t in tgt]
 
@@ -0,0 +1,117 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import torch
+
+sys.path.append("..")
+import export
+import models
+
+from time_utils import measure_func, summarize
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the latency of eager, fused and exported models."
+    )
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        type=str,
+        default=[
+            os.path.join(ROOT, "configs", "iamdb", "tds2d.json"),
+            os.path.join(ROOT, "configs", "librispeech", "tds.json"),
+            os.path.join(ROOT, "configs", "iamdb", "rnn.json"),
+        ],
+        help="Configs of the models to benchmark.",
+    )
+    parser.add_argument(
+        "--B", nargs="+", type=int, default=[1, 8, 32], help="Batch sizes."
+    )
+    parser.add_argument("--width", type=int, default=400, help="Input width.")
+    parser.add_argument(
+        "--output_size", type=int, default=80, help="Number of output classes."
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=20, help="Number of timed iterations."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of the JSON file to save the results in.",
+    )
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def benchmark(config_path, args):
+    with open(config_path, "r") as fid:
+        config = json.load(fid)
+    input_size = config["data"]["num_features"]
+    model = models.load_model(
+        config["model_type"], input_size, args.output_size, config["model"]
+    ).eval()
+    variants = [
+        ("eager", model),
+        ("exported", torch.jit.optimize_for_inference(export.export_model(model))),
+    ]
+    if config["model_type"] in ["tds", "tds2d"]:
+        fused = models.load_model(
+            config["model_type"], input_size, args.output_size, config["model"], True
+        ).eval()
+        fused.load_state_dict(model.state_dict())
+        variants.append(("fused", fused))
+
+    results = []
+    for B in args.B:
+        inputs = torch.randn(B, input_size, args.width)
+        expected = model(inputs)
+        result = {"config": os.path.relpath(config_path, ROOT), "B": B}
+        for name, fn in variants:
+            assert torch.allclose(fn(inputs), expected, atol=1e-4)
+            times = measure_func(lambda: fn(inputs), args.iterations)
+            result[name] = summarize(times)
+        result["speedup"] = {
+            name: result["eager"]["p50_ms"] / result[name]["p50_ms"]
+            for name, _ in variants[1:]
+        }
+        logging.info(
+            "{} B={}: eager {:.2f} (ms), ".format(
+                result["config"], B, result["eager"]["p50_ms"]
+            )
+            + ", ".join(
+                "{} {:.2f} (ms) {:.2f}x".format(
+                    name, result[name]["p50_ms"], result["speedup"][name]
+                )
+                for name, _ in variants[1:]
+            )
+        )
+        results.append(result)
+    return results
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    results = []
+    for config_path in args.configs:
+        results.extend(benchmark(config_path, args))
+    if args.output is not None:
+        with open(args.output, "w") as fid:
+            json.dump(results, fid, indent=2)
+
+
+if __name__ == "__main__":
+    main()
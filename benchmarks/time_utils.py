@@ -6,6 +6,7 @@ LICENSE file in the root directory of this source tree.
 """
 
 
+import numpy as np
 import time
 
 def time_func(func, iterations=100, name=None):
@@ -19,3 +20,38 @@ def time_func(func, iterations=100, name=None):
     time_taken = (time.perf_counter() - start) * 1e3 / iterations
     name = "function" if name is None else name
     print("\"{}\" took {:.3f} (ms)".format(name, time_taken))
+
+
+def measure_func(func, iterations=100, warmup=5, setup=None, sync=None):
+    """
+    Returns a list with the time taken by each call of `func` in ms. If
+    `setup` is given, it is called before each call of `func` outside of the
+    timed region and its output is passed to `func`. If `sync` is given (e.g.
+    `torch.cuda.synchronize`) it is called before stopping each timer.
+    """
+    def call():
+        args = () if setup is None else (setup(),)
+        if sync is not None:
+            sync()
+        start = time.perf_counter()
+        func(*args)
+        if sync is not None:
+            sync()
+        return (time.perf_counter() - start) * 1e3
+
+    for i in range(warmup):
+        call()
+    return [call() for i in range(iterations)]
+
+
+def summarize(times):
+    """
+    Returns summary statistics for a list of times in ms.
+    """
+    times = np.array(times)
+    return {
+        "mean_ms": float(times.mean()),
+        "std_ms": float(times.std()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+    }
@@ -0,0 +1,230 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import torch
+
+sys.path.append("..")
+import train
+import utils
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+WORD_PIECES = os.path.join(ROOT, "benchmarks", "word_pieces_tokens_1000.txt")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the training loop end-to-end on synthetic data."
+    )
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        type=str,
+        default=None,
+        help="Configs to benchmark, defaults to all configs in "
+        "`configs/` and `recipes/`.",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=10, help="Number of training steps per config."
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="Override the batch size of the configs.",
+    )
+    parser.add_argument(
+        "--min_width", type=int, default=1000, help="Minimum input width."
+    )
+    parser.add_argument(
+        "--max_width", type=int, default=2000, help="Maximum input width."
+    )
+    parser.add_argument(
+        "--target_length",
+        nargs=2,
+        type=int,
+        default=[20, 60],
+        help="Minimum and maximum target length.",
+    )
+    parser.add_argument(
+        "--disable_cuda", action="store_true", help="Disable CUDA."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of the JSON file to save the results in.",
+    )
+    args = parser.parse_args()
+    args.disable_cuda = args.disable_cuda or not torch.cuda.is_available()
+    if args.configs is None:
+        args.configs = sorted(
+            glob.glob(os.path.join(ROOT, "configs", "**", "*.json"), recursive=True)
+            + glob.glob(os.path.join(ROOT, "recipes", "**", "*.json"), recursive=True)
+        )
+    args.configs = [os.path.abspath(c) for c in args.configs]
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+    return args
+
+
+def synthetic_tokens(path, tmpdir):
+    """
+    Returns a tokens file to use in place of the missing file `path`. Word
+    piece token sets are replaced by the first word pieces of
+    `word_pieces_tokens_1000.txt` and anything else by the default graphemes
+    of the synthetic dataset (`None`).
+    """
+    match = re.search(r"tokens_(\d+)", os.path.basename(path))
+    if match is None:
+        return None
+    with open(WORD_PIECES, "r") as fid:
+        tokens = [l.strip() for l in fid][: int(match.group(1))]
+    tokens_path = os.path.join(tmpdir, os.path.basename(path))
+    with open(tokens_path, "w") as fid:
+        fid.write("\n".join(tokens) + "\n")
+    return tokens_path
+
+
+def synthetic_config(config, args, tmpdir):
+    """
+    Rewrites a config to train one epoch on the synthetic dataset. Returns
+    the new config and a list of the substitutions made for files which do
+    not exist.
+    """
+    substitutions = []
+
+    def substitute_tokens(section):
+        path = section.get("tokens", None)
+        if path is None or os.path.exists(path):
+            return
+        new_path = synthetic_tokens(path, tmpdir)
+        if new_path is None:
+            section.pop("tokens")
+            replacement = "graphemes"
+        else:
+            section["tokens"] = new_path
+            with open(new_path, "r") as fid:
+                replacement = f"{len(fid.readlines())} word pieces"
+        substitutions.append({"file": path, "replacement": replacement})
+
+    data = config["data"]
+    data["dataset"] = "synthetic"
+    data["data_path"] = tmpdir
+    if "num_features" not in data:
+        data["num_features"] = data.pop("img_height")
+    substitute_tokens(data)
+    substitute_tokens(config["model"])
+
+    criterion = config.get("criterion", {})
+    transitions = criterion.get("transitions", None)
+    if transitions is not None and not os.path.exists(transitions):
+        substitutions.append({"file": criterion.pop("transitions"), "replacement": None})
+
+    optim = config["optim"]
+    optim["epochs"] = 1
+    if args.batch_size is not None:
+        optim["batch_size"] = args.batch_size
+    return config, substitutions
+
+
+def benchmark(config_path, args):
+    with open(config_path, "r") as fid:
+        config = json.load(fid)
+    # measure the peak of this benchmark only:
+    utils.peak_rss_mb(reset=True)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config, substitutions = synthetic_config(config, args, tmpdir)
+        batch_size = config["optim"]["batch_size"]
+        spec = {
+            "num_samples": {
+                "train": args.steps * batch_size,
+                "validation": batch_size,
+            },
+            "min_width": args.min_width,
+            "max_width": args.max_width,
+            "min_target_length": args.target_length[0],
+            "max_target_length": args.target_length[1],
+        }
+        with open(os.path.join(tmpdir, "synthetic.json"), "w") as fid:
+            json.dump(spec, fid)
+        synthetic_config_path = os.path.join(tmpdir, "config.json")
+        with open(synthetic_config_path, "w") as fid:
+            json.dump(config, fid)
+
+        # only override what the benchmark needs, the rest are train.py defaults:
+        argv = [
+            "--config",
+            synthetic_config_path,
+            "--checkpoint_path",
+            tmpdir,
+            "--no_pin_cores",
+        ]
+        if args.disable_cuda:
+            argv.append("--disable_cuda")
+        train_args = train.parse_args(argv)
+        stats = train.train(0, train_args)
+
+    train_time = stats["timers"]["train_total"]["mean"]
+    return {
+        "config": os.path.relpath(config_path, ROOT),
+        "batch_size": batch_size,
+        "steps": args.steps,
+        "samples_per_sec": stats["num_samples"] / train_time,
+        "phases_ms": {k: v["mean"] * 1e3 for k, v in stats["timers"].items()},
+        "phases_p95_ms": {k: v["p95"] * 1e3 for k, v in stats["timers"].items()},
+        "peak_rss_mb": utils.peak_rss_mb(reset=True),
+        "substitutions": substitutions,
+    }
+
+
+def main():
+    args = parse_args()
+    # The training script loads the datasets relative to the root:
+    os.chdir(ROOT)
+
+    results = []
+    for config_path in args.configs:
+        result = benchmark(config_path, args)
+        results.append(result)
+        logging.getLogger().setLevel(logging.INFO)
+        logging.info(
+            "{}: {:.2f} samples/sec, ".format(result["config"], result["samples_per_sec"])
+            + ", ".join(
+                "{} : {:.2f}ms".format(k, v) for k, v in result["phases_ms"].items()
+            )
+        )
+
+    if args.output is not None:
+        metadata = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "hostname": platform.node(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": "cpu" if args.disable_cuda else "cuda",
+            "num_cores": len(os.sched_getaffinity(0)),
+            "min_width": args.min_width,
+            "max_width": args.max_width,
+            "target_length": args.target_length,
+        }
+        with open(args.output, "w") as fid:
+            json.dump({"metadata": metadata, "results": results}, fid, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -5,6 +5,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import functools
 import itertools
 import json
 import os
@@ -14,13 +15,166 @@ import torchaudio
 import torchvision
 
 
-def log_normalize(x):
+def log_normalize(x, mean=None, std=None):
+    """
+    Normalizes the log of the features in place, with the given mean and
+    standard deviation or those of the features.
+    """
     x.add_(1e-6).log_()
-    mean = x.mean()
-    std = x.std()
+    if mean is None:
+        mean = x.mean()
+        std = x.std()
     return x.sub_(mean).div_(std + 1e-6)
 
 
+def mel_spectrogram(num_features, sample_rate, center=True):
+    return torchaudio.transforms.MelSpectrogram(
+        sample_rate=sample_rate,
+        n_fft=sample_rate * 25 // 1000,
+        n_mels=num_features,
+        hop_length=sample_rate * 10 // 1000,
+        center=center,
+    )
+
+
+def feature_transforms(num_features, sample_rate, mean=None, std=None):
+    """
+    Returns the list of transforms from audio to normalized log-mel features.
+    The features are normalized with the mean and standard deviation of each
+    file unless global ones are given, e.g. from `feature_stats`.
+    """
+    return [
+        mel_spectrogram(num_features, sample_rate),
+        torchvision.transforms.Lambda(
+            functools.partial(log_normalize, mean=mean, std=std)
+        ),
+    ]
+
+
+def feature_stats(audios, num_features, sample_rate=16000):
+    """
+    Returns the mean and standard deviation of the log-mel features of an
+    iterable of audio tensors.
+    """
+    transform = mel_spectrogram(num_features, sample_rate)
+    total, squares, count = 0.0, 0.0, 0
+    for audio in audios:
+        features = transform(audio).add_(1e-6).log_().double()
+        total += features.sum().item()
+        squares += features.square().sum().item()
+        count += features.numel()
+    mean = total / count
+    return mean, ((squares - count * mean ** 2) / (count - 1)) ** 0.5
+
+
+class StreamingFeatures:
+    """
+    Computes the normalized log-mel features of `feature_transforms`
+    incrementally from a stream of chunks of audio, e.g. from a microphone.
+    The samples of the windows which overlap the next chunk are cached, and
+    the reflection padding of the first and last windows is added at the
+    start and the end of the stream. The frames of a stream are the frames of
+    the whole audio.
+
+    With a global `mean` and `std`, the features are those of the transforms
+    with the same statistics. Otherwise each frame is normalized with the
+    statistics of the frames up to and including it, so the last frame is
+    normalized as by the transforms of the whole audio.
+
+    Args:
+        num_features (int) : Number of mel features.
+        sample_rate (int) : The sample rate of the audio.
+        mean (float, optional) : The global mean of the log-mel features.
+        std (float, optional) : The global standard deviation of the log-mel
+            features.
+    """
+
+    def __init__(self, num_features, sample_rate=16000, mean=None, std=None):
+        self.transform = mel_spectrogram(num_features, sample_rate, center=False)
+        self.n_fft = self.transform.spectrogram.n_fft
+        self.hop_length = self.transform.spectrogram.hop_length
+        self.padding = self.n_fft // 2
+        self.mean = mean
+        self.std = std
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+        self.started = False
+        self.total = 0.0
+        self.squares = 0.0
+        self.count = 0
+
+    @torch.no_grad()
+    def __call__(self, audio, final=False):
+        """
+        Returns the features, of shape [C, num_features, T], of the frames
+        completed by the next chunk of audio of shape [C, N]. The last chunk
+        of a stream, which can be empty, is passed with `final=True`, which
+        also resets the state for the next stream.
+        """
+        if self.buffer is not None:
+            audio = torch.cat([self.buffer, audio], dim=-1)
+        if final and not self.started and audio.shape[-1] <= self.padding:
+            raise ValueError(f"Audio of {audio.shape[-1]} samples is too short.")
+        if not self.started and audio.shape[-1] > self.padding:
+            # reflection padding of the first frames:
+            left = audio[..., 1 : self.padding + 1].flip(-1)
+            audio = torch.cat([left, audio], dim=-1)
+            self.started = True
+        if final:
+            right = audio[..., -self.padding - 1 : -1].flip(-1)
+            audio = torch.cat([audio, right], dim=-1)
+        num_frames = 0
+        if self.started and audio.shape[-1] >= self.n_fft:
+            num_frames = (audio.shape[-1] - self.n_fft) // self.hop_length + 1
+        if num_frames > 0:
+            end = (num_frames - 1) * self.hop_length + self.n_fft
+            features = self.transform(audio[..., :end])
+        else:
+            features = audio.new_zeros(
+                audio.shape[:-1] + (self.transform.n_mels, 0)
+            )
+        self.buffer = audio[..., num_frames * self.hop_length :]
+        features = self._normalize(features)
+        if final:
+            self.reset()
+        return features
+
+    def _normalize(self, features):
+        if self.mean is not None:
+            return log_normalize(features, self.mean, self.std)
+        features.add_(1e-6).log_()
+        # running statistics over all the features up to each frame:
+        T = features.shape[-1]
+        frames = features.double().flatten(0, -2)
+        totals = frames.sum(0).cumsum(0) + self.total
+        squares = frames.square().sum(0).cumsum(0) + self.squares
+        counts = torch.arange(1, T + 1, dtype=torch.double) * frames.shape[0]
+        counts += self.count
+        if T > 0:
+            self.total = totals[-1].item()
+            self.squares = squares[-1].item()
+            self.count = counts[-1].item()
+        mean = totals / counts
+        std = ((squares - counts * mean.square()) / (counts - 1).clamp(min=1)).sqrt()
+        frames = (frames - mean) / (std + 1e-6)
+        return frames.reshape(features.shape).to(features)
+
+
+def load_file(audio_file, num_features, sample_rate=16000, mean=None, std=None):
+    """
+    Loads an audio file and returns its normalized log-mel features.
+    """
+    transforms = torchvision.transforms.Compose(
+        feature_transforms(num_features, sample_rate, mean, std)
+    )
+    audio, file_sample_rate = torchaudio.load(audio_file)
+    if file_sample_rate != sample_rate:
+        audio = torchaudio.functional.resample(audio, file_sample_rate, sample_rate)
+    return transforms(audio)
+
+
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, data_path, preprocessor, split, splits, augmentation=None, sample_rate=16000):
         data = []
@@ -30,14 +184,12 @@ class Dataset(torch.utils.data.Dataset):
         self.preprocessor = preprocessor
 
         # setup transforms:
-        self.transforms = [
-            torchaudio.transforms.MelSpectrogram(
-                sample_rate=sample_rate, sample_rate * 25 // 1000,
-                n_mels=preprocessor.num_features,
-                hop_length=sample_rate * 10 // 1000,
-            ),
-            torchvision.transforms.Lambda(log_normalize),
-        ]
+        self.transforms = feature_transforms(
+            preprocessor.num_features,
+            sample_rate,
+            preprocessor.feature_mean,
+            preprocessor.feature_std,
+        )
         if augmentation is not None:
             self.transforms.extend(augmentation)
         self.transforms = torchvision.transforms.Compose(self.transforms)
@@ -81,6 +233,11 @@ class Preprocessor:
             provided the preprocessor will split the text into words and
             map them to the corresponding token. If not provided the text
             will be tokenized at the grapheme level.
+        feature_mean (float) (optional) : The global mean of the log-mel
+            features, e.g. from `feature_stats`. If not provided the features
+            of each file are normalized with their own statistics.
+        feature_std (float) (optional) : The global standard deviation of the
+            log-mel features.
     """
 
     def __init__(
@@ -92,12 +249,16 @@ class Preprocessor:
         lexicon_path=None,
         use_words=False,
         prepend_wordsep=False,
+        feature_mean=None,
+        feature_std=None,
     ):
         if use_words:
             raise ValueError("use_words not supported for audio dataset")
         self.wordsep = "▁"
         self._prepend_wordsep = prepend_wordsep
         self.num_features = num_features
+        self.feature_mean = feature_mean
+        self.feature_std = feature_std
 
         data = []
         for sp in splits["train"]:
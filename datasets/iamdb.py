@@ -99,6 +99,19 @@ def load_image(example):
     return transforms.functional.resized_crop(img, y, x, h, w, size)
 
 
+def load_file(img_file, num_features):
+    """
+    Loads an image of a single line of text and returns the model inputs,
+    transformed as in the validation and test sets.
+    """
+    img = PIL.Image.open(img_file).convert("L")
+    w, h = img.size
+    img = transforms.functional.resize(img, (num_features, int((num_features / h) * w)))
+    return transforms.functional.normalize(
+        transforms.functional.to_tensor(img), mean=[0.912], std=[0.168]
+    )
+
+
 class RandomResizeCrop:
     def __init__(self, jitter=10, ratio=0.5):
         self.jitter = jitter
@@ -40,6 +40,12 @@ class Dataset(audioset.Dataset):
         )
 
 
+def load_file(audio_file, num_features, feature_mean=None, feature_std=None):
+    return audioset.load_file(
+        audio_file, num_features, Dataset.sample_rate, feature_mean, feature_std
+    )
+
+
 if __name__ == "__main__":
     import argparse
     import torch
@@ -81,11 +87,15 @@ if __name__ == "__main__":
 
         sys.exit(0)
 
-    # Compute mean and var stats:
-    audio = torch.cat([trainset[i][0] for i in range(len(trainset))], dim=2)
-    mean = torch.mean(audio)
-    std = torch.std(audio)
+    # Compute the global stats of the log-mel features:
+    mean, std = audioset.feature_stats(
+        (torchaudio.load(f)[0] for f, _, _ in trainset.dataset),
+        preprocessor.num_features,
+        Dataset.sample_rate,
+    )
     print(f"Data mean {mean} and standard deviation {std}.")
+    print(f'Add "feature_mean" : {mean}, "feature_std" : {std} to the data config')
+    print("to normalize the features with them.")
 
     # Compute average lengths of audio and targets:
     avg_in_t = sum(w for (w, _), _ in trainset.sample_sizes()) / len(trainset)
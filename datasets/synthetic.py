@@ -0,0 +1,163 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+import os
+import string
+import torch
+
+
+# The default shape of the synthetic data, which can be overridden by a
+# `synthetic.json` file in the data path:
+SPEC = {
+    "seed": 0,
+    "num_samples": {"train": 256, "validation": 32, "test": 32},
+    "min_width": 1000,
+    "max_width": 2000,
+    "min_target_length": 20,
+    "max_target_length": 60,
+}
+
+
+def load_spec(data_path):
+    spec = dict(SPEC)
+    spec_file = os.path.join(data_path, "synthetic.json")
+    if os.path.exists(spec_file):
+        with open(spec_file, "r") as fid:
+            spec.update(json.load(fid))
+    return spec
+
+
+class Dataset(torch.utils.data.Dataset):
+    """
+    A dataset of random inputs (e.g. images or spectrograms) of height
+    `preprocessor.num_features` and random targets. Used to benchmark
+    training without any data on disk.
+    """
+
+    def __init__(self, data_path, preprocessor, split, augment=False):
+        spec = load_spec(data_path)
+        if split not in spec["num_samples"]:
+            split_names = ", ".join(f"'{k}'" for k in spec["num_samples"].keys())
+            raise ValueError(f"Invalid split {split}, must be in [{split_names}].")
+
+        self.preprocessor = preprocessor
+        split_index = sorted(spec["num_samples"].keys()).index(split)
+        generator = torch.Generator().manual_seed(spec["seed"] + split_index)
+        num_samples = spec["num_samples"][split]
+        widths = torch.randint(
+            spec["min_width"], spec["max_width"] + 1, (num_samples,), generator=generator
+        )
+        lengths = torch.randint(
+            spec["min_target_length"],
+            spec["max_target_length"] + 1,
+            (num_samples,),
+            generator=generator,
+        )
+        seeds = torch.randint(2 ** 31, (num_samples,), generator=generator)
+        self.dataset = list(zip(widths.tolist(), lengths.tolist(), seeds.tolist()))
+
+    def sample_sizes(self):
+        """
+        Returns a list of tuples containing the input size
+        (width, height) and the output length for each sample.
+        """
+        return [
+            ((width, self.preprocessor.num_features), length)
+            for width, length, _ in self.dataset
+        ]
+
+    def __getitem__(self, index):
+        width, length, seed = self.dataset[index]
+        generator = torch.Generator().manual_seed(seed)
+        inputs = torch.randn(
+            1, self.preprocessor.num_features, width, generator=generator
+        )
+        outputs = torch.randint(
+            self.preprocessor.num_targets, (length,), generator=generator
+        )
+        return inputs, outputs
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class Preprocessor:
+    """
+    A preprocessor for the synthetic dataset.
+    Args:
+        data_path (str) : Path to the top level data directory.
+        num_features (int) : Height of the inputs.
+        tokens_path (str) (optional) : The path to the list of model output
+            tokens. If not provided the tokens are a default set of graphemes.
+        lexicon_path (str) (optional) : If provided the targets are token
+            indices, otherwise they are grapheme indices. The lexicon itself
+            is not loaded.
+    """
+
+    def __init__(
+        self,
+        data_path,
+        num_features,
+        tokens_path=None,
+        lexicon_path=None,
+        use_words=False,
+        prepend_wordsep=False,
+    ):
+        self.wordsep = "▁"
+        self._use_words = use_words
+        self.num_features = num_features
+
+        if tokens_path is not None:
+            with open(tokens_path, "r") as fid:
+                self.tokens = [l.strip() for l in fid]
+            graphemes = set(t for token in self.tokens for t in token)
+            self.graphemes = sorted(graphemes)
+        else:
+            self.graphemes = sorted(
+                set(string.ascii_letters + string.digits + string.punctuation)
+                | {self.wordsep}
+            )
+            self.tokens = self.graphemes
+
+        # The targets are random, so the lexicon is only used to decide if
+        # they are encoded as tokens or graphemes:
+        self.lexicon = {} if lexicon_path is not None else None
+
+        self.graphemes_to_index = {t: i for i, t in enumerate(self.graphemes)}
+        self.tokens_to_index = {t: i for i, t in enumerate(self.tokens)}
+
+    @property
+    def num_tokens(self):
+        return len(self.tokens)
+
+    @property
+    def num_targets(self):
+        return len(self.tokens) if self.lexicon is not None else len(self.graphemes)
+
+    @property
+    def use_words(self):
+        return self._use_words
+
+    def to_index(self, line):
+        tok_to_idx = self.graphemes_to_index
+        if self.lexicon is not None:
+            tok_to_idx = self.tokens_to_index
+        return torch.LongTensor([tok_to_idx[t] for t in line])
+
+    def to_text(self, indices):
+        encoding = self.graphemes
+        if self.lexicon is not None:
+            encoding = self.tokens
+        return self._post_process(encoding[i] for i in indices)
+
+    def tokens_to_text(self, indices):
+        return self._post_process(self.tokens[i] for i in indices)
+
+    def _post_process(self, indices):
+        # ignore preceding and trailling spaces
+        return "".join(indices).strip(self.wordsep)
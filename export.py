@@ -0,0 +1,92 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import torch
+
+import infer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export a trained acoustic model to TorchScript."
+    )
+    parser.add_argument(
+        "--config", type=str, help="The json configuration file used for training."
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default="/tmp/",
+        type=str,
+        help="Checkpoint path for loading the model",
+    )
+    parser.add_argument(
+        "--load_last",
+        default=False,
+        action="store_true",
+        help="Load the last saved model instead of the best model.",
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="Path to save the exported model."
+    )
+    args = parser.parse_args()
+    return args
+
+
+def remove_dropout(model):
+    """
+    Replaces the dropout layers of a model with identities in place.
+    """
+    for name, module in model.named_children():
+        if isinstance(module, torch.nn.Dropout):
+            setattr(model, name, torch.nn.Identity())
+        else:
+            remove_dropout(module)
+    return model
+
+
+def export_model(model):
+    """
+    Returns a scripted, frozen copy of the model in eval mode for inference.
+    The dropout layers are removed and the parameters are folded into
+    constants. The GTN criterion is not part of the exported model.
+    """
+    model = remove_dropout(copy.deepcopy(model).eval())
+    try:
+        scripted = torch.jit.script(model)
+    except Exception as e:
+        raise ValueError(f"Cannot export {type(model).__name__}: {e}")
+    return torch.jit.freeze(scripted)
+
+
+def save_exported(exported, path, model_type, input_size):
+    # loaded by `models.load_exported`:
+    metadata = {"model_type": model_type, "input_size": input_size}
+    torch.jit.save(exported, path, _extra_files={"model.json": json.dumps(metadata)})
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, "r") as fid:
+        config = json.load(fid)
+
+    _, _, model, _ = infer.load_inference(
+        config, args.checkpoint_path, args.load_last, torch.device("cpu")
+    )
+    exported = export_model(model)
+    save_exported(
+        exported, args.output, config["model_type"], config["data"]["num_features"]
+    )
+    logging.info(f"Saved exported model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import torch
+
+import models
+import transducer
+import utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Transcribe a directory of images or audio files."
+    )
+    parser.add_argument(
+        "--config", type=str, help="The json configuration file used for training."
+    )
+    parser.add_argument(
+        "--input_dir", type=str, help="Directory of the files to transcribe."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of the JSONL file to write the hypotheses to (default: stdout).",
+    )
+    parser.add_argument(
+        "--extensions",
+        nargs="+",
+        type=str,
+        default=[".png", ".jpg", ".flac", ".wav"],
+        help="Extensions of the files to transcribe.",
+    )
+    parser.add_argument("--disable_cuda", action="store_true", help="Disable CUDA")
+    parser.add_argument(
+        "--checkpoint_path",
+        default="/tmp/",
+        type=str,
+        help="Checkpoint path for loading the model",
+    )
+    parser.add_argument(
+        "--load_last",
+        default=False,
+        action="store_true",
+        help="Load the last saved model instead of the best model.",
+    )
+    parser.add_argument(
+        "--exported_model",
+        type=str,
+        default=None,
+        help="Use the model saved by `export.py` at this path.",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Use the fused inference only implementation of the TDS models.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="Batch size (default: the batch size of the config).",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of processes loading and transforming the files.",
+    )
+    parser.add_argument(
+        "--confidences",
+        action="store_true",
+        help="Also write the confidence of each word (transducer criterion only).",
+    )
+    parser.add_argument(
+        "--sort_batches",
+        type=int,
+        default=8,
+        help="Number of batches of loaded files sorted together by width.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class FileDataset(torch.utils.data.Dataset):
+    def __init__(self, files, load_file):
+        self.files = files
+        self.load_file = load_file
+
+    def __getitem__(self, index):
+        return self.files[index], self.load_file(self.files[index])
+
+    def __len__(self):
+        return len(self.files)
+
+
+def list_files(input_dir, extensions):
+    files = []
+    for root, _, filenames in os.walk(input_dir):
+        files.extend(
+            os.path.join(root, f)
+            for f in filenames
+            if os.path.splitext(f)[1].lower() in extensions
+        )
+    return sorted(files)
+
+
+def width_batches(samples, batch_size, sort_batches):
+    """
+    Groups a stream of (file, inputs) samples into batches of inputs of
+    similar widths. Up to `sort_batches` batches of samples are buffered and
+    sorted by width at a time.
+    """
+    buffer = []
+
+    def flush():
+        buffer.sort(key=lambda s: s[1].shape[-1])
+        for i in range(0, len(buffer), batch_size):
+            yield buffer[i : i + batch_size]
+        buffer.clear()
+
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) == batch_size * sort_batches:
+            yield from flush()
+    yield from flush()
+
+
+def load_vocabulary(config, checkpoint_path):
+    """
+    Returns the vocabulary saved with the checkpoints, or builds it from the
+    dataset for checkpoints saved without one.
+    """
+    if os.path.exists(os.path.join(checkpoint_path, utils.Vocabulary.FILENAME)):
+        return utils.Vocabulary.load(checkpoint_path)
+    dataset = utils.module_from_file(
+        "dataset", f"datasets/{config['data']['dataset']}.py"
+    )
+    preprocessor = dataset.Preprocessor(
+        config["data"]["data_path"],
+        num_features=config["data"]["num_features"],
+        tokens_path=config["data"].get("tokens", None),
+        lexicon_path=config["data"].get("lexicon", None),
+        use_words=config["data"].get("use_words", False),
+        prepend_wordsep=config["data"].get("prepend_wordsep", False),
+    )
+    return utils.Vocabulary.from_preprocessor(preprocessor)
+
+
+def load_inference(
+    config, checkpoint_path, load_last, device, exported_model=None, fused=False
+):
+    """
+    Returns the dataset module, the vocabulary and the model and criterion
+    loaded from the checkpoint for inference. If `exported_model` is given,
+    the model is loaded from that file saved by `export.py` instead. With
+    `fused=True` the fused implementation of the TDS models is used.
+    """
+    dataset = config["data"]["dataset"]
+    if not os.path.exists(f"datasets/{dataset}.py"):
+        raise ValueError(f"Unknown dataset {dataset}")
+    dataset = utils.module_from_file("dataset", f"datasets/{dataset}.py")
+    if not hasattr(dataset, "load_file"):
+        raise ValueError(f"Dataset {config['data']['dataset']} has no input files.")
+
+    input_size = config["data"]["num_features"]
+    vocabulary = load_vocabulary(config, checkpoint_path)
+    criterion, output_size = models.load_criterion(
+        config.get("criterion_type", "ctc"),
+        vocabulary,
+        config.get("criterion", {}),
+    )
+    criterion = criterion.to(device)
+    model = models.load_model(
+        config["model_type"], input_size, output_size, config["model"], fused
+    ).to(device)
+    models.load_from_checkpoint(model, criterion, checkpoint_path, load_last)
+    model.eval()
+    if exported_model is not None:
+        model = models.load_exported(exported_model, device)
+    return dataset, vocabulary, model, criterion
+
+
+@torch.no_grad()
+def transcribe(inputs, model, criterion, vocabulary, device, confidences=False):
+    """
+    Returns the hypothesis of each of a list of inputs of shape [1, H, W].
+    With `confidences=True` the words of each hypothesis and their
+    confidences are also returned as a list of `(word, confidence)`.
+    """
+    inputs, _ = utils.padding_collate([(i, None) for i in inputs])
+    outputs = model(inputs.to(device))
+    if not confidences:
+        predictions = criterion.viterbi(outputs)
+        return [vocabulary.tokens_to_text(p.tolist()) for p in predictions]
+    predictions, scores = criterion.viterbi(outputs, confidences=True)
+    return [
+        (
+            vocabulary.tokens_to_text(p.tolist()),
+            vocabulary.word_confidences(p.tolist(), s.tolist()),
+        )
+        for p, s in zip(predictions, scores)
+    ]
+
+
+def infer(args):
+    with open(args.config, "r") as fid:
+        config = json.load(fid)
+
+    if not args.disable_cuda:
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    dataset, vocabulary, model, criterion = load_inference(
+        config,
+        args.checkpoint_path,
+        args.load_last,
+        device,
+        args.exported_model,
+        args.fused,
+    )
+    if args.confidences and not isinstance(criterion, transducer.Transducer):
+        raise ValueError("Confidences are only computed by the transducer criterion.")
+    input_size = config["data"]["num_features"]
+    files = list_files(args.input_dir, args.extensions)
+    logging.info(f"Transcribing {len(files)} files from {args.input_dir}")
+    loader = torch.utils.data.DataLoader(
+        FileDataset(
+            files,
+            functools.partial(
+                dataset.load_file,
+                num_features=input_size,
+                **utils.feature_stats(config["data"]),
+            ),
+        ),
+        batch_size=None,
+        num_workers=args.num_workers,
+    )
+    batch_size = args.batch_size or config["optim"]["batch_size"]
+
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    start = time.perf_counter()
+    num_files = 0
+    try:
+        for batch in width_batches(loader, batch_size, args.sort_batches):
+            names, inputs = zip(*batch)
+            hypotheses = transcribe(
+                inputs, model, criterion, vocabulary, device, args.confidences
+            )
+            for name, hypothesis in zip(names, hypotheses):
+                if not args.confidences:
+                    result = {"file": name, "hypothesis": hypothesis}
+                else:
+                    hypothesis, words = hypothesis
+                    result = {
+                        "file": name,
+                        "hypothesis": hypothesis,
+                        # the confidence of a hypothesis is that of its worst word:
+                        "confidence": min((c for _, c in words), default=1.0),
+                        "words": [{"word": w, "confidence": c} for w, c in words],
+                    }
+                output.write(json.dumps(result) + "\n")
+            num_files += len(batch)
+    finally:
+        if args.output is not None:
+            output.close()
+    elapsed = time.perf_counter() - start
+    logging.info(
+        "Transcribed {} files in {:.2f} sec, {:.2f} files/sec".format(
+            num_files, elapsed, num_files / elapsed if elapsed > 0 else 0
+        )
+    )
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    infer(args)
+
+
+if __name__ == "__main__":
+    main()
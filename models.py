@@ -6,6 +6,8 @@ LICENSE file in the root directory of this source tree.
 """
 
 import gtn
+import json
+import logging
 from itertools import groupby
 import numpy as np
 import os
@@ -14,6 +16,21 @@ import utils
 import transducer
 
 
+def instance_norm_(inputs, norm):
+    """
+    Applies an instance norm in place to channels last inputs of shape
+    [B, ..., C], normalizing over all but the first and last dimensions.
+    """
+    dims = tuple(range(1, inputs.dim() - 1))
+    outputs = inputs.sub_(inputs.mean(dims, keepdim=True))
+    variance = outputs.square().mean(dims, keepdim=True)
+    scale = torch.rsqrt(variance.add_(norm.eps))
+    if norm.affine:
+        scale.mul_(norm.weight)
+        return outputs.mul_(scale).add_(norm.bias)
+    return outputs.mul_(scale)
+
+
 class TDSBlock2d(torch.nn.Module):
     def __init__(self, in_channels, img_depth, kernel_size, dropout):
         super(TDSBlock2d, self).__init__()
@@ -48,7 +65,7 @@ class TDSBlock2d(torch.nn.Module):
         # inputs shape: [B, CD, H, W]
         B, CD, H, W = inputs.shape
         C, D = self.in_channels, self.img_depth
-        outputs = self.conv(inputs.view(B, C, D, H, W)).view(B, CD, H, W) + inputs
+        outputs = self.conv(inputs.view(B, C, D, H, W)).reshape(B, CD, H, W) + inputs
         outputs = self.instance_norms[0](outputs)
 
         outputs = self.fc(outputs.transpose(1, 3)).transpose(1, 3) + outputs
@@ -58,7 +75,47 @@ class TDSBlock2d(torch.nn.Module):
         return outputs
 
 
+class TDSBlock2dInference(TDSBlock2d):
+    """
+    An inference only `TDSBlock2d` with the same parameters. The inputs and
+    outputs are channels last, [B, H, W, C * D], so that the fully connected
+    layers need no transposes, and the element-wise operations are done in
+    place. The convolution runs on the channels last memory format, with the
+    depth folded into the batch.
+    """
+
+    def forward(self, inputs):
+        # inputs shape: [B, H, W, C * D]
+        B, H, W, CD = inputs.shape
+        C, D = self.in_channels, self.img_depth
+        conv = self.conv[0]
+        outputs = inputs.view(B, H, W, C, D).permute(0, 4, 1, 2, 3)
+        outputs = outputs.reshape(B * D, H, W, C)
+        outputs = torch.nn.functional.conv2d(
+            outputs.permute(0, 3, 1, 2),
+            conv.weight.squeeze(2),
+            conv.bias,
+            padding=conv.padding[1:],
+        )
+        outputs = outputs.relu_().view(B, D, C, H, W).permute(0, 3, 4, 2, 1)
+        outputs = instance_norm_(
+            (inputs.view(B, H, W, C, D) + outputs).view(B, H, W, CD),
+            self.instance_norms[0],
+        )
+
+        hidden = torch.nn.functional.linear(
+            outputs, self.fc[0].weight, self.fc[0].bias
+        ).relu_()
+        hidden = torch.nn.functional.linear(hidden, self.fc[3].weight, self.fc[3].bias)
+        outputs = instance_norm_(hidden.add_(outputs), self.instance_norms[1])
+
+        # outputs shape: [B, H, W, C * D]
+        return outputs
+
+
 class TDS2d(torch.nn.Module):
+    block_type = TDSBlock2d
+
     def __init__(
         self, input_size, output_size, depth, tds_groups, kernel_size, dropout,
         in_channels=1
@@ -67,7 +124,7 @@ class TDS2d(torch.nn.Module):
         # downsample layer -> TDS2d group -> ... -> Linear output layer
         self.in_channels = in_channels
         modules = []
-        stride_h = np.prod([grp["stride"][0] for grp in tds_groups])
+        stride_h = int(np.prod([grp["stride"][0] for grp in tds_groups]))
         assert (
             input_size % stride_h == 0
         ), f"Image height not divisible by total stride {stride_h}."
@@ -90,7 +147,7 @@ class TDS2d(torch.nn.Module):
             )
             for _ in range(tds_group["num_blocks"]):
                 modules.append(
-                    TDSBlock2d(tds_group["channels"], depth, kernel_size, dropout)
+                    self.block_type(tds_group["channels"], depth, kernel_size, dropout)
                 )
             in_channels = out_channels
         self.tds = torch.nn.Sequential(*modules)
@@ -110,6 +167,39 @@ class TDS2d(torch.nn.Module):
         return self.linear(outputs.permute(0, 2, 1))
 
 
+class TDS2dInference(TDS2d):
+    """
+    An inference only `TDS2d` which loads the same state dict. The
+    activations are kept channels last throughout, see `TDSBlock2dInference`.
+    """
+
+    block_type = TDSBlock2dInference
+
+    def forward(self, inputs):
+        # inputs shape: [B, H, W]
+        B, H, W = inputs.shape
+        outputs = inputs.reshape(B, self.in_channels, H // self.in_channels, W)
+        outputs = outputs.permute(0, 2, 3, 1)
+        for module in self.tds:
+            if isinstance(module, torch.nn.Conv2d):
+                # channels last inputs are in the channels last memory format:
+                outputs = module(outputs.permute(0, 3, 1, 2))
+                outputs = outputs.permute(0, 2, 3, 1).contiguous()
+            elif isinstance(module, torch.nn.ReLU):
+                outputs = outputs.relu_()
+            elif isinstance(module, torch.nn.InstanceNorm2d):
+                outputs = instance_norm_(outputs, module)
+            elif not isinstance(module, torch.nn.Dropout):
+                outputs = module(outputs)
+
+        # outputs shape: [B, H, W, C]
+        B, H, W, C = outputs.shape
+        outputs = outputs.permute(0, 2, 3, 1).reshape(B, W, C * H)
+
+        # outputs shape: [B, W, output_size]
+        return self.linear(outputs)
+
+
 class TDS2dTransducer(torch.nn.Module):
     def __init__(
             self, input_size, output_size, tokens, kernel_size, stride, tds1, tds2, wfst=True, **kwargs,
@@ -199,7 +289,7 @@ class TDSBlock(torch.nn.Module):
         # inputs shape: [B, C * H, W]
         B, CH, W = inputs.shape
         C, H = self.in_channels, self.num_features
-        outputs = self.conv(inputs.view(B, C, H, W)).view(B, CH, W) + inputs
+        outputs = self.conv(inputs.view(B, C, H, W)).reshape(B, CH, W) + inputs
         outputs = self.instance_norms[0](outputs)
 
         outputs = self.fc(outputs.transpose(1, 2)).transpose(1, 2) + outputs
@@ -209,7 +299,54 @@ class TDSBlock(torch.nn.Module):
         return outputs
 
 
+class TDSBlockInference(TDSBlock):
+    """
+    An inference only `TDSBlock` with the same parameters. The inputs and
+    outputs are channels last, [B, W, C * H], so that the fully connected
+    layers need no transposes. The convolution is computed as one matrix
+    product per kernel tap with the batch folded into the columns, and the
+    element-wise operations are done in place.
+    """
+
+    def forward(self, inputs):
+        # inputs shape: [B, W, C * H]
+        B, W, CH = inputs.shape
+        C, H = self.in_channels, self.num_features
+        conv = self.conv[0]
+        k = conv.kernel_size[1]
+        Wp = W + k - 1
+        padded = torch.nn.functional.pad(inputs, (0, 0, k // 2, k // 2))
+        # The frames of the whole batch side by side, shape: [C, B * Wp * H].
+        # Every tap of the kernel is then a single matrix product with a
+        # shifted slice of them, giving the outputs of all frames, some of
+        # which straddle two inputs and are dropped, shape: [C, N * H].
+        frames = padded.view(B * Wp, C, H).transpose(0, 1).reshape(C, -1)
+        N = B * Wp - k + 1
+        weight = conv.weight.squeeze(2)
+        outputs = torch.addmm(
+            conv.bias.view(C, 1), weight[:, :, 0], frames[:, : N * H]
+        )
+        for j in range(1, k):
+            outputs.addmm_(weight[:, :, j], frames[:, j * H : j * H + N * H])
+        outputs = outputs.relu_().view(C, N, H)
+        outputs = outputs.as_strided((B, W, C, H), (Wp * H, H, N * H, 1))
+        # the sum takes the channels last layout of the inputs:
+        outputs = (inputs.view(B, W, C, H) + outputs).view(B, W, CH)
+        outputs = instance_norm_(outputs, self.instance_norms[0])
+
+        hidden = torch.nn.functional.linear(
+            outputs, self.fc[0].weight, self.fc[0].bias
+        ).relu_()
+        hidden = torch.nn.functional.linear(hidden, self.fc[3].weight, self.fc[3].bias)
+        outputs = instance_norm_(hidden.add_(outputs), self.instance_norms[1])
+
+        # outputs shape: [B, W, C * H]
+        return outputs
+
+
 class TDS(torch.nn.Module):
+    block_type = TDSBlock
+
     def __init__(self, input_size, output_size, tds_groups, kernel_size, dropout):
         super(TDS, self).__init__()
         modules = []
@@ -233,7 +370,9 @@ class TDS(torch.nn.Module):
             )
             for _ in range(tds_group["num_blocks"]):
                 modules.append(
-                    TDSBlock(tds_group["channels"], input_size, kernel_size, dropout)
+                    self.block_type(
+                        tds_group["channels"], input_size, kernel_size, dropout
+                    )
                 )
             in_channels = out_channels
         self.tds = torch.nn.Sequential(*modules)
@@ -246,6 +385,46 @@ class TDS(torch.nn.Module):
         return self.linear(outputs.permute(0, 2, 1))
 
 
+class TDSInference(TDS):
+    """
+    An inference only `TDS` which loads the same state dict. The activations
+    are kept channels last throughout, see `TDSBlockInference`.
+    """
+
+    block_type = TDSBlockInference
+
+    @staticmethod
+    def _downsample(conv, inputs):
+        # The convolution of channels last inputs, [B, W, C], is a single
+        # matrix product with the windows of the padded inputs.
+        B, W, C = inputs.shape
+        (k,), (stride,), (padding,) = conv.kernel_size, conv.stride, conv.padding
+        padded = torch.nn.functional.pad(inputs, (0, 0, padding, padding))
+        W_out = (W + 2 * padding - k) // stride + 1
+        windows = padded.as_strided(
+            (B, W_out, k * C), (padded.stride(0), stride * C, 1)
+        ).reshape(B * W_out, k * C)
+        weight = conv.weight.transpose(1, 2).reshape(conv.out_channels, k * C)
+        outputs = torch.nn.functional.linear(windows, weight, conv.bias)
+        return outputs.view(B, W_out, conv.out_channels)
+
+    def forward(self, inputs):
+        # inputs shape: [B, H, W]
+        outputs = inputs.transpose(1, 2).contiguous()
+        for module in self.tds:
+            if isinstance(module, torch.nn.Conv1d):
+                outputs = self._downsample(module, outputs)
+            elif isinstance(module, torch.nn.ReLU):
+                outputs = outputs.relu_()
+            elif isinstance(module, torch.nn.InstanceNorm1d):
+                outputs = instance_norm_(outputs, module)
+            elif not isinstance(module, torch.nn.Dropout):
+                outputs = module(outputs)
+
+        # outputs shape: [B, W, output_size]
+        return self.linear(outputs)
+
+
 class RNN(torch.nn.Module):
     def __init__(
         self,
@@ -344,9 +523,10 @@ class CTC(torch.nn.Module):
 
 
 class ASG(torch.nn.Module):
-    def __init__(self, num_classes, num_replabels=1, use_garbage=True):
+    def __init__(self, num_classes, num_replabels=1, use_garbage=True, use_pt=False):
         super(ASG, self).__init__()
         self.num_classes = num_classes
+        self.use_pt = use_pt  # use pytorch version instead of GTN
         self.num_replabels = num_replabels
         assert self.num_replabels > 0
         self.garbage_idx = (num_classes + num_replabels) if use_garbage else None
@@ -363,6 +543,8 @@ class ASG(torch.nn.Module):
                 prev_tgt = targets[idx]
                 targets[idx] = [self.garbage_idx] * (len(prev_tgt) * 2 + 1)
                 targets[idx][1::2] = prev_tgt
+        if self.use_pt:
+            return utils.asg_loss(inputs, self.transitions, targets, "mean")
         return utils.ASGLoss(inputs, self.transitions, targets, "mean")
 
     def viterbi(self, outputs):
@@ -374,7 +556,7 @@ class ASG(torch.nn.Module):
         def process(b):
             # create emission graph
             g_emissions = gtn.linear_graph(T, C, False)
-            cpu_data = outputs[b].cpu().contiguous()
+            cpu_data = outputs[b].cpu().float().contiguous()
             g_emissions.set_weights(cpu_data.data_ptr())
 
             # create transition graph
@@ -393,17 +575,23 @@ class ASG(torch.nn.Module):
             predictions[b] = utils.unpack_replabels(
                 collapsed_prediction, self.num_replabels)
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
         return [torch.IntTensor(p) for p in predictions]
 
 
-def load_model(model_type, input_size, output_size, config):
+def load_model(model_type, input_size, output_size, config, fused=False):
+    """
+    Builds a model. With `fused=True` the TDS models are built with their
+    fused inference only implementation, which loads the same state dict.
+    """
     if model_type == "rnn":
         return RNN(input_size, output_size, **config)
     elif model_type == "tds":
-        return TDS(input_size, output_size, **config)
+        model_class = TDSInference if fused else TDS
+        return model_class(input_size, output_size, **config)
     elif model_type == "tds2d":
-        return TDS2d(input_size, output_size, **config)
+        model_class = TDS2dInference if fused else TDS2d
+        return model_class(input_size, output_size, **config)
     elif model_type == "tds2d_transducer":
         return TDS2dTransducer(input_size, output_size, **config)
     else:
@@ -415,8 +603,9 @@ def load_criterion(criterion_type, preprocessor, config):
     if criterion_type == "asg":
         num_replabels = config.get("num_replabels", 0)
         use_garbage = config.get("use_garbage", True)
+        use_pt = config.get("use_pt", False)  # use pytorch implementation
         return (
-            ASG(num_tokens, num_replabels, use_garbage),
+            ASG(num_tokens, num_replabels, use_garbage, use_pt),
             num_tokens + num_replabels + int(use_garbage),
         )
     elif criterion_type == "ctc":
@@ -435,6 +624,9 @@ def load_criterion(criterion_type, preprocessor, config):
             blank=blank,
             allow_repeats=config.get("allow_repeats", True),
             reduction="mean",
+            recompute=config.get("recompute", False),
+            dense_normalizer=config.get("dense_normalizer", True),
+            dense_bigram=config.get("dense_bigram", True),
         )
         return criterion, num_tokens + int(blank != "none")
     else:
@@ -449,3 +641,15 @@ def load_from_checkpoint(model, criterion, checkpoint_path, load_last=False):
         criterion_checkpoint += ".best"
     model.load_state_dict(torch.load(model_checkpoint))
     criterion.load_state_dict(torch.load(criterion_checkpoint))
+
+
+def load_exported(path, device):
+    """
+    Loads a model saved by `export.py` onto the device and optimizes its graph
+    for inference on that device, e.g. by fusing operations.
+    """
+    extra_files = {"model.json": ""}
+    exported = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files["model.json"])
+    logging.info("Loaded exported {} model from {}".format(metadata["model_type"], path))
+    return torch.jit.optimize_for_inference(exported)
@@ -0,0 +1,167 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import torch
+from torch.ao import quantization
+
+import models
+import utils
+
+
+CONV_TYPES = (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Quantize a trained acoustic model to int8 for CPU inference."
+    )
+    parser.add_argument(
+        "--config", type=str, help="The json configuration file used for training."
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default="/tmp/",
+        type=str,
+        help="Checkpoint path for loading the model",
+    )
+    parser.add_argument(
+        "--load_last",
+        default=False,
+        action="store_true",
+        help="Load the last saved model instead of the best model.",
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="Path to save the quantized model."
+    )
+    parser.add_argument(
+        "--dynamic_only",
+        action="store_true",
+        help="Only quantize the linear layers, which needs no calibration.",
+    )
+    parser.add_argument(
+        "--calibration_batches",
+        type=int,
+        default=10,
+        help="Number of batches to calibrate the convolutions with.",
+    )
+    parser.add_argument(
+        "--split",
+        default="validation",
+        type=str,
+        choices=["train", "validation", "test"],
+        help="Data split to calibrate on (default: 'validation')",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def wrap_convs(model):
+    """
+    Wraps the convolutions of a model in place to quantize their inputs and
+    dequantize their outputs, so that the other layers run in float.
+    """
+    qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+    for name, module in model.named_children():
+        if isinstance(module, CONV_TYPES):
+            wrapper = quantization.QuantWrapper(module)
+            wrapper.qconfig = qconfig
+            setattr(model, name, wrapper)
+        else:
+            wrap_convs(module)
+    return model
+
+
+def quantize_model(model, calibration_inputs=None):
+    """
+    Returns an int8 copy of the model for CPU inference. The linear layers
+    are quantized dynamically. If `calibration_inputs` (an iterable of input
+    batches) are given, the convolutions are also quantized statically with
+    the ranges of their activations on these inputs. Other layers, e.g. the
+    instance norms, run in float.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if calibration_inputs is not None:
+        quantization.prepare(wrap_convs(model), inplace=True)
+        with torch.no_grad():
+            for inputs in calibration_inputs:
+                model(inputs)
+        quantization.convert(model, inplace=True)
+    return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model, path, static):
+    torch.save({"static": static, "state_dict": model.state_dict()}, path)
+
+
+def load_quantized(path, model):
+    """
+    Loads a model saved by `quantize.py` given the float model it was
+    quantized from, e.g. as built by `models.load_model`.
+    """
+    checkpoint = torch.load(path)
+    model = copy.deepcopy(model).cpu().eval()
+    if checkpoint["static"]:
+        # the quantization parameters are loaded from the state dict:
+        quantization.prepare(wrap_convs(model), inplace=True)
+        quantization.convert(model, inplace=True)
+    model = quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.load_state_dict(checkpoint["state_dict"])
+    return model
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, "r") as fid:
+        config = json.load(fid)
+
+    dataset = config["data"]["dataset"]
+    if not os.path.exists(f"datasets/{dataset}.py"):
+        raise ValueError(f"Unknown dataset {dataset}")
+    dataset = utils.module_from_file("dataset", f"datasets/{dataset}.py")
+
+    input_size = config["data"]["num_features"]
+    data_path = config["data"]["data_path"]
+    preprocessor = dataset.Preprocessor(
+        data_path,
+        num_features=input_size,
+        tokens_path=config["data"].get("tokens", None),
+        lexicon_path=config["data"].get("lexicon", None),
+        use_words=config["data"].get("use_words", False),
+        prepend_wordsep=config["data"].get("prepend_wordsep", False),
+        **utils.feature_stats(config["data"]),
+    )
+    criterion, output_size = models.load_criterion(
+        config.get("criterion_type", "ctc"),
+        preprocessor,
+        config.get("criterion", {}),
+    )
+    model = models.load_model(
+        config["model_type"], input_size, output_size, config["model"]
+    )
+    models.load_from_checkpoint(model, criterion, args.checkpoint_path, args.load_last)
+
+    calibration_inputs = None
+    if not args.dynamic_only:
+        data = dataset.Dataset(data_path, preprocessor, split=args.split)
+        loader = utils.data_loader(data, config)
+        calibration_inputs = (
+            inputs for inputs, _ in itertools.islice(loader, args.calibration_batches)
+        )
+    model = quantize_model(model, calibration_inputs)
+    save_quantized(model, args.output, not args.dynamic_only)
+    logging.info(f"Saved quantized model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
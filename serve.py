@@ -0,0 +1,348 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import http
+import io
+import json
+import logging
+import math
+import time
+import torch
+
+import infer
+import utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve a recognition model over HTTP with dynamic batching."
+    )
+    parser.add_argument(
+        "--config", type=str, help="The json configuration file used for training."
+    )
+    parser.add_argument("--disable_cuda", action="store_true", help="Disable CUDA")
+    parser.add_argument(
+        "--checkpoint_path",
+        default="/tmp/",
+        type=str,
+        help="Checkpoint path for loading the model",
+    )
+    parser.add_argument(
+        "--load_last",
+        default=False,
+        action="store_true",
+        help="Load the last saved model instead of the best model.",
+    )
+    parser.add_argument(
+        "--exported_model",
+        type=str,
+        default=None,
+        help="Use the model saved by `export.py` at this path.",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Use the fused inference only implementation of the TDS models.",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host.")
+    parser.add_argument("--port", type=int, default=8000, help="Port.")
+    parser.add_argument(
+        "--max_batch", type=int, default=8, help="Maximum number of inputs per batch."
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=20,
+        help="Maximum time a request waits for its batch to fill.",
+    )
+    parser.add_argument(
+        "--bucket_width",
+        type=int,
+        default=200,
+        help="Inputs are batched with inputs in the same range of this width.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=2,
+        help="Number of threads loading and transforming the input files.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class Histogram:
+    """
+    A histogram of values with fixed bucket upper bounds.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds) + [math.inf]
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.0,
+            "buckets": {str(b): c for b, c in zip(self.bounds, self.counts)},
+        }
+
+
+class Request:
+    def __init__(self, inputs, deadline, future):
+        self.inputs = inputs
+        self.deadline = deadline
+        self.future = future
+
+
+class Batcher:
+    """
+    Accumulates requests into batches of inputs of similar widths. A batch
+    is run when it has `max_batch` inputs or when its oldest request has
+    waited `max_wait_ms`.
+
+    Args:
+        run_batch (callable) : Returns the results of a list of inputs of
+            shape [1, H, W]. It is called in `executor`.
+        max_batch (int) : Maximum number of inputs per batch.
+        max_wait_ms (float) : Maximum time a request waits for its batch.
+        bucket_width (int) : Width of the ranges of input widths batched
+            together.
+        executor (concurrent.futures.Executor) : Runs the batches. The
+            criteria are not thread safe, so it must run one batch at a
+            time, e.g. a `ThreadPoolExecutor(1)`.
+    """
+
+    LATENCY_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, run_batch, max_batch, max_wait_ms, bucket_width, executor):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_width = bucket_width
+        self.executor = executor
+        self.buckets = collections.defaultdict(list)
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.latency_ms = Histogram(self.LATENCY_BOUNDS_MS)
+        self.batch_ms = Histogram(self.LATENCY_BOUNDS_MS)
+        self.batch_sizes = Histogram(range(1, max_batch + 1))
+        self._timer = None
+
+    async def submit(self, inputs):
+        """
+        Queues one input and returns its result once its batch has run.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        bucket = inputs.shape[-1] // self.bucket_width
+        request = Request(inputs, loop.time() + self.max_wait, loop.create_future())
+        self.buckets[bucket].append(request)
+        self.queue_depth += 1
+        if len(self.buckets[bucket]) >= self.max_batch:
+            self._dispatch(bucket)
+        self._schedule()
+        try:
+            return await request.future
+        finally:
+            self.latency_ms.observe((time.perf_counter() - start) * 1000)
+
+    def _schedule(self):
+        # wake up at the earliest deadline of the waiting requests:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.queue_depth > 0:
+            loop = asyncio.get_running_loop()
+            deadline = min(r[0].deadline for r in self.buckets.values() if len(r) > 0)
+            self._timer = loop.call_at(deadline, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        now = asyncio.get_running_loop().time()
+        for bucket, requests in list(self.buckets.items()):
+            if len(requests) > 0 and requests[0].deadline <= now:
+                self._dispatch(bucket)
+        self._schedule()
+
+    def _dispatch(self, bucket):
+        requests = self.buckets[bucket][: self.max_batch]
+        del self.buckets[bucket][: self.max_batch]
+        if len(self.buckets[bucket]) == 0:
+            del self.buckets[bucket]
+        self.queue_depth -= len(requests)
+        self.in_flight += len(requests)
+        self.batch_sizes.observe(len(requests))
+        asyncio.get_running_loop().create_task(self._run(requests))
+
+    async def _run(self, requests):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.run_batch, [r.inputs for r in requests]
+            )
+            for request, result in zip(requests, results):
+                request.future.set_result(result)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+        finally:
+            self.in_flight -= len(requests)
+            self.batch_ms.observe((time.perf_counter() - start) * 1000)
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "latency_ms": self.latency_ms.to_dict(),
+            "batch_ms": self.batch_ms.to_dict(),
+            "batch_size": self.batch_sizes.to_dict(),
+        }
+
+
+class Server:
+    """
+    A minimal HTTP server with two endpoints:
+        POST /transcribe : The body is an image or audio file. Returns the
+            hypothesis as JSON.
+        GET /metrics : Returns the queue depth, the histograms of the
+            request latency, batch run time and batch size, and the number
+            of failed requests as JSON.
+
+    Requests which can not be parsed or whose file can not be loaded fail
+    with status 400, failures of the model or decoder with status 500.
+
+    Args:
+        load_inputs (callable) : Returns the model inputs of a file object.
+        batcher (Batcher) : Batches and runs the inputs.
+        executor (concurrent.futures.Executor) : Runs `load_inputs`.
+    """
+
+    def __init__(self, load_inputs, batcher, executor):
+        self.load_inputs = load_inputs
+        self.batcher = batcher
+        self.executor = executor
+        self.errors = {"bad_request": 0, "server_error": 0}
+
+    def error(self, status, message):
+        if status == 400:
+            logging.exception("Bad request")
+            self.errors["bad_request"] += 1
+        else:
+            logging.exception("Server error")
+            self.errors["server_error"] += 1
+        return status, {"error": message}
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+        except Exception as e:
+            status, response = self.error(400, str(e))
+        else:
+            try:
+                status, response = await self.route(method, path, body)
+            except Exception as e:
+                status, response = self.error(500, str(e))
+        payload = json.dumps(response).encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            return 200, {"errors": self.errors, **self.batcher.metrics()}
+        if method == "POST" and path == "/transcribe":
+            loop = asyncio.get_running_loop()
+            try:
+                inputs = await loop.run_in_executor(
+                    self.executor, self.load_inputs, io.BytesIO(body)
+                )
+            except Exception as e:
+                return self.error(400, str(e))
+            try:
+                return 200, {"hypothesis": await self.batcher.submit(inputs)}
+            except Exception as e:
+                return self.error(500, str(e))
+        return 404, {"error": f"Unknown endpoint {method} {path}"}
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, "r") as fid:
+        config = json.load(fid)
+
+    if not args.disable_cuda:
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    dataset, vocabulary, model, criterion = infer.load_inference(
+        config,
+        args.checkpoint_path,
+        args.load_last,
+        device,
+        args.exported_model,
+        args.fused,
+    )
+    num_features = config["data"]["num_features"]
+    feature_stats = utils.feature_stats(config["data"])
+
+    def load_inputs(fid):
+        return dataset.load_file(fid, num_features, **feature_stats)
+
+    def run_batch(inputs):
+        return infer.transcribe(inputs, model, criterion, vocabulary, device)
+
+    # the batches run one at a time as the criterion graphs are shared, the
+    # samples of a batch are decoded in parallel by the criterion:
+    batch_executor = concurrent.futures.ThreadPoolExecutor(1)
+    load_executor = concurrent.futures.ThreadPoolExecutor(args.num_threads)
+    batcher = Batcher(
+        run_batch, args.max_batch, args.max_wait_ms, args.bucket_width, batch_executor
+    )
+    server = Server(load_inputs, batcher, load_executor)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import torch
+
+import models
+
+
+class StreamingConv:
+    """
+    Runs a convolution over the last dimension (time) of a stream of chunks
+    of inputs. The input frames needed by the next outputs are cached between
+    chunks. The left zero padding is added at the start of the stream and the
+    right padding after the last chunk, so that the outputs of a stream are
+    those of the convolution of the whole sequence.
+
+    Args:
+        conv (torch.nn.Conv1d or torch.nn.Conv2d) : The convolution.
+    """
+
+    def __init__(self, conv):
+        self.conv = conv
+        self.kernel_size = conv.kernel_size[-1]
+        self.stride = conv.stride[-1]
+        self.padding = conv.padding[-1]
+        if isinstance(conv, torch.nn.Conv1d):
+            self.conv_fn = torch.nn.functional.conv1d
+        else:
+            self.conv_fn = torch.nn.functional.conv2d
+        # the other dimensions are still padded by the convolution:
+        self.other_padding = tuple(conv.padding[:-1]) + (0,)
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+
+    @property
+    def lookahead(self):
+        """
+        The number of input frames needed after the center of the window of
+        an output.
+        """
+        return self.kernel_size - 1 - self.padding
+
+    def __call__(self, inputs, final=False):
+        if self.buffer is None:
+            inputs = torch.nn.functional.pad(inputs, (self.padding, 0))
+        else:
+            inputs = torch.cat([self.buffer, inputs], dim=-1)
+        if final:
+            inputs = torch.nn.functional.pad(inputs, (0, self.padding))
+        num_outputs = max((inputs.shape[-1] - self.kernel_size) // self.stride + 1, 0)
+        self.buffer = None if final else inputs[..., num_outputs * self.stride :]
+        if num_outputs == 0:
+            shape = list(inputs.shape)
+            shape[1], shape[-1] = self.conv.out_channels, 0
+            return inputs.new_zeros(shape)
+        end = (num_outputs - 1) * self.stride + self.kernel_size
+        return self.conv_fn(
+            inputs[..., :end],
+            self.conv.weight,
+            self.conv.bias,
+            stride=self.conv.stride,
+            padding=self.other_padding,
+        )
+
+
+class StreamingInstanceNorm:
+    """
+    An instance norm over the last dimension (time) of a stream of chunks of
+    inputs of shape [B, C, T]. Each frame is normalized with the statistics
+    of the frames up to and including it, or of only the last `window` of
+    them, so that the outputs do not depend on how the stream is chunked.
+    If precomputed statistics are given, all the frames are normalized with
+    them instead.
+
+    Known limitation: the instance norm of the model normalizes with the
+    statistics of the whole utterance, which are not known until its end, so
+    the outputs of a stream do not match those of the norm except with
+    precomputed statistics of the utterance itself. Statistics averaged over
+    other utterances (see `norm_statistics`) only bring the outputs closer.
+
+    Args:
+        norm (torch.nn.InstanceNorm1d) : The instance norm.
+        window (int, optional) : The number of frames the statistics are
+            computed over. Defaults to all frames since the start.
+        stats (tuple, optional) : The mean and variance of each channel, e.g.
+            as returned by `norm_statistics`.
+    """
+
+    def __init__(self, norm, window=None, stats=None):
+        self.norm = norm
+        self.window = window
+        self.stats = stats
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums = None
+        self.history = None
+
+    def __call__(self, inputs, final=False):
+        T = inputs.shape[2]
+        frames = inputs.double()
+        if self.stats is not None:
+            mean, variance = (s.to(frames).view(1, -1, 1) for s in self.stats)
+        elif self.window is None:
+            sums = frames.cumsum(2)
+            squares = frames.square().cumsum(2)
+            if self.sums is not None:
+                sums += self.sums[0]
+                squares += self.sums[1]
+            counts = torch.arange(self.count + 1, self.count + T + 1)
+            if T > 0:
+                self.sums = (sums[..., -1:], squares[..., -1:])
+                self.count += T
+        else:
+            if self.history is not None:
+                frames = torch.cat([self.history, frames], dim=2)
+            past = frames.shape[2] - T
+            cumsums = torch.nn.functional.pad(frames.cumsum(2), (1, 0))
+            cumsquares = torch.nn.functional.pad(frames.square().cumsum(2), (1, 0))
+            end = torch.arange(past + 1, past + T + 1)
+            start = (end - self.window).clamp(min=0)
+            sums = cumsums[..., end] - cumsums[..., start]
+            squares = cumsquares[..., end] - cumsquares[..., start]
+            counts = end - start
+            self.history = frames[..., -self.window :]
+            frames = frames[..., past:]
+        if self.stats is None:
+            counts = counts.to(frames)
+            mean = sums / counts
+            variance = (squares / counts - mean.square()).clamp(min=0)
+        outputs = ((frames - mean) * torch.rsqrt(variance + self.norm.eps)).to(inputs)
+        if self.norm.affine:
+            outputs = outputs * self.norm.weight.view(1, -1, 1)
+            outputs = outputs + self.norm.bias.view(1, -1, 1)
+        if final:
+            self.reset()
+        return outputs
+
+
+@torch.no_grad()
+def norm_statistics(model, utterances):
+    """
+    Returns the mean and variance of each channel of the inputs of each
+    instance norm of a model, averaged over utterances, by the name of the
+    norm in the model. The utterances are an iterable of inputs of shape
+    [1, H, T], or batches of unpadded inputs of the same length.
+    """
+    model = model.eval()
+    names = {
+        module: name
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.InstanceNorm1d)
+    }
+    sums = {name: [0, 0, 0] for name in names.values()}
+
+    def record(norm, inputs, outputs):
+        frames = inputs[0].double()
+        stats = sums[names[norm]]
+        stats[0] = stats[0] + frames.mean(2).sum(0)
+        stats[1] = stats[1] + frames.var(2, unbiased=False).sum(0)
+        stats[2] += frames.shape[0]
+
+    handles = [norm.register_forward_hook(record) for norm in names]
+    try:
+        for inputs in utterances:
+            model(inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {
+        name: (mean / count, variance / count)
+        for name, (mean, variance, count) in sums.items()
+    }
+
+
+class StreamingTDSBlock:
+    def __init__(self, block, norm_window=None, norm_stats=None):
+        self.block = block
+        self.conv = StreamingConv(block.conv[0])
+        self.instance_norms = [
+            StreamingInstanceNorm(norm, norm_window, norm_stats.get(norm))
+            for norm in block.instance_norms
+        ]
+        self.reset()
+
+    def reset(self):
+        self.conv.reset()
+        for norm in self.instance_norms:
+            norm.reset()
+        # the inputs of the residual connection of the convolution:
+        self.residual = None
+
+    @property
+    def lookahead(self):
+        return self.conv.lookahead
+
+    def __call__(self, inputs, final=False):
+        # inputs shape: [B, C * H, T]
+        B, CH, T = inputs.shape
+        C, H = self.block.in_channels, self.block.num_features
+        if self.residual is not None:
+            self.residual = torch.cat([self.residual, inputs], dim=2)
+        else:
+            self.residual = inputs
+        outputs = self.block.conv[1](self.conv(inputs.view(B, C, H, T), final))
+        T = outputs.shape[3]
+        outputs = outputs.reshape(B, CH, T) + self.residual[..., :T]
+        self.residual = None if final else self.residual[..., T:]
+        outputs = self.instance_norms[0](outputs, final)
+
+        outputs = self.block.fc(outputs.transpose(1, 2)).transpose(1, 2) + outputs
+        outputs = self.instance_norms[1](outputs, final)
+
+        # outputs shape: [B, C * H, T]
+        return outputs
+
+
+class StreamingTDS:
+    """
+    Runs a trained `TDS` model on a stream of chunks of inputs, e.g. the
+    features of live audio, with the same weights.
+
+    The convolutions of the model are centered, so each output frame needs
+    `lookahead` input frames after the frame at its center. The outputs of a
+    chunk are the frames for which these are available, and the rest follow
+    with the next chunks or the last one. The convolution outputs are exact.
+    The instance norms use the statistics of the frames so far instead of the
+    whole utterance (see `StreamingInstanceNorm`), which is the only
+    difference with the outputs of the model on the whole utterance. These
+    statistics are noisy at the start of a stream, so the outputs can be far
+    from those of the model. With precomputed statistics from
+    `norm_statistics` the outputs only differ by how far the statistics of
+    the utterance are from them, and match the model only when they are
+    computed on the utterance itself. This is a known limitation: the
+    outputs of a stream are an approximation of the model with either kind
+    of statistics.
+
+    Args:
+        model (models.TDS) : The model, which is put in eval mode.
+        norm_window (int, optional) : The number of frames the statistics of
+            the instance norms are computed over. Defaults to all frames since
+            the start of the stream.
+        norm_stats (dict, optional) : The statistics of the instance norms
+            returned by `norm_statistics`, used instead of those of the
+            frames of the stream.
+    """
+
+    def __init__(self, model, norm_window=None, norm_stats=None):
+        if not isinstance(model, models.TDS):
+            raise ValueError(f"Streaming is not supported for {type(model).__name__}")
+        self.model = model.eval()
+        names = {module: name for name, module in model.named_modules()}
+        if norm_stats is not None:
+            norm_stats = {
+                module: norm_stats[name]
+                for module, name in names.items()
+                if isinstance(module, torch.nn.InstanceNorm1d)
+            }
+        else:
+            norm_stats = {}
+        self.layers = []
+        self.stride = 1
+        self.lookahead = 0
+        for module in model.tds:
+            if isinstance(module, torch.nn.Conv1d):
+                layer = StreamingConv(module)
+            elif isinstance(module, torch.nn.InstanceNorm1d):
+                layer = StreamingInstanceNorm(
+                    module, norm_window, norm_stats.get(module)
+                )
+            elif isinstance(module, models.TDSBlock):
+                layer = StreamingTDSBlock(module, norm_window, norm_stats)
+            elif isinstance(module, torch.nn.ReLU):
+                layer = module
+            else:
+                continue
+            # the lookahead of a layer is in its own input frames:
+            self.lookahead += getattr(layer, "lookahead", 0) * self.stride
+            if isinstance(layer, StreamingConv):
+                self.stride *= layer.stride
+            self.layers.append(layer)
+
+    def reset(self):
+        for layer in self.layers:
+            if not isinstance(layer, torch.nn.Module):
+                layer.reset()
+
+    @torch.no_grad()
+    def __call__(self, inputs, final=False):
+        """
+        Returns the outputs, of shape [B, T', output_size], of the next chunk
+        of inputs of shape [B, H, T]. The last chunk of a stream, which can be
+        empty, is passed with `final=True`, which also resets the state for
+        the next stream.
+        """
+        outputs = inputs
+        for layer in self.layers:
+            if isinstance(layer, torch.nn.Module):
+                outputs = layer(outputs)
+            else:
+                outputs = layer(outputs, final)
+        return self.model.linear(outputs.permute(0, 2, 1))
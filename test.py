@@ -6,12 +6,15 @@ LICENSE file in the root directory of this source tree.
 """
 
 import argparse
-import editdistance
+import collections
+import concurrent.futures
 import json
 import os
+import time
 import torch
 
 import models
+import quantize
 import utils
 
 
@@ -35,6 +38,23 @@ def parse_args():
         action="store_true",
         help="Load the last saved model instead of the best model.",
     )
+    parser.add_argument(
+        "--exported_model",
+        type=str,
+        default=None,
+        help="Use the model saved by `export.py` at this path.",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Use the fused inference only implementation of the TDS models.",
+    )
+    parser.add_argument(
+        "--quantized_model",
+        type=str,
+        default=None,
+        help="Use the int8 model saved by `quantize.py` at this path (CPU only).",
+    )
     parser.add_argument(
         "--split",
         default="validation",
@@ -42,6 +62,25 @@ def parse_args():
         choices=["train", "validation", "test"],
         help="Data split to test on (default: 'validation')",
     )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Only compute the CER and WER, decoding each batch in a thread pool "
+        "while the model runs on the next one, and print only the totals.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of the JSONL file to write the hypothesis and errors of each "
+        "sample to with --fast.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=2,
+        help="Number of processes loading the data with --fast.",
+    )
     args = parser.parse_args()
     return args
 
@@ -70,9 +109,9 @@ def test(args):
         lexicon_path=config["data"].get("lexicon", None),
         use_words=config["data"].get("use_words", False),
         prepend_wordsep=config["data"].get("prepend_wordsep", False),
+        **utils.feature_stats(config["data"]),
     )
     data = dataset.Dataset(data_path, preprocessor, split=args.split)
-    loader = utils.data_loader(data, config)
 
     criterion, output_size = models.load_criterion(
         config.get("criterion_type", "ctc"),
@@ -80,37 +119,146 @@ def test(args):
         config.get("criterion", {}),
     )
     criterion = criterion.to(device)
+    if args.fused and args.quantized_model is not None:
+        raise ValueError("Quantized models can not be fused.")
     model = models.load_model(
-        config["model_type"], input_size, output_size, config["model"]
+        config["model_type"], input_size, output_size, config["model"], args.fused
     ).to(device)
     models.load_from_checkpoint(model, criterion, args.checkpoint_path, args.load_last)
+    if args.exported_model is not None:
+        model = models.load_exported(args.exported_model, device)
+    if args.quantized_model is not None:
+        if device.type != "cpu":
+            raise ValueError("Quantized models only run on CPU, use --disable_cuda.")
+        model = quantize.load_quantized(args.quantized_model, model)
 
     model.eval()
+    if args.fast:
+        fast_test(args, config, data, preprocessor, model, criterion, device)
+        return
+
+    loader = utils.data_loader(data, config)
     meters = utils.Meters()
+    edit_distance = utils.EditDistance(preprocessor)
+    Timer = utils.CudaTimer if device.type == "cuda" else utils.Timer
+    timers = Timer(["model_fwd"])
     for inputs, targets in loader:
+        timers.start("model_fwd")
         outputs = model(inputs.to(device))
+        timers.stop("model_fwd")
         meters.loss += criterion(outputs, targets).item() * len(targets)
         meters.num_samples += len(targets)
         predictions = criterion.viterbi(outputs)
-        for p, t in zip(predictions, targets):
-            p, t = preprocessor.tokens_to_text(p), preprocessor.to_text(t)
-            pw, tw = p.split(preprocessor.wordsep), t.split(preprocessor.wordsep)
-            pw, tw = list(filter(None, pw)), list(filter(None, tw))
-            tokens_dist = editdistance.eval(p, t)
-            words_dist = editdistance.eval(pw, tw)
-            print("CER: {:.3f}".format(tokens_dist * 100.0 / len(t) if len(t) > 0 else 0))
-            print("WER: {:.3f}".format(words_dist * 100.0 / len(tw) if len(tw) > 0 else 0))
-            print("HYP:", "".join(p))
-            print("REF", "".join(t))
+        distances = edit_distance(predictions, targets)
+        for p, t, (tokens_dist, words_dist, n_tokens, n_words) in zip(
+            predictions, targets, distances
+        ):
+            print("CER: {:.3f}".format(tokens_dist * 100.0 / n_tokens if n_tokens > 0 else 0))
+            print("WER: {:.3f}".format(words_dist * 100.0 / n_words if n_words > 0 else 0))
+            print("HYP:", preprocessor.tokens_to_text(p))
+            print("REF", preprocessor.to_text(t))
             print("=" * 80)
             meters.edit_distance_tokens += tokens_dist
             meters.edit_distance_words += words_dist
-            meters.num_tokens += len(t)
-            meters.num_words += len(tw)
+            meters.num_tokens += n_tokens
+            meters.num_words += n_words
+
+    model_time = timers.summary().get("model_fwd", {"mean": 0, "count": 0})
+    model_time = model_time["mean"] * model_time["count"]
+    num_samples = meters.num_samples
+    print(
+        "Loss {:.3f}, CER {:.3f}, WER {:.3f}, "
+        "Model time {:.2f} (ms/sample), {:.2f} samples/sec".format(
+            meters.avg_loss,
+            meters.cer,
+            meters.wer,
+            model_time * 1e3 / num_samples if num_samples > 0 else 0,
+            num_samples / model_time if model_time > 0 else 0,
+        )
+    )
+
+
+@torch.no_grad()
+def fast_test(args, config, data, preprocessor, model, criterion, device):
+    """
+    Computes the CER and WER without the loss. The batches are decoded and
+    scored in a background thread while the model runs on the next batches.
+    The results of each sample are written to `args.output` if it is given
+    and only the totals are printed.
+    """
+    # the samples of the normal path, with the indices of the whole dataset:
+    data = utils.select_samples(data, config)
+    data_indices = getattr(data, "indices", range(len(data)))
+    batches = list(
+        utils.BatchSortedSampler(
+            data, config["optim"]["batch_size"], 0, 1, shuffle=False
+        )
+    )
+    loader = torch.utils.data.DataLoader(
+        data,
+        batch_sampler=batches,
+        collate_fn=utils.padding_collate,
+        num_workers=args.num_workers,
+    )
+    edit_distance = utils.EditDistance(preprocessor)
+
+    def decode(outputs, targets):
+        predictions = criterion.viterbi(outputs)
+        return predictions, edit_distance(predictions, targets)
+
+    meters = utils.Meters()
+    output = open(args.output, "w") if args.output is not None else None
+
+    def write(indices, targets, result):
+        predictions, distances = result.result()
+        meters.num_samples += len(targets)
+        for index, p, t, (tokens_dist, words_dist, n_tokens, n_words) in zip(
+            indices, predictions, targets, distances
+        ):
+            index = int(data_indices[index])
+            meters.edit_distance_tokens += tokens_dist
+            meters.edit_distance_words += words_dist
+            meters.num_tokens += n_tokens
+            meters.num_words += n_words
+            if output is not None:
+                sample = {
+                    "index": index,
+                    "hypothesis": preprocessor.tokens_to_text(p.tolist()),
+                    "reference": preprocessor.to_text(t.tolist()),
+                    "token_errors": tokens_dist,
+                    "num_tokens": n_tokens,
+                    "word_errors": words_dist,
+                    "num_words": n_words,
+                }
+                output.write(json.dumps(sample) + "\n")
 
+    start = time.perf_counter()
+    pending = collections.deque()
+    try:
+        # The criteria are not thread safe so the batches are decoded one at
+        # a time, and the samples of a batch in parallel by the criterion:
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            for indices, (inputs, targets) in zip(batches, loader):
+                outputs = model(inputs.to(device))
+                pending.append(
+                    (indices, targets, executor.submit(decode, outputs, targets))
+                )
+                # bound the number of batches of outputs in memory:
+                if len(pending) > 2:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+    finally:
+        if output is not None:
+            output.close()
+    elapsed = time.perf_counter() - start
     print(
-        "Loss {:.3f}, CER {:.3f}, WER {:.3f}, ".format(
-            meters.avg_loss, meters.cer, meters.wer
+        "CER {:.3f}, WER {:.3f}, {} samples in {:.2f} sec, {:.2f} samples/sec".format(
+            meters.cer,
+            meters.wer,
+            meters.num_samples,
+            elapsed,
+            meters.num_samples / elapsed if elapsed > 0 else 0,
         )
     )
 
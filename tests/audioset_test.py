@@ -0,0 +1,101 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import json
+import os
+import tempfile
+import torch
+import unittest
+from unittest import mock
+
+import utils
+
+try:
+    import torchvision
+
+    audioset = utils.module_from_file(
+        "audioset",
+        os.path.join(os.path.dirname(__file__), "..", "datasets", "audioset.py"),
+    )
+except ImportError:
+    audioset = None
+
+
+def stream(features, audio, chunk_size):
+    outputs = [
+        features(audio[..., i : i + chunk_size])
+        for i in range(0, audio.shape[-1], chunk_size)
+    ]
+    outputs.append(features(audio[..., :0], final=True))
+    return torch.cat(outputs, dim=-1)
+
+
+@unittest.skipIf(audioset is None, "torchaudio is not installed")
+class TestStreamingFeatures(unittest.TestCase):
+    def test_global_stats(self):
+        audio = torch.randn(1, 4000)
+        mean, std = audioset.feature_stats([audio, torch.randn(1, 1000)], 20)
+        transforms = torchvision.transforms.Compose(
+            audioset.feature_transforms(20, 16000, mean, std)
+        )
+        expected = transforms(audio)
+        features = audioset.StreamingFeatures(20, 16000, mean, std)
+        for chunk_size in [1, 100, 160, 399, 4000]:
+            outputs = stream(features, audio, chunk_size)
+            self.assertEqual(outputs.shape, expected.shape)
+            self.assertTrue(outputs.allclose(expected, atol=1e-5))
+
+    def test_dataset_stats(self):
+        # the training features with global stats are those of a stream:
+        audio = torch.randn(1, 4000)
+        mean, std = audioset.feature_stats([audio], 20)
+        with tempfile.TemporaryDirectory() as data_path:
+            with open(os.path.join(data_path, "train.json"), "w") as fid:
+                example = {"audio": "a.wav", "text": "a b", "duration": 0.25}
+                fid.write(json.dumps(example) + "\n")
+            splits = {"train": ["train"]}
+            preprocessor = audioset.Preprocessor(
+                data_path, 20, splits, feature_mean=mean, feature_std=std
+            )
+            with mock.patch.object(
+                audioset.torchaudio, "load", return_value=(audio, 16000)
+            ):
+                dataset = audioset.Dataset(data_path, preprocessor, "train", splits)
+                inputs, _ = dataset[0]
+                file_inputs = audioset.load_file("a.wav", 20, 16000, mean, std)
+        outputs = stream(audioset.StreamingFeatures(20, 16000, mean, std), audio, 160)
+        self.assertTrue(inputs.allclose(outputs, atol=1e-5))
+        self.assertTrue(file_inputs.allclose(outputs, atol=1e-5))
+
+    def test_running_stats(self):
+        audio = torch.randn(1, 3000)
+        transforms = torchvision.transforms.Compose(
+            audioset.feature_transforms(20, 16000)
+        )
+        expected = transforms(audio)
+        log_mels = audioset.mel_spectrogram(20, 16000)(audio).add_(1e-6).log_()
+        features = audioset.StreamingFeatures(20, 16000)
+        for chunk_size in [7, 500]:
+            outputs = stream(features, audio, chunk_size)
+            self.assertEqual(outputs.shape, expected.shape)
+            # the last frame is normalized as the whole audio:
+            self.assertTrue(outputs[..., -1].allclose(expected[..., -1], atol=1e-4))
+            for t in range(1, outputs.shape[-1]):
+                frames = log_mels[..., : t + 1]
+                frame = (log_mels[..., t] - frames.mean()) / (frames.std() + 1e-6)
+                self.assertTrue(outputs[..., t].allclose(frame, atol=1e-4))
+
+        with self.assertRaises(ValueError):
+            features(audio[..., :100], final=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
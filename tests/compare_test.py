@@ -0,0 +1,89 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+sys.path.append("../benchmarks")
+
+import argparse
+import numpy as np
+import unittest
+
+import compare
+
+
+class TestCompare(unittest.TestCase):
+    def runs(self, scale, rng):
+        # three runs of 20 timings with some variance between runs:
+        return [
+            list(scale * (10 + rng.normal()) * (1 + 0.01 * rng.standard_normal(20)))
+            for _ in range(3)
+        ]
+
+    def compare(self, scales):
+        rng = np.random.default_rng(0)
+        baseline = {k: {"runs_ms": self.runs(1.0, rng)} for k in scales}
+        current = {k: {"runs_ms": self.runs(s, rng)} for k, s in scales.items()}
+        return compare.compare(baseline, current, self.args())
+
+    def args(self):
+        return argparse.Namespace(
+            seed=0,
+            statistic="median",
+            confidence=0.95,
+            num_bootstrap=500,
+            tolerance=0.05,
+            min_runs=3,
+        )
+
+    def test_compare(self):
+        self.assertEqual(self.compare({"same": 1.0, "faster": 0.5}), [])
+        regressions = self.compare({"same": 1.0, "slower": 2.0, "faster": 0.5})
+        self.assertEqual(regressions, ["slower"])
+
+    def test_runs(self):
+        # too few runs for the variance between runs are not compared:
+        rng = np.random.default_rng(0)
+        baseline = {"slower": {"runs_ms": self.runs(1.0, rng)[:1]}}
+        current = {"slower": {"runs_ms": self.runs(2.0, rng)}}
+        self.assertEqual(compare.compare(baseline, current, self.args()), [])
+
+    def test_check_metadata(self):
+        baseline = {
+            "device": "cpu",
+            "num_threads": 8,
+            "num_cores": 8,
+            "torch": "1.6.0",
+            "iterations": 10,
+            "hostname": "a",
+        }
+        current = dict(baseline, iterations=20, hostname="b")
+        self.assertEqual(compare.check_metadata(baseline, current), [])
+        mismatches = compare.check_metadata(
+            baseline, dict(current, num_threads=1, iterations=5)
+        )
+        self.assertEqual(len(mismatches), 2)
+        self.assertTrue(mismatches[0].startswith("num_threads"))
+        self.assertTrue(mismatches[1].startswith("iterations"))
+
+    def test_relative_change_ci(self):
+        rng = np.random.default_rng(0)
+        baseline = [[10.0, 10.5, 9.5], [10.2, 9.8, 10.0]]
+        current = [[2 * t for t in run] for run in baseline]
+        base, cur, ratio, low, high = compare.relative_change_ci(
+            baseline, current, "mean", 0.95, 200, rng
+        )
+        self.assertAlmostEqual(base, 10.0)
+        self.assertAlmostEqual(cur, 20.0)
+        self.assertAlmostEqual(ratio, 2.0)
+        self.assertLess(low, 2.0)
+        self.assertGreater(high, 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import os
+import tempfile
+import torch
+import unittest
+
+import export
+import models
+
+
+class TestExport(unittest.TestCase):
+    def test_export(self):
+        configs = [
+            ("tds", {"tds_groups": [{"channels": 2, "num_blocks": 1}], "kernel_size": 3}),
+            (
+                "tds2d",
+                {
+                    "depth": 2,
+                    "tds_groups": [{"channels": 2, "num_blocks": 1, "stride": [2, 1]}],
+                    "kernel_size": [3, 3],
+                },
+            ),
+            (
+                "rnn",
+                {
+                    "cell_type": "gru",
+                    "hidden_size": 8,
+                    "num_layers": 1,
+                    "strides": [[1, 1], [1, 1]],
+                },
+            ),
+        ]
+        inputs = torch.randn(2, 8, 20)
+        for model_type, config in configs:
+            model = models.load_model(model_type, 8, 5, dict(config, dropout=0.5))
+            exported = export.export_model(model)
+            # the model is not modified:
+            self.assertTrue(model.training)
+            model.eval()
+            with torch.no_grad():
+                expected = model(inputs)
+                self.assertTrue(exported(inputs).allclose(expected, atol=1e-5))
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    path = os.path.join(tmpdir, "model.pt")
+                    export.save_exported(exported, path, model_type, 8)
+                    loaded = models.load_exported(path, torch.device("cpu"))
+                    self.assertTrue(loaded(inputs).allclose(expected, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
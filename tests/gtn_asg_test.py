@@ -12,6 +12,7 @@ sys.path.append("..")
 import unittest
 import torch
 import math
+import utils
 from utils import ASGLoss
 from models import ASG
 from torch.autograd import gradcheck
@@ -124,6 +125,54 @@ class TestASGCriterion(unittest.TestCase):
         path = asg.viterbi(inputs)[0].tolist()
         self.assertTrue(path == expected_path)
 
+    def test_fwd_bwd_recompute(self):
+        T = 5
+        N = 4
+        tgt = [[0, 1, 2], [3, 3], [1]]
+        inputs = torch.randn(3, T, N, device=self.device, requires_grad=True)
+        transitions = torch.randn(N + 1, N, device=self.device, requires_grad=True)
+        fwd = ASGLoss(inputs, transitions, tgt, "mean")
+        fwd.backward()
+        grads = inputs.grad, transitions.grad
+        inputs.grad = transitions.grad = None
+
+        graph_memory = utils.GraphMemory(max_mb=0)
+        utils.set_graph_memory(graph_memory)
+        try:
+            fwd_recompute = ASGLoss(inputs, transitions, tgt, "mean")
+            fwd_recompute.backward()
+        finally:
+            utils.set_graph_memory(None)
+        self.assertEqual(graph_memory.num_recomputed, 3)
+        self.assertAlmostEqual(fwd.item(), fwd_recompute.item(), places=5)
+        self.assertTrue(inputs.grad.allclose(grads[0]))
+        self.assertTrue(transitions.grad.allclose(grads[1]))
+
+    def test_fwd_bwd_pt(self):
+        T = 6
+        N = 5
+        # include a repeated label, a target longer than the input and an
+        # empty target:
+        tgt = [[0, 1, 2], [3, 3, 1], [1], [0, 1, 2, 3, 4, 0, 1], []]
+        B = len(tgt)
+        inputs = torch.randn(B, T, N, device=self.device, requires_grad=True)
+        transitions = torch.randn(N + 1, N, device=self.device, requires_grad=True)
+        for reduction in ["none", "mean"]:
+            # the GTN loss is infinite for samples without any alignment:
+            for b in [slice(0, 3), slice(0, B)]:
+                results = []
+                for loss_fn in [ASGLoss, utils.asg_loss]:
+                    loss = loss_fn(inputs[b], transitions, tgt[b], reduction)
+                    loss.backward()
+                    results.append((loss.item(), inputs.grad, transitions.grad))
+                    inputs.grad = transitions.grad = None
+                if b.stop == B:
+                    self.assertEqual(results[0][0], results[1][0])
+                    continue
+                self.assertAlmostEqual(results[0][0], results[1][0], places=4)
+                self.assertTrue(results[0][1].allclose(results[1][1], atol=1e-5))
+                self.assertTrue(results[0][2].allclose(results[1][2], atol=1e-5))
+
     @unittest.skip("Enable when gtn supports retain grad graph.")
     def test_jacobian(self):
         T = 20
@@ -12,6 +12,7 @@ sys.path.append("..")
 import unittest
 import torch
 import math
+import utils
 from utils import CTCLoss
 from torch.autograd import gradcheck
 
@@ -80,6 +81,62 @@ class TestCTCCriterion(unittest.TestCase):
         # fmt: on
         self.assertTrue(log_emissions.grad.allclose(expected_grad))
 
+    def test_fwd_bwd_half(self):
+        T = 5
+        N = 6
+        labels = [[0, 1, 2], [3, 3]]
+        log_probs = torch.randn(2, T, N, device=self.device).log_softmax(2)
+        log_probs_half = log_probs.half().requires_grad_(True)
+        log_probs = log_probs_half.detach().float().requires_grad_(True)
+        fwd = CTCLoss(log_probs, labels, N - 1)
+        fwd_half = CTCLoss(log_probs_half, labels, N - 1)
+        self.assertAlmostEqual(fwd.item(), fwd_half.item(), places=5)
+        fwd.backward()
+        fwd_half.backward()
+        self.assertEqual(log_probs_half.grad.dtype, torch.half)
+        self.assertTrue(
+            log_probs_half.grad.float().allclose(log_probs.grad, atol=1e-3)
+        )
+
+    def test_fwd_bwd_recompute(self):
+        T = 5
+        N = 6
+        labels = [[0, 1, 2], [3, 3], [4]]
+        log_probs = torch.randn(3, T, N, device=self.device).log_softmax(2)
+        log_probs.requires_grad_(True)
+        fwd = CTCLoss(log_probs, labels, N - 1, "mean")
+        fwd.backward()
+        grad = log_probs.grad
+        log_probs.grad = None
+
+        # with no cap the graphs are retained until the backward:
+        graph_memory = utils.GraphMemory()
+        utils.set_graph_memory(graph_memory)
+        try:
+            CTCLoss(log_probs, labels, N - 1, "mean").backward()
+            self.assertGreater(graph_memory.peak_retained, 0)
+            self.assertEqual(graph_memory.retained, 0)
+            self.assertTrue(log_probs.grad.allclose(grad))
+            log_probs.grad = None
+
+            # the graphs of a loss without a backward are released with it:
+            loss = CTCLoss(log_probs, labels, N - 1, "mean")
+            self.assertGreater(graph_memory.retained, 0)
+            del loss
+            self.assertEqual(graph_memory.retained, 0)
+
+            # with a cap of zero the graphs are all recomputed:
+            graph_memory = utils.GraphMemory(max_mb=0)
+            utils.set_graph_memory(graph_memory)
+            fwd_recompute = CTCLoss(log_probs, labels, N - 1, "mean")
+            fwd_recompute.backward()
+        finally:
+            utils.set_graph_memory(None)
+        self.assertEqual(graph_memory.num_recomputed, 3)
+        self.assertEqual(graph_memory.peak_retained, 0)
+        self.assertAlmostEqual(fwd.item(), fwd_recompute.item(), places=5)
+        self.assertTrue(log_probs.grad.allclose(grad))
+
     @unittest.skip("Enable when gtn supports retain grad graph.")
     def test_jacobian(self):
         T = 20
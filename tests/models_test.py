@@ -0,0 +1,77 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import torch
+import unittest
+
+import models
+
+
+class TestFused(unittest.TestCase):
+    def test_fused_blocks(self):
+        block = models.TDSBlock(3, 8, 5, 0.1).eval()
+        fused = models.TDSBlockInference(3, 8, 5, 0.1).eval()
+        fused.load_state_dict(block.state_dict())
+        inputs = torch.randn(2, 24, 7)
+        with torch.no_grad():
+            expected = block(inputs)
+            outputs = fused(inputs.transpose(1, 2).contiguous())
+        self.assertTrue(outputs.transpose(1, 2).allclose(expected, atol=1e-5))
+
+        block = models.TDSBlock2d(3, 2, [3, 5], 0.1).eval()
+        fused = models.TDSBlock2dInference(3, 2, [3, 5], 0.1).eval()
+        fused.load_state_dict(block.state_dict())
+        inputs = torch.randn(2, 6, 4, 7)
+        with torch.no_grad():
+            expected = block(inputs)
+            outputs = fused(inputs.permute(0, 2, 3, 1).contiguous())
+        self.assertTrue(outputs.permute(0, 3, 1, 2).allclose(expected, atol=1e-5))
+
+    def test_fused_models(self):
+        configs = [
+            (
+                "tds",
+                {
+                    "tds_groups": [
+                        {"channels": 2, "num_blocks": 2},
+                        {"channels": 3, "num_blocks": 1, "stride": 1},
+                    ],
+                    "kernel_size": 5,
+                },
+            ),
+            (
+                "tds2d",
+                {
+                    "depth": 2,
+                    "tds_groups": [
+                        {"channels": 2, "num_blocks": 2, "stride": [2, 2]},
+                        {"channels": 3, "num_blocks": 1, "stride": [2, 1]},
+                    ],
+                    "kernel_size": [3, 5],
+                },
+            ),
+        ]
+        for model_type, config in configs:
+            config = dict(config, dropout=0.5)
+            model = models.load_model(model_type, 8, 5, config).eval()
+            fused = models.load_model(model_type, 8, 5, config, fused=True).eval()
+            fused.load_state_dict(model.state_dict())
+            for width in [5, 9, 20]:
+                inputs = torch.randn(3, 8, width)
+                with torch.no_grad():
+                    expected = model(inputs)
+                    outputs = fused(inputs)
+                self.assertEqual(outputs.shape, expected.shape)
+                self.assertTrue(outputs.allclose(expected, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import os
+import tempfile
+import torch
+import unittest
+
+import models
+import quantize
+
+
+class TestQuantize(unittest.TestCase):
+    def test_quantize(self):
+        configs = [
+            ("tds", {"tds_groups": [{"channels": 2, "num_blocks": 1}], "kernel_size": 3}),
+            (
+                "tds2d",
+                {
+                    "depth": 2,
+                    "tds_groups": [{"channels": 2, "num_blocks": 1, "stride": [2, 1]}],
+                    "kernel_size": [3, 3],
+                },
+            ),
+        ]
+        inputs = torch.randn(4, 8, 40)
+        for model_type, config in configs:
+            model = models.load_model(model_type, 8, 5, dict(config, dropout=0.1))
+            model.eval()
+            with torch.no_grad():
+                expected = model(inputs)
+            for calibration_inputs in [None, inputs.split(2)]:
+                quantized = quantize.quantize_model(model, calibration_inputs)
+                with torch.no_grad():
+                    outputs = quantized(inputs)
+                self.assertTrue(outputs.allclose(expected, atol=0.2))
+
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    path = os.path.join(tmpdir, "model.pt")
+                    quantize.save_quantized(
+                        quantized, path, calibration_inputs is not None
+                    )
+                    loaded = quantize.load_quantized(path, model)
+                with torch.no_grad():
+                    self.assertTrue(loaded(inputs).equal(outputs))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import asyncio
+import concurrent.futures
+import threading
+import torch
+import unittest
+
+from serve import Batcher, Server
+
+
+class TestBatcher(unittest.TestCase):
+    def test_batches(self):
+        batches = []
+
+        def run_batch(inputs):
+            batches.append([i.shape[-1] for i in inputs])
+            return [i.shape[-1] for i in inputs]
+
+        async def run(widths, max_batch, max_wait_ms):
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                batcher = Batcher(run_batch, max_batch, max_wait_ms, 100, executor)
+                results = await asyncio.gather(
+                    *(batcher.submit(torch.zeros(1, 2, w)) for w in widths)
+                )
+                return results, batcher.metrics()
+
+        # full batches are run without waiting:
+        widths = [10, 20, 150, 30, 160, 170]
+        results, metrics = asyncio.run(run(widths, 3, 60000))
+        self.assertEqual(results, widths)
+        self.assertEqual(batches, [[10, 20, 30], [150, 160, 170]])
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["latency_ms"]["count"], 6)
+
+        # partial batches of each width are run after the wait:
+        batches.clear()
+        widths = [10, 20, 150, 30, 40, 160]
+        results, metrics = asyncio.run(run(widths, 3, 10))
+        self.assertEqual(results, widths)
+        self.assertEqual(sorted(batches), [[10, 20, 30], [40], [150, 160]])
+        self.assertEqual(metrics["batch_size"]["count"], 3)
+
+
+class TestServer(unittest.TestCase):
+    def test_executors(self):
+        threads = {}
+
+        def load_inputs(fid):
+            threads["load"] = threading.current_thread().name
+            return torch.zeros(1, 2, len(fid.read()))
+
+        def run_batch(inputs):
+            threads["batch"] = threading.current_thread().name
+            return [i.shape[-1] for i in inputs]
+
+        async def run():
+            batch_executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="batch"
+            )
+            load_executor = concurrent.futures.ThreadPoolExecutor(
+                2, thread_name_prefix="load"
+            )
+            with batch_executor, load_executor:
+                batcher = Batcher(run_batch, 1, 10, 100, batch_executor)
+                server = Server(load_inputs, batcher, load_executor)
+                return await server.route("POST", "/transcribe", b"abc")
+
+        # the inputs are loaded outside of the thread running the batches:
+        self.assertEqual(asyncio.run(run()), (200, {"hypothesis": 3}))
+        self.assertTrue(threads["load"].startswith("load"))
+        self.assertTrue(threads["batch"].startswith("batch"))
+
+    def test_errors(self):
+        def load_inputs(fid):
+            data = fid.read()
+            if data == b"":
+                raise ValueError("Empty file")
+            return torch.zeros(1, 2, len(data))
+
+        def run_batch(inputs):
+            raise RuntimeError("Decoder failed")
+
+        async def run():
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                batcher = Batcher(run_batch, 1, 10, 100, executor)
+                server = Server(load_inputs, batcher, executor)
+                statuses = [
+                    (await server.route("POST", "/transcribe", body))[0]
+                    for body in [b"", b"abc"]
+                ]
+                return statuses, (await server.route("GET", "/metrics", b""))[1]
+
+        # bad inputs are client errors, failures of the batch server errors:
+        statuses, metrics = asyncio.run(run())
+        self.assertEqual(statuses, [400, 500])
+        self.assertEqual(metrics["errors"], {"bad_request": 1, "server_error": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import torch
+import unittest
+
+import models
+import streaming
+
+
+def stream(layer, inputs, chunk_size):
+    outputs = [
+        layer(inputs[..., i : i + chunk_size])
+        for i in range(0, inputs.shape[-1], chunk_size)
+    ]
+    outputs.append(layer(inputs[..., :0], final=True))
+    return outputs
+
+
+class TestStreaming(unittest.TestCase):
+    def test_conv(self):
+        inputs = torch.randn(2, 3, 23)
+        for kernel_size, stride in [(5, 2), (3, 1), (4, 2), (1, 1)]:
+            conv = torch.nn.Conv1d(3, 4, kernel_size, stride, kernel_size // 2)
+            expected = conv(inputs)
+            streaming_conv = streaming.StreamingConv(conv)
+            for chunk_size in [1, 2, 7, 23]:
+                outputs = torch.cat(stream(streaming_conv, inputs, chunk_size), dim=2)
+                self.assertEqual(outputs.shape, expected.shape)
+                self.assertTrue(outputs.allclose(expected, atol=1e-6))
+
+    def test_instance_norm(self):
+        norm = torch.nn.InstanceNorm1d(3, affine=True)
+        torch.nn.init.normal_(norm.weight)
+        torch.nn.init.normal_(norm.bias)
+        inputs = torch.randn(2, 3, 20)
+        for window in [None, 1, 4]:
+            streaming_norm = streaming.StreamingInstanceNorm(norm, window)
+            outputs = torch.cat(stream(streaming_norm, inputs, 3), dim=2)
+            for t in range(20):
+                start = 0 if window is None else max(t + 1 - window, 0)
+                frames = inputs[..., start : t + 1]
+                mean = frames.mean(2)
+                std = torch.sqrt(frames.var(2, unbiased=False) + norm.eps)
+                expected = (inputs[..., t] - mean) / std * norm.weight + norm.bias
+                self.assertTrue(outputs[..., t].allclose(expected, atol=1e-5))
+
+    def test_tds(self):
+        config = {
+            "tds_groups": [
+                {"channels": 2, "num_blocks": 2},
+                {"channels": 2, "num_blocks": 1, "stride": 1},
+            ],
+            "kernel_size": 5,
+            "dropout": 0.1,
+        }
+        model = models.load_model("tds", 8, 5, config).eval()
+        inputs = torch.randn(2, 8, 30)
+        expected_length = model(inputs).shape[1]
+        for norm_window in [None, 4]:
+            streaming_model = streaming.StreamingTDS(model, norm_window)
+            self.assertEqual(streaming_model.stride, 2)
+            self.assertEqual(streaming_model.lookahead, 2 + 2 * (2 + 2 + 2 + 2))
+            expected = torch.cat(stream(streaming_model, inputs, 30), dim=1)
+            self.assertEqual(expected.shape[1], expected_length)
+            # the outputs do not depend on the chunks:
+            for chunk_size in [1, 4, 7]:
+                chunks = stream(streaming_model, inputs, chunk_size)
+                outputs = torch.cat(chunks, dim=1)
+                self.assertTrue(outputs.allclose(expected, atol=1e-5))
+                # outputs are emitted as soon as their lookahead is available:
+                num_frames = 0
+                for i, chunk in enumerate(chunks[:-1]):
+                    num_frames += chunk.shape[1]
+                    seen = min((i + 1) * chunk_size, 30)
+                    if seen > streaming_model.lookahead:
+                        self.assertEqual(
+                            num_frames, (seen - streaming_model.lookahead - 1) // 2 + 1
+                        )
+
+    def test_norm_statistics(self):
+        torch.manual_seed(0)
+        config = {
+            "tds_groups": [
+                {"channels": 4, "num_blocks": 2},
+                {"channels": 8, "num_blocks": 2},
+            ],
+            "kernel_size": 5,
+            "dropout": 0.1,
+        }
+        model = models.load_model("tds", 16, 5, config).eval()
+        inputs = torch.randn(1, 16, 200)
+        with torch.no_grad():
+            expected = model(inputs)
+
+        # the statistics of the utterance itself give the outputs of the model:
+        stats = streaming.norm_statistics(model, [inputs])
+        self.assertEqual(len(stats), 2 + 2 * 4)
+        streaming_model = streaming.StreamingTDS(model, norm_stats=stats)
+        for chunk_size in [1, 10, 200]:
+            outputs = torch.cat(stream(streaming_model, inputs, chunk_size), dim=1)
+            self.assertEqual(outputs.shape, expected.shape)
+            self.assertTrue(outputs.allclose(expected, atol=1e-4))
+
+        # the outputs with the statistics of other utterances do not match the
+        # model (a known limitation), they are only closer than with the
+        # running statistics:
+        stats = streaming.norm_statistics(
+            model, [torch.randn(1, 16, 200) for _ in range(20)]
+        )
+        errors = []
+        for streaming_model in [
+            streaming.StreamingTDS(model),
+            streaming.StreamingTDS(model, norm_stats=stats),
+        ]:
+            outputs = torch.cat(stream(streaming_model, inputs, 10), dim=1)
+            errors.append((outputs - expected).abs().mean())
+        self.assertLess(errors[1], errors[0])
+        self.assertFalse(outputs.allclose(expected, atol=1e-2))
+
+    def test_unsupported(self):
+        config = {
+            "depth": 1,
+            "tds_groups": [{"channels": 1, "num_blocks": 0, "stride": [1, 1]}],
+            "kernel_size": [3, 3],
+            "dropout": 0,
+        }
+        with self.assertRaises(ValueError):
+            streaming.StreamingTDS(models.load_model("tds2d", 8, 5, config))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,16 +10,34 @@ import sys
 sys.path.append("..")
 
 import gtn
+import itertools
 import math
 import torch
 import unittest
 
 import transducer
-from transducer import Transducer, make_transitions_graph
+from transducer import (
+    GraphArcs,
+    Transducer,
+    make_alignments_graph,
+    make_transitions_arcs,
+    make_transitions_graph,
+)
+import utils
 from utils import CTCLoss, ASGLossFunction
 from torch.autograd import gradcheck
 
 
+def load_graph_arcs(path):
+    # the nodes and arcs of a graph saved in the text format of `gtn.loadtxt`:
+    with open(path, "r") as fid:
+        lines = [l.split() for l in fid if l.strip()]
+    start, accept = [int(n) for n in lines[0]], [int(n) for n in lines[1]]
+    arcs = [tuple(int(x) for x in l[:3]) for l in lines[2:]]
+    num_nodes = max([n for arc in arcs for n in arc[:2]] + start + accept) + 1
+    return GraphArcs(num_nodes, start, accept, arcs)
+
+
 class TestConvTransducer(unittest.TestCase):
     def test_kernel_graph(self):
         def get_graph(l1, l2, add_skip=False):
@@ -364,6 +382,316 @@ class TestTransducer(unittest.TestCase):
         predictions = transducer.viterbi(emissions)
         self.assertEqual([p.tolist() for p in predictions], labels)
 
+    def test_viterbi_confidences(self):
+        T = 5
+        N = 4
+        # fmt: off
+        emissions = torch.tensor((
+            0, 4, 0, 1,
+            0, 2, 1, 1,
+            0, 0, 0, 2,
+            0, 0, 0, 2,
+            8, 0, 0, 2,
+            ),
+            dtype=torch.float,
+        ).view(1, T, N)
+        # fmt: on
+
+        # Without transitions the posteriors are the softmax of the frames:
+        transducer = Transducer(
+            tokens=["a", "b", "c", "d"],
+            graphemes_to_idx={"a": 0, "b": 1, "c": 2, "d": 3},
+            blank="none",
+        )
+        predictions, confidences = transducer.viterbi(emissions, confidences=True)
+        self.assertEqual(predictions[0].tolist(), [1, 3, 0])
+        posteriors = torch.softmax(emissions[0], dim=1)
+        expected = [posteriors[:2, 1].max(), posteriors[2:4, 3].max(), posteriors[4, 0]]
+        self.assertTrue(torch.allclose(confidences[0], torch.stack(expected)))
+
+        # With transitions they are the gradients of the normalization term:
+        transducer = Transducer(
+            tokens=["a", "b", "c"],
+            graphemes_to_idx={"a": 0, "b": 1, "c": 2},
+            ngram=2,
+            blank="optional",
+            allow_repeats=False,
+        )
+        torch.manual_seed(0)
+        torch.nn.init.normal_(transducer.transition_params, std=0.1)
+        predictions, confidences = transducer.viterbi(emissions, confidences=True)
+        self.assertEqual(predictions[0].tolist(), [1, 0])
+        inputs = emissions.clone().requires_grad_()
+        transducer.normalizer(inputs, transducer.transition_params.detach()).backward()
+        posteriors = inputs.grad[0]
+        expected = [posteriors[:2, 1].max(), posteriors[4, 0]]
+        self.assertTrue(
+            torch.allclose(confidences[0], torch.stack(expected), atol=1e-5)
+        )
+
+    def test_half(self):
+        T, N = 6, 4
+        tokens = [(i,) for i in range(N - 1)]
+        graphemes_to_idx = {i: i for i in range(N - 1)}
+        labels = [[0, 1, 2], [1, 1]]
+        for ngram in [0, 2]:
+            transducer = Transducer(
+                tokens, graphemes_to_idx, ngram=ngram, blank="optional"
+            )
+            inputs_half = torch.randn(2, T, N).half().requires_grad_(True)
+            inputs = inputs_half.detach().float().requires_grad_(True)
+            loss = transducer(inputs, labels)
+            loss_half = transducer(inputs_half, labels)
+            self.assertAlmostEqual(loss.item(), loss_half.item(), delta=1e-2)
+            loss.backward()
+            loss_half.backward()
+            self.assertEqual(inputs_half.grad.dtype, torch.half)
+            self.assertTrue(inputs_half.grad.float().allclose(inputs.grad, atol=1e-2))
+            predictions = transducer.viterbi(inputs)
+            predictions_half = transducer.viterbi(inputs_half.detach())
+            self.assertEqual(
+                [p.tolist() for p in predictions],
+                [p.tolist() for p in predictions_half],
+            )
+
+    def test_recompute(self):
+        T, N = 6, 4
+        tokens = [(i,) for i in range(N - 1)]
+        graphemes_to_idx = {i: i for i in range(N - 1)}
+        labels = [[0, 1, 2], [1, 1], [2]]
+        for ngram in [0, 2]:
+            inputs = torch.randn(3, T, N, requires_grad=True)
+            grads = []
+            losses = []
+            for recompute in [False, True]:
+                torch.manual_seed(0)
+                transducer = Transducer(
+                    tokens,
+                    graphemes_to_idx,
+                    ngram=ngram,
+                    blank="optional",
+                    reduction="mean",
+                    recompute=recompute,
+                    dense_normalizer=False,
+                    dense_bigram=False,
+                )
+                if ngram > 0:
+                    transducer.transition_params.data.normal_()
+                loss = transducer(inputs, labels)
+                loss.backward()
+                losses.append(loss.item())
+                grads.append([p.grad for p in [inputs] + list(transducer.parameters())])
+                inputs.grad = None
+            self.assertAlmostEqual(losses[0], losses[1], places=5)
+            self.assertTrue(grads[0][0].allclose(grads[1][0]))
+            if ngram > 0:
+                self.assertTrue(grads[0][1].allclose(grads[1][1]))
+
+    def test_dense_matches_gtn(self):
+        T, N = 6, 4
+        tokens = [(i,) for i in range(N - 1)]
+        graphemes_to_idx = {i: i for i in range(N - 1)}
+        labels = [[0, 1, 2], [1, 1], [2]]
+        for ngram in [1, 2, 3]:
+            inputs = torch.randn(3, T, N, requires_grad=True)
+            transition_params = torch.randn(
+                make_transitions_graph(ngram, N).num_arcs()
+            )
+            results = []
+            # the default dense loss, GTN, and GTN when recomputing:
+            for dense, recompute in [(True, False), (False, False), (True, True)]:
+                crit = Transducer(
+                    tokens,
+                    graphemes_to_idx,
+                    ngram=ngram,
+                    blank="optional",
+                    reduction="mean",
+                    recompute=recompute,
+                    dense_normalizer=dense,
+                    dense_bigram=dense,
+                )
+                crit.transition_params.data.copy_(transition_params)
+                calls = []
+                bigram_loss = crit._bigram_loss
+
+                def counted_bigram_loss(*args):
+                    calls.append(args)
+                    return bigram_loss(*args)
+
+                crit._bigram_loss = counted_bigram_loss
+                loss = crit(inputs, labels)
+                loss.backward()
+                uses_bigram = dense and not recompute and ngram == 2
+                self.assertEqual(len(calls) > 0, uses_bigram)
+                results.append(
+                    (loss.item(), inputs.grad, crit.transition_params.grad)
+                )
+                inputs.grad = None
+            for result in results[1:]:
+                self.assertAlmostEqual(results[0][0], result[0], places=4)
+                self.assertTrue(results[0][1].allclose(result[1], atol=1e-5))
+                self.assertTrue(results[0][2].allclose(result[2], atol=1e-5))
+
+    def test_dense_normalizer(self):
+        T, N = 6, 4
+        tokens = [(i,) for i in range(N - 1)]
+        graphemes_to_idx = {i: i for i in range(N - 1)}
+        labels = [[0, 1, 2], [1, 1], [2]]
+        for ngram, blank in [(1, "none"), (2, "none"), (2, "optional")]:
+            C = N - 1 + int(blank != "none")
+            inputs = torch.randn(3, T, C, requires_grad=True)
+            transition_params = torch.randn(
+                make_transitions_graph(ngram, C).num_arcs()
+            )
+            results = []
+            for dense in [False, True]:
+                crit = Transducer(
+                    tokens,
+                    graphemes_to_idx,
+                    ngram=ngram,
+                    blank=blank,
+                    reduction="mean",
+                    dense_normalizer=dense,
+                    dense_bigram=False,
+                )
+                self.assertEqual(crit.normalizer is not None, dense)
+                crit.transition_params.data.copy_(transition_params)
+                loss = crit(inputs, labels)
+                loss.backward()
+                results.append(
+                    (loss.item(), inputs.grad, crit.transition_params.grad)
+                )
+                inputs.grad = None
+            self.assertAlmostEqual(results[0][0], results[1][0], places=4)
+            self.assertTrue(results[0][1].allclose(results[1][1], atol=1e-5))
+            self.assertTrue(results[0][2].allclose(results[1][2], atol=1e-5))
+
+        # GTN recomputes the normalization term when the memory is bounded:
+        inputs = torch.randn(3, T, N, requires_grad=True)
+        transition_params = torch.randn(make_transitions_graph(2, N).num_arcs())
+        results = []
+        for recompute, max_mb in [(False, None), (True, None), (False, 0)]:
+            crit = Transducer(
+                tokens,
+                graphemes_to_idx,
+                ngram=2,
+                blank="optional",
+                recompute=recompute,
+                dense_bigram=False,
+            )
+            crit.transition_params.data.copy_(transition_params)
+            dense = crit.normalizer
+            calls = []
+            crit.normalizer = lambda *args: calls.append(args) or dense(*args)
+            graph_memory = utils.GraphMemory(max_mb)
+            utils.set_graph_memory(graph_memory)
+            try:
+                loss = crit(inputs, labels)
+                loss.backward()
+            finally:
+                utils.set_graph_memory(None)
+            self.assertEqual(len(calls) > 0, not recompute and max_mb is None)
+            if max_mb is not None:
+                self.assertEqual(graph_memory.num_recomputed, len(labels))
+            results.append((loss.item(), inputs.grad, crit.transition_params.grad))
+            inputs.grad = None
+        for result in results[1:]:
+            self.assertAlmostEqual(results[0][0], result[0], places=4)
+            self.assertTrue(results[0][1].allclose(result[1], atol=1e-5))
+            self.assertTrue(results[0][2].allclose(result[2], atol=1e-5))
+
+        # back-off transitions have epsilon arcs between states:
+        transitions = gtn.loadtxt("trans_backoff_test.txt")
+        normalizer = transducer.DenseNormalizer(
+            load_graph_arcs("trans_backoff_test.txt")
+        )
+        emissions = torch.randn(2, T, 6)
+        weights = torch.randn(transitions.num_arcs())
+        transitions.set_weights(weights.data_ptr())
+        for b in range(2):
+            g_emissions = gtn.linear_graph(T, 6)
+            g_emissions.set_weights(emissions[b].contiguous().data_ptr())
+            expected = gtn.forward_score(gtn.intersect(g_emissions, transitions))
+            self.assertAlmostEqual(
+                normalizer(emissions, weights)[b].item(), expected.item(), places=4
+            )
+
+    def test_dense_bigram(self):
+        T, N = 6, 4
+        tokens = [(i,) for i in range(N - 1)]
+        graphemes_to_idx = {i: i for i in range(N - 1)}
+        labels = [[0, 1, 2], [1, 1], [2], []]
+        for ngram, blank in [
+            (1, "none"),
+            (1, "optional"),
+            (2, "none"),
+            (2, "optional"),
+            (2, "forced"),
+        ]:
+            C = N - 1 + int(blank != "none")
+            inputs = torch.randn(len(labels), T, C, requires_grad=True)
+            transition_params = torch.randn(
+                make_transitions_graph(ngram, C).num_arcs()
+            )
+            results = []
+            for dense in [False, True]:
+                crit = Transducer(
+                    tokens,
+                    graphemes_to_idx,
+                    ngram=ngram,
+                    blank=blank,
+                    reduction="mean",
+                    dense_normalizer=False,
+                    dense_bigram=dense,
+                )
+                self.assertEqual(crit.bigram is not None, dense)
+                crit.transition_params.data.copy_(transition_params)
+                loss = crit(inputs, labels)
+                if dense:
+                    self.assertAlmostEqual(
+                        crit._bigram_loss(inputs, labels).item(), loss.item(), places=4
+                    )
+                loss.backward()
+                results.append(
+                    (loss.item(), inputs.grad, crit.transition_params.grad)
+                )
+                inputs.grad = None
+            self.assertAlmostEqual(results[0][0], results[1][0], places=4)
+            self.assertTrue(results[0][1].allclose(results[1][1], atol=1e-5))
+            self.assertTrue(results[0][2].allclose(results[1][2], atol=1e-5))
+
+        # higher order models fall back to GTN:
+        with self.assertRaises(ValueError):
+            transducer.DenseBigram(make_transitions_arcs(3, N))
+
+    def test_alignments_arcs(self):
+        T = 8
+        tokens = ["a", "b", "c", "ab", "ca"]
+        graphemes_to_idx = {"a": 0, "b": 1, "c": 2}
+        labels = [[0, 1, 2], [0, 1, 1], [2, 0, 1, 0], [2], []]
+        for blank, allow_repeats in [
+            ("none", True),
+            ("optional", True),
+            ("forced", True),
+            ("optional", False),
+        ]:
+            crit = Transducer(
+                tokens, graphemes_to_idx, blank=blank, allow_repeats=allow_repeats
+            )
+            C = len(tokens) + int(blank != "none")
+            for label in labels:
+                # the alignments have the same paths as those built with GTN:
+                arcs = crit._alignments_arcs(label)
+                expected = make_alignments_graph(label, crit.tokens, crit.lexicon)
+                emissions = gtn.linear_graph(T, C)
+                weights = torch.randn(T, C)
+                emissions.set_weights(weights.data_ptr())
+                score = gtn.forward_score(
+                    gtn.intersect(emissions, transducer.make_graph(arcs))
+                )
+                expected = gtn.forward_score(gtn.intersect(emissions, expected))
+                self.assertAlmostEqual(score.item(), expected.item(), places=4)
+
     def test_transitions(self):
         num_tokens = 4
 
@@ -565,6 +893,108 @@ class TestTransducer(unittest.TestCase):
             torch.allclose(analytic_grad, numerical_grad, rtol=1e-3, atol=1e-3)
         )
 
+    def test_lattice(self):
+        T = 5
+        N = 4
+        torch.manual_seed(0)
+        inputs = torch.randn(2, T, N)
+        tokens = [(n,) for n in range(N - 1)]
+        graphemes_to_idx = {n: n for n in range(N - 1)}
+        for ngram in [0, 1, 2]:
+            transducer = Transducer(
+                tokens=tokens,
+                graphemes_to_idx=graphemes_to_idx,
+                ngram=ngram,
+                blank="optional",
+                allow_repeats=False,
+            )
+            if ngram > 0:
+                torch.nn.init.normal_(transducer.transition_params)
+                transitions = transducer.transitions
+                transitions.set_weights(transducer.transition_params.data_ptr())
+                emissions = inputs
+            else:
+                emissions = torch.nn.functional.log_softmax(inputs, dim=2)
+            lattices = transducer.lattice(inputs, beam=0)
+            full_lattices = transducer.lattice(inputs, beam=math.inf)
+            for b in range(2):
+                graph = gtn.linear_graph(T, N, False)
+                graph.set_weights(emissions[b].contiguous().data_ptr())
+                if ngram > 0:
+                    graph = gtn.intersect(graph, transitions)
+                graph = gtn.project_output(gtn.compose(graph, transducer.tokens))
+                best = gtn.viterbi_score(graph).item()
+                self.assertAlmostEqual(
+                    gtn.viterbi_score(lattices[b]).item(), best, places=4
+                )
+                self.assertAlmostEqual(
+                    gtn.viterbi_score(full_lattices[b]).item(), best, places=4
+                )
+                # without pruning the lattice has all the alignments:
+                self.assertAlmostEqual(
+                    gtn.forward_score(full_lattices[b]).item(),
+                    gtn.forward_score(graph).item(),
+                    places=4,
+                )
+                self.assertLess(lattices[b].num_arcs(), full_lattices[b].num_arcs())
+
+        # the lattice scorer is built once without a dense normalizer:
+        transducer = Transducer(
+            tokens=tokens,
+            graphemes_to_idx=graphemes_to_idx,
+            ngram=2,
+            blank="optional",
+            allow_repeats=False,
+            dense_normalizer=False,
+        )
+        transducer.lattice(inputs)
+        scorer = transducer._dense_transitions(N)[0]
+        transducer.lattice(inputs)
+        self.assertIs(transducer._dense_transitions(N)[0], scorer)
+
+    def test_nbest(self):
+        T = 4
+        N = 3
+        torch.manual_seed(0)
+        inputs = torch.randn(2, T, N)
+        transducer = Transducer(
+            tokens=["a", "b"],
+            graphemes_to_idx={"a": 0, "b": 1},
+            ngram=1,
+            blank="optional",
+            allow_repeats=False,
+        )
+        torch.nn.init.normal_(transducer.transition_params)
+        transitions = transducer.transitions
+        transitions.set_weights(transducer.transition_params.data_ptr())
+        hypotheses = transducer.nbest(inputs, 5, beam=math.inf)
+        predictions = transducer.viterbi(inputs)
+        for b in range(2):
+            emissions = gtn.linear_graph(T, N, False)
+            emissions.set_weights(inputs[b].contiguous().data_ptr())
+            graph = gtn.intersect(emissions, transitions)
+            # score every token sequence which fits in the frames:
+            expected = []
+            for length in range(T + 1):
+                for target in itertools.product(range(2), repeat=length):
+                    alignments = make_alignments_graph(
+                        list(target), transducer.tokens, transducer.lexicon
+                    )
+                    score = gtn.viterbi_score(gtn.intersect(graph, alignments)).item()
+                    expected.append((score, list(target)))
+            expected.sort(reverse=True)
+            self.assertEqual(len(hypotheses[b]), 5)
+            self.assertEqual(hypotheses[b][0][0].tolist(), predictions[b].tolist())
+            for (tokens, score), (expected_score, target) in zip(
+                hypotheses[b], expected
+            ):
+                self.assertEqual(tokens.tolist(), target)
+                self.assertAlmostEqual(score, expected_score, places=4)
+
+        # a narrow beam keeps fewer hypotheses:
+        hypotheses = transducer.nbest(inputs, 5, beam=0)
+        self.assertEqual([len(h) for h in hypotheses], [1, 1])
+
 
 if __name__ == "__main__":
     unittest.main()
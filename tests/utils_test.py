@@ -9,6 +9,13 @@ import sys
 
 sys.path.append("..")
 
+import editdistance
+import gtn
+import json
+import os
+import tempfile
+import time
+import torch
 import unittest
 import utils
 
@@ -35,5 +42,207 @@ class UnpackReplabel(unittest.TestCase):
         self.assertEqual(unrep2, [0, 0, 0, 1, 1, 1, 2, 2, 2, 2, 3, 4, 4])
 
 
+class TestEditDistance(unittest.TestCase):
+    class Preprocessor:
+        def __init__(self, tokens, lexicon):
+            self.wordsep = "_"
+            self.graphemes = ["_", "a", "b", "c"]
+            self.tokens = tokens
+            self.lexicon = lexicon
+
+        def to_text(self, indices):
+            encoding = self.graphemes if self.lexicon is None else self.tokens
+            return "".join(encoding[i] for i in indices).strip(self.wordsep)
+
+        def tokens_to_text(self, indices):
+            return "".join(self.tokens[i] for i in indices).strip(self.wordsep)
+
+    def reference(self, preprocessor, p, t):
+        p, t = preprocessor.tokens_to_text(p), preprocessor.to_text(t)
+        pw, tw = p.split(preprocessor.wordsep), t.split(preprocessor.wordsep)
+        pw, tw = list(filter(None, pw)), list(filter(None, tw))
+        return (editdistance.eval(p, t), editdistance.eval(pw, tw), len(t), len(tw))
+
+    def test_graphemes(self):
+        preprocessor = self.Preprocessor(["_", "a", "b", "c"], None)
+        edit_distance = utils.EditDistance(preprocessor)
+        predictions = [
+            torch.IntTensor([0, 1, 2, 0, 0, 3, 0]),
+            torch.IntTensor([]),
+            torch.IntTensor([1, 1, 0, 2]),
+        ]
+        targets = [
+            torch.LongTensor([1, 2, 0, 3]),
+            torch.LongTensor([3, 0, 1]),
+            torch.LongTensor([]),
+        ]
+        expected = [self.reference(preprocessor, p, t) for p, t in zip(predictions, targets)]
+        self.assertEqual(edit_distance(predictions, targets), expected)
+
+    def test_word_pieces(self):
+        tokens = ["_a", "b", "_ab", "c_", "a"]
+        for lexicon in [None, {"ab": ["_ab"]}]:
+            preprocessor = self.Preprocessor(tokens, lexicon)
+            edit_distance = utils.EditDistance(preprocessor)
+            predictions = [torch.IntTensor([2, 3, 0, 1]), torch.IntTensor([4, 4, 3])]
+            targets = [torch.LongTensor([1, 2, 0, 3, 1]), torch.LongTensor([0, 2, 3])]
+            expected = [
+                self.reference(preprocessor, p, t) for p, t in zip(predictions, targets)
+            ]
+            self.assertEqual(edit_distance(predictions, targets), expected)
+
+
+class TestVocabulary(unittest.TestCase):
+    def test_save_load(self):
+        preprocessor = TestEditDistance.Preprocessor(["_a", "b", "_ab", "c_"], None)
+        vocabulary = utils.Vocabulary.from_preprocessor(preprocessor)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vocabulary.save(tmpdir)
+            loaded = utils.Vocabulary.load(tmpdir)
+        self.assertEqual(loaded.tokens, preprocessor.tokens)
+        self.assertEqual(loaded.num_tokens, 4)
+        self.assertEqual(loaded.graphemes_to_index, {"_": 0, "a": 1, "b": 2, "c": 3})
+        for indices in [[0, 1, 3], [2, 3, 0], []]:
+            self.assertEqual(
+                loaded.tokens_to_text(indices), preprocessor.tokens_to_text(indices)
+            )
+
+    def test_word_confidences(self):
+        preprocessor = TestEditDistance.Preprocessor(["_a", "b", "_ab", "c_"], None)
+        vocabulary = utils.Vocabulary.from_preprocessor(preprocessor)
+        words = vocabulary.word_confidences([0, 1, 3, 2, 3], [0.5, 0.8, 0.9, 0.6, 1.0])
+        self.assertEqual([w for w, _ in words], ["abc", "abc"])
+        self.assertAlmostEqual(words[0][1], 0.5 * 0.8 * 0.9)
+        self.assertAlmostEqual(words[1][1], 0.6 * 1.0)
+        self.assertEqual(vocabulary.word_confidences([], []), [])
+
+
+class TestParallelFor(unittest.TestCase):
+    def test_num_threads(self):
+        for num_threads in [None, 1, 3, 16]:
+            utils.set_gtn_num_threads(num_threads)
+            outputs = [None] * 10
+
+            def process(b):
+                outputs[b] = b * b
+
+            utils.parallel_for(process, range(10))
+            self.assertEqual(outputs, [b * b for b in range(10)])
+        utils.set_gtn_num_threads(None)
+
+
+class TestFeatureStats(unittest.TestCase):
+    def test_feature_stats(self):
+        self.assertEqual(utils.feature_stats({"num_features": 80}), {})
+        data_config = {"num_features": 80, "feature_mean": -6.0, "feature_std": 4.0}
+        self.assertEqual(
+            utils.feature_stats(data_config),
+            {"feature_mean": -6.0, "feature_std": 4.0},
+        )
+
+
+class TestSelectSamples(unittest.TestCase):
+    def test_select_samples(self):
+        dataset = list(range(100))
+        config = {"data": {"num_samples": 10}, "seed": 0}
+        subset = list(utils.select_samples(dataset, config))
+        self.assertEqual(len(subset), 10)
+        # the subset does not depend on the state of the global generator:
+        torch.randperm(200)
+        self.assertEqual(list(utils.select_samples(dataset, config)), subset)
+        self.assertIs(utils.select_samples(dataset, {"data": {}}), dataset)
+
+
+class TestThreadBudgets(unittest.TestCase):
+    def test_partition(self):
+        cores = sorted(os.sched_getaffinity(0))
+        budgets = utils.make_thread_budgets(1)
+        self.assertEqual(budgets[0].cores, cores)
+        self.assertEqual(budgets[0].torch_threads, len(cores))
+        self.assertEqual(budgets[0].gtn_threads, len(cores))
+
+        # a single rank shares all of its cores:
+        budgets = utils.make_thread_budgets(1, cores_per_rank=8)
+        self.assertEqual(budgets[0].torch_threads, 8)
+        self.assertEqual(budgets[0].gtn_threads, 8)
+
+        # several ranks split their cores:
+        budgets = utils.make_thread_budgets(2, cores_per_rank=8)
+        for b in budgets:
+            self.assertEqual(b.torch_threads, 4)
+            self.assertEqual(b.gtn_threads, 4)
+
+        # an explicit count leaves the rest of the cores to the other:
+        budgets = utils.make_thread_budgets(1, cores_per_rank=8, torch_threads=6)
+        self.assertEqual(budgets[0].gtn_threads, 2)
+        budgets = utils.make_thread_budgets(1, cores_per_rank=8, gtn_threads=2)
+        self.assertEqual(budgets[0].torch_threads, 6)
+
+        world_size = max(len(cores) // 2, 1)
+        budgets = utils.make_thread_budgets(world_size, gtn_threads=3)
+        self.assertEqual(len(budgets), world_size)
+        rank_cores = [c for b in budgets for c in b.cores]
+        self.assertEqual(len(set(rank_cores)), len(rank_cores))
+        for b in budgets:
+            self.assertEqual(b.torch_threads, max(len(b.cores) - 3, 1))
+            self.assertEqual(b.gtn_threads, 3)
+
+
+class TestTimer(unittest.TestCase):
+    def test_accumulate(self):
+        timer = utils.Timer(["a", "b"])
+        for _ in range(2):
+            timer.start("a")
+            time.sleep(0.01)
+            timer.stop("a")
+        self.assertGreaterEqual(timer.total_time["a"], 0.02)
+        self.assertGreaterEqual(timer.summary()["a"]["mean"], 0.01)
+        self.assertRaises(ValueError, timer.value)
+        self.assertEqual(list(timer.summary().keys()), ["a"])
+
+    def test_reservoir(self):
+        timer = utils.Timer(["a"], reservoir_size=100)
+        for i in range(10000):
+            timer._add("a", i)
+        summary = timer.summary()["a"]
+        self.assertEqual(len(timer.reservoirs["a"]), 100)
+        self.assertEqual(summary["count"], 10000)
+        self.assertEqual(summary["mean"], 4999.5)
+        self.assertAlmostEqual(summary["p50"], 5000, delta=1500)
+        self.assertAlmostEqual(summary["p95"], 9500, delta=1000)
+
+        timer.reset()
+        self.assertEqual(timer.summary(), {})
+
+
+class TestGTNProfiler(unittest.TestCase):
+    def test_summary(self):
+        intersect = gtn.intersect
+        graphs = [gtn.linear_graph(4, 3) for _ in range(8)]
+
+        def process(b):
+            gtn.forward_score(gtn.intersect(graphs[b], graphs[b]))
+
+        with utils.GTNProfiler(trace=True) as profiler:
+            self.assertIsNot(gtn.intersect, intersect)
+            utils.parallel_for(process, range(8))
+            summary = profiler.summary()
+            with tempfile.TemporaryDirectory() as tmpdir:
+                trace_path = os.path.join(tmpdir, "trace.json")
+                profiler.save_trace(trace_path)
+                with open(trace_path, "r") as fid:
+                    events = json.load(fid)["traceEvents"]
+        self.assertIs(gtn.intersect, intersect)
+
+        self.assertEqual(set(summary.keys()), {"intersect", "forward_score"})
+        self.assertEqual(summary["intersect"]["calls"], 8)
+        self.assertEqual(summary["intersect"]["nodes_in"], 10)
+        self.assertEqual(summary["intersect"]["arcs_in"], 24)
+        self.assertEqual(summary["intersect"]["arcs_out"], 12)
+        self.assertEqual(summary["forward_score"]["arcs_out"], 1)
+        self.assertEqual(len(events), 16)
+        self.assertEqual(profiler.summary(), {})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -6,7 +6,7 @@ LICENSE file in the root directory of this source tree.
 """
 
 import argparse
-import editdistance
+import contextlib
 import itertools
 import json
 import logging
@@ -19,7 +19,7 @@ import models
 import utils
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description="Train a handwriting recognition model."
     )
@@ -47,15 +47,72 @@ def parse_args():
         "the IP address and open port number of the master node",
     )
     parser.add_argument(
-        "--dist_backend", default="nccl", type=str, help="distributed backend"
+        "--dist_backend",
+        default=None,
+        type=str,
+        help="distributed backend (default: 'nccl' for GPU and 'gloo' for CPU)",
+    )
+    parser.add_argument(
+        "--cores_per_rank",
+        default=None,
+        type=int,
+        help="Number of cores for each rank (default: split all cores evenly)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        default=None,
+        type=int,
+        help="Number of torch intra-op threads per rank (default: all the cores of "
+        "the rank, or half of them with more than one rank)",
+    )
+    parser.add_argument(
+        "--gtn_threads",
+        default=None,
+        type=int,
+        help="Number of GTN threads per rank (default: all the cores of the rank, or "
+        "the other half of them with more than one rank)",
+    )
+    parser.add_argument(
+        "--no_pin_cores",
+        action="store_true",
+        help="Do not pin each rank to its cores, even if the config asks for it",
+    )
+    parser.add_argument(
+        "--profile_gtn",
+        action="store_true",
+        help="Log the time and graph sizes of the GTN operations of each step",
+    )
+    parser.add_argument(
+        "--gtn_trace",
+        default=None,
+        type=str,
+        help="Save the GTN operations to this Chrome trace file (implies --profile_gtn)",
+    )
+    parser.add_argument(
+        "--profile_memory",
+        action="store_true",
+        help="Log the memory of the graphs retained by the criterion and the peak RSS of each step",
+    )
+    parser.add_argument(
+        "--max_graph_mb",
+        default=None,
+        type=float,
+        help="Cap on the memory of the graphs retained by the criterion for the "
+        "backward, graphs over the cap are recomputed in the backward",
+    )
+    parser.add_argument(
+        "--log_interval",
+        default=0,
+        type=int,
+        help="Log the timing info every this many steps (default: each epoch only)",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     logging.basicConfig(level=logging.INFO)
 
     use_cpu = args.disable_cuda or not torch.cuda.is_available()
-    if args.world_size > 1 and use_cpu:
-        logging.fatal("CPU distributed training not supported.")
-        sys.exit(1)
+    args.disable_cuda = use_cpu
+    if args.dist_backend is None:
+        args.dist_backend = "gloo" if use_cpu else "nccl"
 
     logging.info("World size is : " + str(args.world_size))
     logging.info(f"Restoring model from epoch {args.last_epoch}")
@@ -71,40 +128,34 @@ def parse_args():
     return args
 
 
-def compute_edit_distance(predictions, targets, preprocessor):
-    tokens_dist = 0
-    words_dist = 0
-    n_tokens = 0
-    n_words = 0
-    for p, t in zip(predictions, targets):
-        p, t = preprocessor.tokens_to_text(p), preprocessor.to_text(t)
-        pw, tw = p.split(preprocessor.wordsep), t.split(preprocessor.wordsep)
-        pw, tw = list(filter(None, pw)), list(filter(None, tw))
-        tokens_dist += editdistance.eval(p, t)
-        words_dist += editdistance.eval(pw, tw)
-        n_tokens += len(t)
-        n_words += len(tw)
+def compute_edit_distance(predictions, targets, edit_distance):
+    distances = edit_distance(predictions, targets)
+    tokens_dist = sum(d[0] for d in distances)
+    words_dist = sum(d[1] for d in distances)
+    n_tokens = sum(d[2] for d in distances)
+    n_words = sum(d[3] for d in distances)
     return tokens_dist, words_dist, n_tokens, n_words
 
 
 @torch.no_grad()
-def test(model, criterion, data_loader, preprocessor, device, world_size):
+def test(model, criterion, data_loader, edit_distance, device, world_size, amp=False):
     model.eval()
     criterion.eval()
     meters = utils.Meters()
     for inputs, targets in data_loader:
-        outputs = model(inputs.to(device))
+        with torch.cuda.amp.autocast(enabled=amp):
+            outputs = model(inputs.to(device))
         meters.loss += criterion(outputs, targets).item() * len(targets)
         meters.num_samples += len(targets)
         tokens_dist, words_dist, n_tokens, n_words = compute_edit_distance(
-            criterion.viterbi(outputs), targets, preprocessor
+            criterion.viterbi(outputs), targets, edit_distance
         )
         meters.edit_distance_tokens += tokens_dist
         meters.num_tokens += n_tokens
         meters.edit_distance_words += words_dist
         meters.num_words += n_words
     if world_size > 1:
-        meters.sync()
+        meters.sync(device)
     return meters.avg_loss, meters.cer, meters.wer
 
 
@@ -147,6 +198,21 @@ def train(world_rank, args):
     else:
         device = torch.device("cpu")
 
+    # setup the thread budget of each rank:
+    thread_config = dict(config.get("threads", {}))
+    for key in ["cores_per_rank", "torch_threads", "gtn_threads"]:
+        if getattr(args, key) is not None:
+            thread_config[key] = getattr(args, key)
+    pin_cores = thread_config.pop("pin_cores", None)
+    if pin_cores is None:
+        # only pin the ranks of distributed CPU training by default:
+        pin_cores = args.world_size > 1 and args.disable_cuda
+    pin_cores = pin_cores and not args.no_pin_cores
+    budgets = utils.make_thread_budgets(args.world_size, **thread_config)
+    for rank, budget in enumerate(budgets):
+        logging.info(f"Rank {rank} thread budget: {budget}")
+    budgets[world_rank].apply(pin_cores)
+
     # seed everything:
     seed = config.get("seed", None)
     if seed is not None:
@@ -168,7 +234,12 @@ def train(world_rank, args):
         lexicon_path=config["data"].get("lexicon", None),
         use_words=config["data"].get("use_words", False),
         prepend_wordsep=config["data"].get("prepend_wordsep", False),
+        **utils.feature_stats(config["data"]),
     )
+    if world_rank == 0:
+        # save the vocabulary to decode with the checkpoints:
+        utils.Vocabulary.from_preprocessor(preprocessor).save(args.checkpoint_path)
+    edit_distance = utils.EditDistance(preprocessor)
     trainset = dataset.Dataset(data_path, preprocessor, split="train", augment=True)
     valset = dataset.Dataset(data_path, preprocessor, split="validation")
     train_loader = utils.data_loader(trainset, config, world_rank, args.world_size)
@@ -198,19 +269,31 @@ def train(world_rank, args):
     base_model = model
     base_criterion = criterion  # `decode` cannot be called on DDP module
     if is_distributed_train:
+        device_ids = [world_rank] if device.type == "cuda" else None
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[world_rank]
+            model, device_ids=device_ids
         )
 
         if len(list(criterion.parameters())) > 0:
             criterion = torch.nn.parallel.DistributedDataParallel(
-                criterion, device_ids=[world_rank]
+                criterion, device_ids=device_ids
             )
 
     epochs = config["optim"]["epochs"]
     lr = config["optim"]["learning_rate"]
     step_size = config["optim"]["step_size"]
     max_grad_norm = config["optim"].get("max_grad_norm", None)
+    # number of batches to accumulate gradients over for each update:
+    accumulate_steps = config["optim"].get("accumulate_steps", 1)
+    logging.info(
+        "Effective batch size is {}".format(
+            config["optim"]["batch_size"] * accumulate_steps
+        )
+    )
+    amp = config["optim"].get("amp", False)
+    if amp and device.type != "cuda":
+        logging.warning("Mixed precision training requires CUDA, disabling it.")
+        amp = False
 
     # run training:
     logging.info("Starting training ...")
@@ -226,6 +309,9 @@ def train(world_rank, args):
         params.append(crit_params)
 
     optimizer = torch.optim.SGD(params)
+    # The criteria upcast the (possibly half precision) model outputs and
+    # return gradients in the dtype of the outputs:
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
     scheduler = torch.optim.lr_scheduler.StepLR(
         optimizer, step_size=step_size, gamma=0.5,
         last_epoch=args.last_epoch,
@@ -247,7 +333,18 @@ def train(world_rank, args):
             "test_total",  # total testing
         ]
     )
+    profiler = None
+    if args.profile_gtn or args.gtn_trace is not None:
+        profiler = utils.GTNProfiler(trace=args.gtn_trace is not None).enable()
+        gtn_trace = args.gtn_trace
+        if gtn_trace is not None and args.world_size > 1:
+            gtn_trace += f".{world_rank}"
+    graph_memory = None
+    if args.profile_memory or args.max_graph_mb is not None:
+        graph_memory = utils.GraphMemory(args.max_graph_mb)
+        utils.set_graph_memory(graph_memory)
     num_updates = 0
+    stats = None
     for epoch in range(args.last_epoch, epochs):
         logging.info("Epoch {} started. ".format(epoch + 1))
         model.train()
@@ -255,38 +352,67 @@ def train(world_rank, args):
         start_time = time.time()
         meters = utils.Meters()
         timers.reset()
+        num_batches = len(train_loader)
+        optimizer.zero_grad()
         timers.start("train_total").start("ds_fetch")
-        for inputs, targets in train_loader:
+        for step, (inputs, targets) in enumerate(train_loader):
             timers.stop("ds_fetch").start("model_fwd")
-            optimizer.zero_grad()
-            outputs = model(inputs.to(device))
-            timers.stop("model_fwd").start("crit_fwd")
-            loss = criterion(outputs, targets)
-            timers.stop("crit_fwd").start("bwd")
-            loss.backward()
+            # the last update of an epoch may accumulate fewer batches:
+            group_start = step - step % accumulate_steps
+            group_size = min(accumulate_steps, num_batches - group_start)
+            is_update = step + 1 == group_start + group_size
+            with contextlib.ExitStack() as stack:
+                if is_distributed_train and not is_update:
+                    # skip the gradient all-reduce until the update:
+                    for module in [model, criterion]:
+                        if hasattr(module, "no_sync"):
+                            stack.enter_context(module.no_sync())
+                with torch.cuda.amp.autocast(enabled=amp):
+                    outputs = model(inputs.to(device))
+                timers.stop("model_fwd").start("crit_fwd")
+                loss = criterion(outputs, targets)
+                timers.stop("crit_fwd").start("bwd")
+                scaler.scale(loss / group_size).backward()
             timers.stop("bwd").start("optim")
-            if max_grad_norm is not None:
-                torch.nn.utils.clip_grad_norm_(
-                    itertools.chain(model.parameters(), criterion.parameters()),
-                    max_grad_norm,
-                )
-            optimizer.step()
-            num_updates += 1
+            if is_update:
+                if max_grad_norm is not None:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(
+                        itertools.chain(model.parameters(), criterion.parameters()),
+                        max_grad_norm,
+                    )
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                num_updates += 1
             timers.stop("optim").start("metrics")
             meters.loss += loss.item() * len(targets)
             meters.num_samples += len(targets)
             tokens_dist, words_dist, n_tokens, n_words = compute_edit_distance(
-                base_criterion.viterbi(outputs), targets, preprocessor
+                base_criterion.viterbi(outputs), targets, edit_distance
             )
             meters.edit_distance_tokens += tokens_dist
             meters.num_tokens += n_tokens
             meters.edit_distance_words += words_dist
             meters.num_words += n_words
-            timers.stop("metrics").start("ds_fetch")
+            if profiler is not None:
+                logging.info(
+                    f"Step {step + 1} GTN ops: "
+                    + profiler.format_summary(profiler.summary())
+                )
+            if args.profile_memory:
+                logging.info(
+                    f"Step {step + 1} memory: "
+                    + graph_memory.format_summary(graph_memory.summary())
+                )
+            timers.stop("metrics")
+            if args.log_interval > 0 and (step + 1) % args.log_interval == 0:
+                logging.info(f"Step {step + 1} Timing Info: " + timers.format_summary())
+            timers.start("ds_fetch")
         timers.stop("ds_fetch").stop("train_total")
         epoch_time = time.time() - start_time
         if args.world_size > 1:
-            meters.sync()
+            meters.sync(device)
         logging.info(
             "Epoch {} complete. "
             "nUpdates {}, Loss {:.3f}, CER {:.3f}, WER {:.3f},"
@@ -303,9 +429,19 @@ def train(world_rank, args):
         logging.info("Evaluating validation set..")
         timers.start("test_total")
         val_loss, val_cer, val_wer = test(
-            model, base_criterion, val_loader, preprocessor, device, args.world_size
+            model,
+            base_criterion,
+            val_loader,
+            edit_distance,
+            device,
+            args.world_size,
+            amp,
         )
         timers.stop("test_total")
+        if profiler is not None:
+            logging.info(
+                "Validation GTN ops: " + profiler.format_summary(profiler.summary())
+            )
         if world_rank == 0:
             checkpoint(
                 base_model,
@@ -323,20 +459,25 @@ def train(world_rank, args):
                 val_loss, val_cer, val_wer, min_val_loss, min_val_cer, min_val_wer
             ),
         )
-        logging.info(
-            "Timing Info: "
-            + ", ".join(
-                [
-                    "{} : {:.2f}ms".format(k, v * 1000.0)
-                    for k, v in timers.value().items()
-                ]
-            )
-        )
+        logging.info("Timing Info: " + timers.format_summary())
+        if profiler is not None and gtn_trace is not None:
+            profiler.save_trace(gtn_trace)
+        stats = {
+            "num_samples": meters.num_samples,
+            "epoch_time": epoch_time,
+            "timers": timers.summary(),
+        }
         scheduler.step()
         start_time = time.time()
 
+    if profiler is not None:
+        profiler.disable()
+    if graph_memory is not None:
+        utils.set_graph_memory(None)
     if is_distributed_train:
         torch.distributed.destroy_process_group()
+    # training statistics of the last epoch:
+    return stats
 
 
 def main():
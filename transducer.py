@@ -5,12 +5,15 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import collections
 import gtn
 import math
 import numpy as np
 import torch
 import itertools
 
+import utils
+
 
 def make_scalar_graph(weight):
     scalar = gtn.Graph()
@@ -29,9 +32,35 @@ def make_chain_graph(sequence):
     return graph
 
 
-def make_transitions_graph(ngram, num_tokens, calc_grad=False):
-    transitions = gtn.Graph(calc_grad)
-    transitions.add_node(True, ngram == 1)
+# The nodes and arcs of a graph, as the arguments of `add_node` and
+# `add_arc`, for the dense implementations of the loss which can't read them
+# from a `gtn.Graph`. The arcs are (source node, destination node, label) in
+# the order of the arc indices:
+GraphArcs = collections.namedtuple(
+    "GraphArcs", ["num_nodes", "start", "accept", "arcs"]
+)
+
+
+def make_graph(graph_arcs, calc_grad=False):
+    """
+    Returns the `gtn.Graph` acceptor of a `GraphArcs`.
+    """
+    graph = gtn.Graph(calc_grad)
+    start, accept = set(graph_arcs.start), set(graph_arcs.accept)
+    for n in range(graph_arcs.num_nodes):
+        graph.add_node(n in start, n in accept)
+    for src, dst, label in graph_arcs.arcs:
+        graph.add_arc(src, dst, label)
+    return graph
+
+
+def make_transitions_arcs(ngram, num_tokens):
+    """
+    Returns the `GraphArcs` of the transitions graph of an ngram model.
+    """
+    num_nodes = 1
+    accept = [0] if ngram == 1 else []
+    arcs = []
 
     state_map = {(): 0}
 
@@ -39,23 +68,324 @@ def make_transitions_graph(ngram, num_tokens, calc_grad=False):
     for n in range(1, ngram):
         for state in itertools.product(range(num_tokens), repeat=n):
             in_idx = state_map[state[:-1]]
-            out_idx = transitions.add_node(False, ngram == 1)
+            out_idx = num_nodes
+            num_nodes += 1
             state_map[state] = out_idx
-            transitions.add_arc(in_idx, out_idx, state[-1])
+            arcs.append((in_idx, out_idx, state[-1]))
 
     for state in itertools.product(range(num_tokens), repeat=ngram):
         state_idx = state_map[state[:-1]]
         new_state_idx = state_map[state[1:]]
         # p(state[-1] | state[:-1])
-        transitions.add_arc(state_idx, new_state_idx, state[-1])
+        arcs.append((state_idx, new_state_idx, state[-1]))
 
     if ngram > 1:
         # build transitions which include </s>:
-        end_idx = transitions.add_node(False, True)
+        end_idx = num_nodes
+        num_nodes += 1
+        accept.append(end_idx)
         for in_idx in range(end_idx):
-            transitions.add_arc(in_idx, end_idx, gtn.epsilon)
+            arcs.append((in_idx, end_idx, gtn.epsilon))
+
+    return GraphArcs(num_nodes, [0], accept, arcs)
+
+
+def make_transitions_graph(ngram, num_tokens, calc_grad=False):
+    return make_graph(make_transitions_arcs(ngram, num_tokens), calc_grad)
+
+
+def gather_weights(weights, index):
+    """
+    Returns the entries of `weights` at `index`, with `-inf` where the index
+    is negative.
+    """
+    gathered = weights[index.clamp(min=0)]
+    return torch.where(index >= 0, gathered, gathered.new_tensor(-math.inf))
+
+
+class DenseNormalizer:
+    """
+    Computes `forward_score(intersect(emissions, transitions))` for a batch of
+    emissions with tensor operations on the device of the emissions. Since
+    the emissions graph is linear, the score is a forward recursion over the
+    nodes of the transitions graph with one sparse log-semiring
+    matrix-vector product per frame. The gradients with respect to the
+    emissions and the transition weights are exact and given by autograd.
 
-    return transitions
+    Args:
+        transitions (GraphArcs) : The nodes and arcs of the transitions graph.
+            Its epsilon arcs must not form cycles.
+    """
+
+    def __init__(self, transitions):
+        start, accept, arcs = transitions.start, transitions.accept, transitions.arcs
+        self.num_nodes = transitions.num_nodes
+        emitting = [(i, *arc) for i, arc in enumerate(arcs) if arc[2] != gtn.epsilon]
+        epsilons = [(i, *arc) for i, arc in enumerate(arcs) if arc[2] == gtn.epsilon]
+
+        # Sort the epsilon arcs in levels such that the nodes of a level are
+        # only reached by epsilon arcs of lower levels:
+        depth = [0] * self.num_nodes
+        in_degree = [0] * self.num_nodes
+        out_arcs = [[] for _ in range(self.num_nodes)]
+        for _, src, dst, _ in epsilons:
+            in_degree[dst] += 1
+            out_arcs[src].append(dst)
+        queue = [n for n in range(self.num_nodes) if in_degree[n] == 0]
+        visited = 0
+        while queue:
+            node = queue.pop()
+            visited += 1
+            for dst in out_arcs[node]:
+                depth[dst] = max(depth[dst], depth[node] + 1)
+                in_degree[dst] -= 1
+                if in_degree[dst] == 0:
+                    queue.append(dst)
+        if visited != self.num_nodes:
+            raise ValueError("The epsilon arcs of the transitions graph have a cycle.")
+        epsilons.sort(key=lambda arc: depth[arc[1]])
+        self.levels = [0]
+        for e in range(1, len(epsilons) + 1):
+            if e == len(epsilons) or depth[epsilons[e][1]] != depth[epsilons[e - 1][1]]:
+                self.levels.append(e)
+
+        def to_tensors(arcs):
+            return [torch.tensor(x, dtype=torch.long) for x in zip(*arcs)] or [
+                torch.zeros(0, dtype=torch.long)
+            ] * 4
+
+        self.tensors = {
+            "start": torch.tensor(start, dtype=torch.long),
+            "accept": torch.tensor(accept, dtype=torch.long),
+            "nodes": torch.arange(self.num_nodes),
+            "arcs": to_tensors(emitting),
+            "epsilons": to_tensors(epsilons),
+        }
+        self.device_tensors = {}
+
+    def _tensors(self, device, num_classes):
+        key = (device, num_classes)
+        if key not in self.device_tensors:
+            tensors = dict(self.tensors)
+            # arcs with labels not in the emissions can't be intersected:
+            keep = tensors["arcs"][3] < num_classes
+            tensors["arcs"] = [t[keep] for t in tensors["arcs"]]
+            self.device_tensors[key] = {
+                k: [t.to(device) for t in v] if isinstance(v, list) else v.to(device)
+                for k, v in tensors.items()
+            }
+        return self.device_tensors[key]
+
+    def _epsilon_closure(
+        self, alpha, weights, tensors, reduce=utils.scatter_logsumexp
+    ):
+        index, src, dst, _ = tensors["epsilons"]
+        for start, end in zip(self.levels[:-1], self.levels[1:]):
+            scores = alpha[:, src[start:end]] + weights[index[start:end]]
+            alpha = reduce(
+                torch.cat([alpha, scores], dim=1),
+                torch.cat([tensors["nodes"], dst[start:end]]),
+                self.num_nodes,
+            )
+        return alpha
+
+    def _backward_closure(self, beta, weights, tensors):
+        index, src, dst, _ = tensors["epsilons"]
+        # the nodes of later levels are only left by arcs to even later ones:
+        for start, end in reversed(list(zip(self.levels[:-1], self.levels[1:]))):
+            scores = beta[:, dst[start:end]] + weights[index[start:end]]
+            beta = utils.scatter_max(
+                torch.cat([beta, scores], dim=1),
+                torch.cat([tensors["nodes"], src[start:end]]),
+                self.num_nodes,
+            )
+        return beta
+
+    def viterbi_scores(self, emissions, weights):
+        """
+        Returns the scores of the best paths from the start nodes to each
+        node of the transitions graph after each frame of the emissions of
+        shape [B, T, C], and from each node after each frame to the accept
+        nodes, both of shape [B, T + 1, N].
+        """
+        B, T, C = emissions.shape
+        tensors = self._tensors(emissions.device, C)
+        index, src, dst, label = tensors["arcs"]
+        arc_weights = weights[index]
+        alpha = emissions.new_full((B, self.num_nodes), -math.inf)
+        alpha[:, tensors["start"]] = 0
+        alphas = [self._epsilon_closure(alpha, weights, tensors, utils.scatter_max)]
+        for t in range(T):
+            scores = alphas[-1][:, src] + arc_weights + emissions[:, t, label]
+            alpha = utils.scatter_max(scores, dst, self.num_nodes)
+            alpha = self._epsilon_closure(alpha, weights, tensors, utils.scatter_max)
+            alphas.append(alpha)
+        beta = emissions.new_full((B, self.num_nodes), -math.inf)
+        beta[:, tensors["accept"]] = 0
+        betas = [self._backward_closure(beta, weights, tensors)]
+        for t in reversed(range(T)):
+            scores = betas[-1][:, dst] + arc_weights + emissions[:, t, label]
+            beta = utils.scatter_max(scores, src, self.num_nodes)
+            betas.append(self._backward_closure(beta, weights, tensors))
+        return torch.stack(alphas, dim=1), torch.stack(betas[::-1], dim=1)
+
+    def __call__(self, emissions, weights):
+        """
+        Returns the forward score of each sample of the emissions of shape
+        [B, T, C] given the transition weights.
+        """
+        B, T, C = emissions.shape
+        tensors = self._tensors(emissions.device, C)
+        index, src, dst, label = tensors["arcs"]
+        alpha = emissions.new_full((B, self.num_nodes), -math.inf)
+        alpha[:, tensors["start"]] = 0
+        alpha = self._epsilon_closure(alpha, weights, tensors)
+        arc_weights = weights[index]
+        for t in range(T):
+            scores = alpha[:, src] + arc_weights + emissions[:, t, label]
+            alpha = utils.scatter_logsumexp(scores, dst, self.num_nodes)
+            alpha = self._epsilon_closure(alpha, weights, tensors)
+        return torch.logsumexp(alpha[:, tensors["accept"]], dim=1)
+
+
+class DenseBigram:
+    """
+    Computes the numerator and the normalization term of the transducer loss
+    with a unigram or bigram transition model using batched tensor
+    operations. In these models the weight of a token only depends on the
+    previous token, so the normalizer is one dense [C + 1, C] log-semiring
+    matrix product per frame (or a closed form for unigram models), and the
+    numerator a recursion over the arcs of the alignment graphs. The gradients
+    with respect to the emissions and the transition weights are given by
+    autograd.
+
+    Args:
+        transitions (GraphArcs) : The nodes and arcs of the transitions graph,
+            e.g. as built by `make_transitions_arcs` with `ngram` of 1 or 2.
+            All the arcs with a given label must lead to the same node and
+            epsilon arcs may only lead to accept nodes without outgoing arcs.
+    """
+
+    def __init__(self, transitions):
+        start, accept, arcs = transitions.start, transitions.accept, transitions.arcs
+        if len(start) != 1:
+            raise ValueError("The transitions graph must have one start node.")
+        label_nodes = {}
+        node_arcs = {}
+        end_arcs = {}
+        sources = set()
+        for i, (src, dst, label) in enumerate(arcs):
+            sources.add(src)
+            if label == gtn.epsilon:
+                if dst not in accept or src in end_arcs:
+                    raise ValueError("Unsupported epsilon arc in transitions graph.")
+                end_arcs[src] = i
+                continue
+            if label_nodes.setdefault(label, dst) != dst or (src, label) in node_arcs:
+                raise ValueError("The transitions graph is not a bigram model.")
+            node_arcs[(src, label)] = i
+        if any(arcs[i][1] in sources for i in end_arcs.values()):
+            raise ValueError("Unsupported epsilon arc in transitions graph.")
+
+        self.num_classes = max(label_nodes.keys(), default=-1) + 1
+        # the node reached by each token and the start node:
+        nodes = [label_nodes.get(c, -1) for c in range(self.num_classes)]
+        nodes.append(start[0])
+        # the index of the weight of each token given the previous token, the
+        # last row is for the first token:
+        self.tensors = {
+            "weights": torch.tensor(
+                [[node_arcs.get((n, c), -1) for c in range(self.num_classes)] for n in nodes]
+            ),
+            # the index of the weight of ending after each token, the accept
+            # nodes end with no weight:
+            "end": torch.tensor([end_arcs.get(n, -1) for n in nodes[:-1]]),
+            "final": torch.tensor([n in accept for n in nodes[:-1]]),
+        }
+        # in a unigram model the weights do not depend on the previous token:
+        self.unigram = bool((self.tensors["weights"] == self.tensors["weights"][0]).all())
+        self.device_tensors = {}
+
+    def _weights(self, params):
+        device = params.device
+        if device not in self.device_tensors:
+            self.device_tensors[device] = {
+                k: v.to(device) for k, v in self.tensors.items()
+            }
+        tensors = self.device_tensors[device]
+        weights = gather_weights(params, tensors["weights"])
+        end = gather_weights(params, tensors["end"])
+        end = torch.where(tensors["final"], torch.zeros_like(end), end)
+        return weights, end
+
+    def normalizer(self, emissions, params):
+        """
+        Returns the forward score of each sample of the emissions of shape
+        [B, T, C] with the transition model.
+        """
+        B, T, C = emissions.shape
+        weights, end = self._weights(params)
+        if self.unigram:
+            # the frames are independent given the last token:
+            scores = emissions + weights[C]
+            return torch.logsumexp(scores[:, :-1], dim=2).sum(dim=1) + torch.logsumexp(
+                scores[:, -1] + end, dim=1
+            )
+        alpha = emissions[:, 0] + weights[C]
+        for t in range(1, T):
+            alpha = emissions[:, t] + utils.log_matmul(alpha, weights[:C])
+        return torch.logsumexp(alpha + end, dim=1)
+
+    def numerator(self, emissions, alignments, params):
+        """
+        Returns the forward score of each sample of the emissions of shape
+        [B, T, C] constrained to the corresponding alignment graph, given as
+        a `GraphArcs`, with the transition model.
+        """
+        B, T, C = emissions.shape
+        weights, end = self._weights(params)
+
+        # Gather the arcs of all the alignment graphs and, for each arc, the
+        # arcs which can precede it:
+        arc_batch, arc_labels, is_start, is_final, prev_arcs = [], [], [], [], []
+        for b, (_, start, accept, arcs) in enumerate(alignments):
+            start, accept = set(start), set(accept)
+            offset = len(arc_labels)
+            in_arcs = collections.defaultdict(list)
+            for i, (src, dst, label) in enumerate(arcs):
+                in_arcs[dst].append(offset + i)
+            for i, (src, dst, label) in enumerate(arcs):
+                arc_batch.append(b)
+                arc_labels.append(label)
+                is_start.append(src in start)
+                is_final.append(dst in accept)
+                prev_arcs.append(in_arcs[src])
+        # pad the predecessors to the same number, the padding has no path:
+        max_prev = max((len(p) for p in prev_arcs), default=0)
+        prev_mask = [[True] * len(p) + [False] * (max_prev - len(p)) for p in prev_arcs]
+        prev_arcs = [p + [0] * (max_prev - len(p)) for p in prev_arcs]
+        device = emissions.device
+        arc_batch = torch.tensor(arc_batch, dtype=torch.long, device=device)
+        arc_labels = torch.tensor(arc_labels, dtype=torch.long, device=device)
+        is_start = torch.tensor(is_start, dtype=torch.bool, device=device)
+        is_final = torch.tensor(is_final, dtype=torch.bool, device=device)
+        prev_arcs = torch.tensor(prev_arcs, dtype=torch.long, device=device)
+        prev_mask = torch.tensor(prev_mask, dtype=torch.bool, device=device)
+        prev_arcs = prev_arcs.view(-1, max_prev)
+        prev_mask = prev_mask.view(-1, max_prev)
+
+        # alpha is the score of the paths ending in each arc:
+        arc_emissions = emissions[arc_batch, :, arc_labels].t()
+        no_path = arc_emissions.new_tensor(-math.inf)
+        prev_weights = torch.where(
+            prev_mask, weights[arc_labels[prev_arcs], arc_labels.unsqueeze(1)], no_path
+        )
+        alpha = arc_emissions[0] + torch.where(is_start, weights[C, arc_labels], no_path)
+        for t in range(1, T):
+            scores = alpha[prev_arcs] + prev_weights
+            alpha = arc_emissions[t] + utils.masked_logsumexp(scores)
+        alpha = alpha + torch.where(is_final, end[arc_labels], no_path)
+        return utils.scatter_logsumexp(alpha, arc_batch, B)
 
 
 def make_lexicon_graph(word_pieces, graphemes_to_idx):
@@ -136,6 +466,10 @@ class Transducer(torch.nn.Module):
             "a", "b", ..) to their corresponding integer index.
         ngram (int) : Order of the token-level transition model. If `ngram=0`
             then no transition model is used.
+        transitions (gtn.Graph or GraphArcs) (optional) : A transition model
+            to use instead of an ngram model. The dense implementations and
+            `lattice` read the arcs of the model, so they are only available
+            if it is given as a `GraphArcs`.
         blank (string) : Specifies the usage of blank token
             'none' - do not use blank token
             'optional' - allow an optional blank inbetween tokens
@@ -144,6 +478,20 @@ class Transducer(torch.nn.Module):
             consecutive tokens in the alignment graph. This keeps the graph
             unambiguous in the sense that the same input cannot transduce to
             different outputs.
+        recompute (boolean) : If true, the graphs of each sample are freed
+            after the forward and recomputed in the backward. This reduces the
+            peak memory when the transition model is large.
+        dense_normalizer (boolean) : If true, the normalization term of the
+            transition model is computed with batched tensor operations
+            instead of GTN when the epsilon arcs of the transitions graph are
+            acyclic. Autograd keeps the intermediate tensors of every frame
+            for the backward, so GTN is used instead when `recompute` is set
+            or the retained graphs are capped (see `utils.GraphMemory`).
+        dense_bigram (boolean) : If true and the transition model is a bigram
+            model, the whole loss is computed with batched tensor operations
+            instead of GTN. For unigram models only the normalization term is.
+            As for `dense_normalizer`, GTN is used instead when the memory is
+            bounded by `recompute` or a graph memory cap.
     """
 
     def __init__(
@@ -155,6 +503,9 @@ class Transducer(torch.nn.Module):
         blank="none",
         allow_repeats=True,
         reduction="none",
+        recompute=False,
+        dense_normalizer=True,
+        dense_bigram=True,
     ):
         super(Transducer, self).__init__()
         if blank not in ["optional", "forced", "none"]:
@@ -163,13 +514,26 @@ class Transducer(torch.nn.Module):
             )
         self.tokens = make_token_graph(tokens, blank=blank, allow_repeats=allow_repeats)
         self.lexicon = make_lexicon_graph(tokens, graphemes_to_idx)
+        self.blank = blank
+        self.allow_repeats = allow_repeats
+        self.num_tokens = len(tokens)
+        # the tokens by their graphemes to build the alignments of a target:
+        self.spellings = collections.defaultdict(list)
+        for i, token in enumerate(tokens):
+            self.spellings[tuple(graphemes_to_idx[g] for g in token)].append(i)
+        self.max_spelling = max((len(t) for t in tokens), default=0)
         self.ngram = ngram
         if ngram > 0 and transitions is not None:
             raise ValueError("Only one of ngram and transitions may be specified")
         if ngram > 0:
-            transitions = make_transitions_graph(
-                ngram, len(tokens) + int(blank != "none"), True
+            transitions = make_transitions_arcs(
+                ngram, len(tokens) + int(blank != "none")
             )
+        # the arcs of the transition model for the dense implementations:
+        self.transitions_arcs = None
+        if isinstance(transitions, GraphArcs):
+            self.transitions_arcs = transitions
+            transitions = make_graph(transitions, True)
 
         if transitions is not None:
             self.transitions = transitions
@@ -181,12 +545,45 @@ class Transducer(torch.nn.Module):
             self.transitions = None
             self.transition_params = None
         self.reduction = reduction
+        self.recompute = recompute
+        self.normalizer = None
+        if self.transitions_arcs is not None and dense_normalizer:
+            try:
+                self.normalizer = DenseNormalizer(self.transitions_arcs)
+            except ValueError:
+                # fall back to GTN for graphs with epsilon cycles
+                pass
+        self.bigram = None
+        if self.transitions_arcs is not None and dense_bigram:
+            try:
+                self.bigram = DenseBigram(self.transitions_arcs)
+            except ValueError:
+                pass
+        # the scorers of the lattices by number of classes, built when needed:
+        self.lattice_scorers = {}
+
+    def _bounded_memory(self):
+        """
+        Returns true if the memory of the loss must stay bounded, in which
+        case it is computed with GTN to recompute the graphs in the backward.
+        """
+        graph_memory = utils.GRAPH_MEMORY
+        capped = graph_memory is not None and graph_memory.max_bytes is not None
+        return self.recompute or capped
 
     def forward(self, inputs, targets):
         if self.transitions is None:
             inputs = torch.nn.functional.log_softmax(inputs, dim=2)
         self.tokens.arc_sort(True)
-        return TransducerLoss(
+        bounded_memory = self._bounded_memory()
+        normalizer = None if bounded_memory else self.normalizer
+        bigram = None if bounded_memory else self.bigram
+        if bigram is not None and bigram.num_classes == inputs.shape[2]:
+            if not bigram.unigram:
+                return self._bigram_loss(inputs, targets)
+            # GTN scores the numerator of unigram models as fast:
+            normalizer = bigram.normalizer
+        loss = TransducerLoss(
             inputs,
             targets,
             self.tokens,
@@ -194,9 +591,151 @@ class Transducer(torch.nn.Module):
             self.transition_params,
             self.transitions,
             self.reduction,
+            self.recompute,
+            normalizer is None,
         )
+        if normalizer is not None:
+            norms = normalizer(inputs.float(), self.transition_params)
+            if self.reduction == "mean":
+                scales = [(1 / len(t) if len(t) > 0 else 1.0) for t in targets]
+                norms = norms * norms.new_tensor(scales)
+            loss = loss + torch.mean(norms)
+        return loss
+
+    def _alignments_arcs(self, target):
+        """
+        Returns the `GraphArcs` of the alignments of the tokens to the target,
+        which has the paths of `make_alignments_graph`. The graph is built
+        from the states of the token graph (see `make_token_graph`) and the
+        positions in the target, and the epsilon arcs are then removed.
+        """
+        L = len(target)
+        if L == 0:
+            # as `make_chain_graph`, an empty target has no accept node:
+            return GraphArcs(1, [0], [], [])
+        ntoks = self.num_tokens
+        forced = self.blank == "forced"
+        blank_state = ntoks + 1
+        # the (end position, token) of the tokens spelled from each position:
+        spelled = [[] for _ in range(L + 1)]
+        for p in range(L):
+            for n in range(1, min(self.max_spelling, L - p) + 1):
+                for k in self.spellings.get(tuple(target[p : p + n]), []):
+                    spelled[p].append((p + n, k))
+
+        def out_arcs(s, p):
+            # the arcs of the token graph from state `s` at position `p` as
+            # (state, position, label), with label `None` for epsilon:
+            tokens = []
+            if s == 0:
+                if self.blank != "none":
+                    yield blank_state, p, ntoks
+                if not forced:
+                    tokens = spelled[p]
+            elif s == blank_state:
+                yield 0, p, None
+                if forced:
+                    tokens = spelled[p]
+            else:
+                yield s, p, s - 1
+                if not self.allow_repeats:
+                    yield blank_state, p, ntoks
+                    tokens = [(q, k) for q, k in spelled[p] if k != s - 1]
+                elif forced:
+                    yield blank_state, p, ntoks
+                else:
+                    yield 0, p, None
+            for q, k in tokens:
+                yield k + 1, q, k
+
+        # the states reachable from the start and their arcs:
+        nodes = {(0, 0): 0}
+        queue = [(0, 0)]
+        out, epsilons = collections.defaultdict(list), collections.defaultdict(list)
+        while queue:
+            state = queue.pop()
+            for s, p, label in out_arcs(*state):
+                if (s, p) not in nodes:
+                    nodes[s, p] = len(nodes)
+                    queue.append((s, p))
+                if label is None:
+                    epsilons[nodes[state]].append(nodes[s, p])
+                else:
+                    out[nodes[state]].append((nodes[s, p], label))
+        final = {
+            n
+            for (s, p), n in nodes.items()
+            if p == L and (s == 0 or (s != blank_state and not forced))
+        }
+
+        # remove the epsilon arcs, which are acyclic, as `gtn.remove` does:
+        # a node gets the arcs of the nodes in its epsilon closure and is an
+        # accept node if one of them is:
+        def closure(n):
+            return {n}.union(*(closure(e) for e in epsilons[n]))
+
+        start = [0]
+        accept, arcs = [], []
+        for n in range(len(nodes)):
+            reached = sorted(closure(n))
+            if not final.isdisjoint(reached):
+                accept.append(n)
+            arcs.extend((n, dst, label) for m in reached for dst, label in out[m])
+
+        # keep the nodes on a path from the start to an accept node:
+        def reachable(nodes, arcs):
+            out = collections.defaultdict(list)
+            for src, dst in arcs:
+                out[src].append(dst)
+            seen, queue = set(nodes), list(nodes)
+            while queue:
+                for m in out[queue.pop()]:
+                    if m not in seen:
+                        seen.add(m)
+                        queue.append(m)
+            return seen
+
+        keep = reachable(start, [(src, dst) for src, dst, _ in arcs]) & reachable(
+            accept, [(dst, src) for src, dst, _ in arcs]
+        )
+        index = {n: i for i, n in enumerate(sorted(keep))}
+        return GraphArcs(
+            len(index),
+            [index[n] for n in start if n in keep],
+            [index[n] for n in accept if n in keep],
+            [
+                (index[src], index[dst], label)
+                for src, dst, label in arcs
+                if src in keep and dst in keep
+            ],
+        )
+
+    def _bigram_loss(self, inputs, targets):
+        B = inputs.shape[0]
+        alignments = [None] * B
 
-    def viterbi(self, outputs):
+        def process(b):
+            alignments[b] = self._alignments_arcs(targets[b])
+
+        utils.parallel_for(process, range(B))
+        emissions = inputs.float()
+        losses = self.bigram.normalizer(
+            emissions, self.transition_params
+        ) - self.bigram.numerator(emissions, alignments, self.transition_params)
+        if self.reduction == "mean":
+            scales = [(1 / len(t) if len(t) > 0 else 1.0) for t in targets]
+            losses = losses * losses.new_tensor(scales)
+        return torch.mean(losses)
+
+    def viterbi(self, outputs, confidences=False):
+        """
+        Returns the best token sequence of each sample of the outputs of shape
+        [B, T, C]. With `confidences=True` the confidence of each token is
+        also returned, as the highest posterior probability of its label over
+        the frames it is aligned to. The frame posteriors are computed by
+        forward-backward over the graph of the emissions intersected with the
+        transitions in parallel over the batch.
+        """
         B, T, C = outputs.shape
 
         if self.transitions is not None:
@@ -207,9 +746,10 @@ class Transducer(torch.nn.Module):
         self.tokens.arc_sort()
 
         paths = [None] * B
+        scores = [None] * B
         def process(b):
-            emissions = gtn.linear_graph(T, C, False)
-            cpu_data = outputs[b].cpu().contiguous()
+            emissions = gtn.linear_graph(T, C, confidences)
+            cpu_data = outputs[b].cpu().float().contiguous()
             emissions.set_weights(cpu_data.data_ptr())
             if self.transitions is not None:
                 full_graph = gtn.intersect(emissions, self.transitions)
@@ -225,15 +765,244 @@ class Transducer(torch.nn.Module):
             # When there are ambiguous paths (allow_repeats is true), we take
             # the shortest:
             path = gtn.viterbi_path(path)
+            if confidences:
+                gtn.backward(gtn.forward_score(full_graph))
+                posteriors = emissions.grad().weights_to_numpy().reshape(T, C)
+                scores[b] = token_confidences(path, posteriors)
             path = gtn.remove(gtn.project_output(path))
             paths[b] = path.labels_to_list()
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
         predictions = [torch.IntTensor(path) for path in paths]
+        if confidences:
+            return predictions, [torch.FloatTensor(s) for s in scores]
         return predictions
 
+    def _dense_transitions(self, num_classes):
+        if self.transitions is None:
+            if num_classes not in self.lattice_scorers:
+                # without a transition model any label can follow any label:
+                arcs = [(0, 0, c) for c in range(num_classes)]
+                transitions = GraphArcs(1, [0], [0], arcs)
+                self.lattice_scorers[num_classes] = DenseNormalizer(transitions)
+            return self.lattice_scorers[num_classes], torch.zeros(num_classes)
+        if self.transitions_arcs is None:
+            raise ValueError("Lattices need the transitions given as GraphArcs.")
+        if self.normalizer is not None:
+            return self.normalizer, self.transition_params.detach().cpu()
+        # sorting the epsilon arcs of the transitions is slow so it is done once:
+        if None not in self.lattice_scorers:
+            self.lattice_scorers[None] = DenseNormalizer(self.transitions_arcs)
+        return self.lattice_scorers[None], self.transition_params.detach().cpu()
+
+    @torch.no_grad()
+    def lattice(self, outputs, beam=10.0):
+        """
+        Returns a pruned lattice of the token sequences of each sample of the
+        outputs of shape [B, T, C] as a `gtn.Graph`. The paths of a lattice
+        are the alignments whose score, the sum of their emissions and
+        transition weights, is within `beam` of the best one, with the tokens
+        as labels and epsilons on the frames which do not start a token. Its
+        `gtn.viterbi_score` is the score of the best alignment. As in the
+        loss, the outputs are log-softmax normalized if there is no
+        transition model.
+
+        The scores of the best alignments to and from each state of the
+        transition model after each frame are computed for the whole batch
+        with tensor operations. The lattices are then built directly from the
+        arcs within the beam in parallel over the batch, so the full graph of
+        the emissions intersected with the transitions is never built. The
+        epsilon arcs of the transitions graph must not form cycles.
+        """
+        B, T, C = outputs.shape
+        emissions = outputs.detach().double()
+        if self.transitions is None:
+            emissions = torch.nn.functional.log_softmax(emissions, dim=2)
+        normalizer, weights = self._dense_transitions(C)
+        weights = weights.to(emissions)
+        alphas, betas = normalizer.viterbi_scores(emissions, weights)
+        emissions, alphas, betas = emissions.cpu(), alphas.cpu(), betas.cpu()
+        weights = weights.cpu()
+        tensors = normalizer._tensors(torch.device("cpu"), C)
+        start = set(tensors["start"].tolist())
+        accept = set(tensors["accept"].tolist())
+        index, src, dst, label = tensors["arcs"]
+        arc_weights = weights[index]
+        eps_index, eps_src, eps_dst, _ = tensors["epsilons"]
+        eps_weights = weights[eps_index]
+        epsilons = torch.full_like(eps_src, gtn.epsilon)
+        best = alphas[:, T, tensors["accept"]].amax(dim=1).tolist()
+
+        self.tokens.arc_sort()
+
+        lattices = [None] * B
+        def process(b):
+            lattice = gtn.Graph(False)
+            nodes = {}
+
+            def node(t, s):
+                if (t, s) not in nodes:
+                    nodes[t, s] = lattice.add_node(
+                        t == 0 and s in start, t == T and s in accept
+                    )
+                return nodes[t, s]
+
+            def add_arcs(t, arcs, keep, scores):
+                arcs = [a[keep].tolist() for a in arcs]
+                for s, d, l, w in zip(*arcs, scores[keep].tolist()):
+                    next_t = t if l == gtn.epsilon else t + 1
+                    lattice.add_arc(node(t, s), node(next_t, d), l, l, w)
+
+            # An arc is kept if the best path through it is within the beam,
+            # with some slack for the rounding of the best path:
+            threshold = best[b] - beam - 1e-6 * (1 + abs(best[b]))
+            for t in range(T + 1) if math.isfinite(best[b]) else []:
+                if t < T:
+                    scores = arc_weights + emissions[b, t, label]
+                    through = alphas[b, t, src] + scores + betas[b, t + 1, dst]
+                    keep = through >= threshold
+                    add_arcs(t, (src, dst, label), keep, scores)
+                through = alphas[b, t, eps_src] + eps_weights + betas[b, t, eps_dst]
+                keep = through >= threshold
+                add_arcs(t, (eps_src, eps_dst, epsilons), keep, eps_weights)
+            lattice.arc_sort(True)
+            lattices[b] = gtn.project_output(gtn.compose(lattice, self.tokens))
+
+        utils.parallel_for(process, range(B))
+        return lattices
+
+    def nbest(self, outputs, n, beam=10.0):
+        """
+        Returns the `n` best token sequences of each sample of the outputs of
+        shape [B, T, C] as lists of `(tokens, score)` by decreasing score.
+        The score of a token sequence is that of its best alignment. The
+        sequences are searched in the lattices returned by `lattice` with
+        `beam`, so fewer than `n` are returned if fewer are in the lattice.
+        """
+        lattices = self.lattice(outputs, beam)
+
+        hypotheses = [None] * len(lattices)
+        def process(b):
+            lattice = lattices[b]
+            lattice.arc_sort(True)
+            labels = set(lattice.labels_to_list()) - {gtn.epsilon}
+            hypotheses[b] = []
+            graph = lattice
+            while len(hypotheses[b]) < n:
+                score = gtn.viterbi_score(graph).item()
+                if math.isinf(score):
+                    break
+                tokens = gtn.remove(gtn.viterbi_path(graph)).labels_to_list()
+                hypotheses[b].append((torch.IntTensor(tokens), score))
+                # the next best sequence is the best one of the others:
+                excluded = [h.tolist() for h, _ in hypotheses[b]]
+                exclusion = make_exclusion_graph(excluded, labels)
+                exclusion.arc_sort()
+                graph = gtn.compose(lattice, exclusion)
+
+        utils.parallel_for(process, range(len(lattices)))
+        return hypotheses
+
+
+def token_confidences(path, posteriors):
+    """
+    Returns the confidence of each token of a best path composed with the
+    token graph as the highest posterior of its label, given the posteriors
+    of each label at each frame of shape [T, C], over the frames of the
+    token.
+    """
+    confidences = []
+    label = None
+    frame = 0
+    for ilabel, olabel in zip(path.labels_to_list(), path.labels_to_list(False)):
+        if olabel != gtn.epsilon:
+            confidences.append(posteriors[frame, ilabel])
+            label = ilabel
+        elif ilabel == label:
+            confidences[-1] = max(confidences[-1], posteriors[frame, ilabel])
+        elif ilabel != gtn.epsilon:
+            # a blank ends the token:
+            label = None
+        if ilabel != gtn.epsilon:
+            frame += 1
+    return confidences
+
+
+def make_exclusion_graph(sequences, labels):
+    """
+    Constructs an acceptor of all the sequences of `labels` except the given
+    sequences.
+    """
+    excluded = set(tuple(s) for s in sequences)
+    prefixes = {()} | {s[:i] for s in excluded for i in range(1, len(s) + 1)}
+    graph = gtn.Graph(False)
+    nodes = {}
+    for prefix in sorted(prefixes, key=len):
+        nodes[prefix] = graph.add_node(len(prefix) == 0, prefix not in excluded)
+    # the sequences which leave the prefixes are all accepted:
+    other = graph.add_node(False, True)
+    for label in labels:
+        graph.add_arc(other, other, label)
+    for prefix, node in nodes.items():
+        for label in labels:
+            graph.add_arc(node, nodes.get(prefix + (label,), other), label)
+    return graph
+
+
+def make_alignments_graph(target, tokens, lexicon):
+    """
+    Constructs the graph of all the alignments of the tokens to the target.
+    """
+    target = make_chain_graph(target)
+    target.arc_sort(True)
+
+    # Create token to grapheme decomposition graph
+    tokens_target = gtn.remove(gtn.project_output(gtn.compose(target, lexicon)))
+    tokens_target.arc_sort()
+
+    # Create alignment graph:
+    alignments = gtn.project_input(
+        gtn.remove(gtn.compose(tokens, tokens_target))
+    )
+    alignments.arc_sort()
+    return alignments
+
 
 class TransducerLossFunction(torch.autograd.Function):
+    @staticmethod
+    def create_loss_graph(
+        inputs, target, tokens, lexicon, transitions, calc_grad, normalize=True
+    ):
+        """
+        Returns the loss graph and the emissions graph of one sample and the
+        estimated memory of the graphs retained by the loss graph.
+        """
+        T, C = inputs.shape
+        # Create emissions graph:
+        emissions = gtn.linear_graph(T, C, calc_grad)
+        # upcast on the host as the weights are read as 32-bit floats:
+        cpu_data = inputs.cpu().float().contiguous()
+        emissions.set_weights(cpu_data.data_ptr())
+        alignments = make_alignments_graph(target, tokens, lexicon)
+
+        # Add transition scores:
+        if transitions is not None:
+            alignments = gtn.intersect(transitions, alignments)
+            alignments.arc_sort()
+
+        aligned = gtn.intersect(emissions, alignments)
+        loss = gtn.forward_score(aligned)
+        retained = [emissions, alignments, aligned]
+
+        # Normalize if needed:
+        if transitions is not None and normalize:
+            normalized = gtn.intersect(emissions, transitions)
+            norm = gtn.forward_score(normalized)
+            loss = gtn.subtract(loss, norm)
+            retained.append(normalized)
+
+        return gtn.negate(loss), emissions, utils.graph_bytes(*retained)
+
     @staticmethod
     def forward(
         ctx,
@@ -244,10 +1013,20 @@ class TransducerLossFunction(torch.autograd.Function):
         transition_params=None,
         transitions=None,
         reduction="none",
+        recompute=False,
+        normalize=True,
     ):
         B, T, C = inputs.shape
         losses = [None] * B
+        loss_values = [None] * B
         emissions_graphs = [None] * B
+        retained_bytes = [0] * B
+        requires_grad = inputs.requires_grad or (
+            transition_params is not None and transition_params.requires_grad
+        )
+        graph_memory = utils.GRAPH_MEMORY if requires_grad else None
+        if graph_memory is not None:
+            graph_memory.release_on_free(ctx, retained_bytes)
         if transitions is not None:
             if transition_params is None:
                 raise ValueError("Specified transitions, but not transition params.")
@@ -257,45 +1036,34 @@ class TransducerLossFunction(torch.autograd.Function):
             transitions.zero_grad()
 
         def process(b):
-            # Create emissions graph:
-            emissions = gtn.linear_graph(T, C, inputs.requires_grad)
-            cpu_data = inputs[b].cpu().contiguous()
-            emissions.set_weights(cpu_data.data_ptr())
-            target = make_chain_graph(targets[b])
-            target.arc_sort(True)
-
-            # Create token to grapheme decomposition graph
-            tokens_target = gtn.remove(gtn.project_output(gtn.compose(target, lexicon)))
-            tokens_target.arc_sort()
-
-            # Create alignment graph:
-            alignments = gtn.project_input(
-                gtn.remove(gtn.compose(tokens, tokens_target))
+            loss, emissions, nbytes = TransducerLossFunction.create_loss_graph(
+                inputs[b],
+                targets[b],
+                tokens,
+                lexicon,
+                transitions,
+                inputs.requires_grad and not recompute,
+                normalize,
             )
-            alignments.arc_sort()
-
-            # Add transition scores:
-            if transitions is not None:
-                alignments = gtn.intersect(transitions, alignments)
-                alignments.arc_sort()
-
-            loss = gtn.forward_score(gtn.intersect(emissions, alignments))
-
-            # Normalize if needed:
-            if transitions is not None:
-                norm = gtn.forward_score(gtn.intersect(emissions, transitions))
-                loss = gtn.subtract(loss, norm)
-
-            losses[b] = gtn.negate(loss)
-
-            # Save for backward:
-            if emissions.calc_grad:
+            loss_values[b] = loss.item()
+
+            # Save for backward, the graphs are recomputed in the backward
+            # if requested or if over the memory cap:
+            if not requires_grad or recompute:
+                return
+            if graph_memory is None or graph_memory.retain(nbytes):
+                losses[b] = loss
                 emissions_graphs[b] = emissions
+                retained_bytes[b] = nbytes
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
 
-        ctx.graphs = (losses, emissions_graphs, transitions)
-        ctx.input_shape = inputs.shape
+        ctx.save_for_backward(inputs)
+        ctx.graphs = (losses, emissions_graphs, tokens, lexicon, transitions)
+        ctx.graph_memory = (graph_memory, retained_bytes)
+        ctx.targets = targets
+        ctx.normalize = normalize
+        ctx.input_dtype = inputs.dtype
 
         # Optionally reduce by target length:
         if reduction == "mean":
@@ -304,30 +1072,47 @@ class TransducerLossFunction(torch.autograd.Function):
             scales = [1.0] * B
         ctx.scales = scales
 
-        loss = torch.tensor([l.item() * s for l, s in zip(losses, scales)])
+        loss = torch.tensor([l * s for l, s in zip(loss_values, scales)])
         return torch.mean(loss.to(inputs.device))
 
     @staticmethod
     def backward(ctx, grad_output):
-        losses, emissions_graphs, transitions = ctx.graphs
+        losses, emissions_graphs, tokens, lexicon, transitions = ctx.graphs
+        graph_memory, retained_bytes = ctx.graph_memory
+        (inputs,) = ctx.saved_tensors
         scales = ctx.scales
-        B, T, C = ctx.input_shape
+        B, T, C = inputs.shape
         calc_emissions = ctx.needs_input_grad[0]
         input_grad = torch.empty((B, T, C)) if calc_emissions else None
 
         def process(b):
+            loss, emissions = losses[b], emissions_graphs[b]
+            if loss is None:
+                loss, emissions, _ = TransducerLossFunction.create_loss_graph(
+                    inputs[b].detach(),
+                    ctx.targets[b],
+                    tokens,
+                    lexicon,
+                    transitions,
+                    calc_emissions,
+                    ctx.normalize,
+                )
             scale = make_scalar_graph(scales[b])
-            gtn.backward(losses[b], scale)
-            emissions = emissions_graphs[b]
+            gtn.backward(loss, scale)
             if calc_emissions:
                 grad = emissions.grad().weights_to_numpy()
                 input_grad[b] = torch.tensor(grad).view(1, T, C)
+            # free the graphs of the sample:
+            losses[b] = emissions_graphs[b] = None
+            if graph_memory is not None:
+                graph_memory.release(retained_bytes, b)
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
 
         if calc_emissions:
             input_grad = input_grad.to(grad_output.device)
             input_grad *= grad_output / B
+            input_grad = input_grad.to(ctx.input_dtype)
 
         if ctx.needs_input_grad[4]:
             grad = transitions.grad().weights_to_numpy()
@@ -343,7 +1128,9 @@ class TransducerLossFunction(torch.autograd.Function):
             None,  # lex
             transition_grad,  # transition params
             None,  # transitions graph
-            None,
+            None,  # reduction
+            None,  # recompute
+            None,  # normalize
         )
 
 
@@ -466,7 +1253,8 @@ class ConvTransduce1DFunction(torch.autograd.Function):
         if T < kernel_size:
             # Padding should be done outside of this function:
             raise ValueError(f"Input ({T}) too short for kernel ({kernel_size})")
-        cpu_inputs = inputs.cpu()
+        # upcast on the host as the weights are read as 32-bit floats:
+        cpu_inputs = inputs.cpu().float()
         output_graphs = [[] for _ in range(B)]
         input_graphs = [[] for _ in range(B)]
 
@@ -502,11 +1290,12 @@ class ConvTransduce1DFunction(torch.autograd.Function):
                 if input_graph.calc_grad:
                     input_graphs[b].append(input_graph)
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
 
         global CTX_GRAPHS
         CTX_GRAPHS = (output_graphs, input_graphs, kernels)
         ctx.input_shape = inputs.shape
+        ctx.input_dtype = inputs.dtype
         ctx.kernel_size = kernel_size
         ctx.stride = stride
         outputs = [
@@ -537,7 +1326,7 @@ class ConvTransduce1DFunction(torch.autograd.Function):
                 )
                 input_grad[b, t * stride : t * stride + kernel_size] += grad
 
-        gtn.parallel_for(process, range(B))
+        utils.parallel_for(process, range(B))
 
         if ctx.needs_input_grad[4]:
             kernel_grads = [k.grad().weights_to_numpy() for k in kernels]
@@ -546,7 +1335,7 @@ class ConvTransduce1DFunction(torch.autograd.Function):
         else:
             kernel_grads = None
         return (
-            input_grad.to(grad_output.device),
+            input_grad.to(grad_output.device, ctx.input_dtype),
             None,  # kernels
             None,  # kernel_size
             None,  # stride
@@ -5,23 +5,45 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-import collections
 from dataclasses import dataclass
+import editdistance
 import gtn
 import importlib
+import itertools
+import json
 import logging
+import math
 import numpy as np
 import os
+import random
+import resource
 import struct
 import sys
+import threading
 import time
 import torch
-
-def data_loader(dataset, config, world_rank=0, world_size=1):
+import weakref
+
+def select_samples(dataset, config):
+    """
+    Returns a random subset of `num_samples` samples of the dataset if it is
+    set in the data config, otherwise the whole dataset. If the config has a
+    "seed" the subset only depends on it and the size of the dataset, so that
+    training and testing select the same samples of each split.
+    """
     num_samples = config["data"].get("num_samples", None)
     if num_samples is not None:
         logging.info(f"Using {num_samples} of {len(dataset)}.")
-        dataset = Subset(dataset, torch.randperm(len(dataset))[:num_samples])
+        generator = None
+        if config.get("seed", None) is not None:
+            generator = torch.Generator().manual_seed(config["seed"])
+        indices = torch.randperm(len(dataset), generator=generator)[:num_samples]
+        dataset = Subset(dataset, indices)
+    return dataset
+
+
+def data_loader(dataset, config, world_rank=0, world_size=1):
+    dataset = select_samples(dataset, config)
     return torch.utils.data.DataLoader(
         dataset,
         batch_sampler=BatchSortedSampler(
@@ -38,6 +60,105 @@ def module_from_file(module_name, file_path):
     sys.modules[module_name] = module
     return module
 
+
+def feature_stats(data_config):
+    """
+    Returns the global mean and standard deviation of the input features set
+    by "feature_mean" and "feature_std" in the data config as keyword
+    arguments, or no arguments if they are not set.
+    """
+    return {
+        key: data_config[key]
+        for key in ["feature_mean", "feature_std"]
+        if key in data_config
+    }
+
+
+# Maximum number of threads used by `parallel_for`, `None` uses all cores:
+GTN_NUM_THREADS = None
+
+
+def set_gtn_num_threads(num_threads):
+    global GTN_NUM_THREADS
+    GTN_NUM_THREADS = num_threads
+
+
+def parallel_for(function, indices):
+    """
+    Calls `function` on each of `indices` with `gtn.parallel_for` using at
+    most `GTN_NUM_THREADS` threads. The GTN thread pool runs one thread per
+    queued item, so the indices are split into that many chunks which are
+    each processed sequentially.
+    """
+    indices = list(indices)
+    num_threads = GTN_NUM_THREADS
+    if num_threads is None or len(indices) <= num_threads:
+        gtn.parallel_for(function, indices)
+        return
+    chunks = [indices[i::num_threads] for i in range(num_threads)]
+
+    def process(c):
+        for i in chunks[c]:
+            function(i)
+
+    gtn.parallel_for(process, range(num_threads))
+
+
+@dataclass
+class ThreadBudget:
+    cores: list
+    torch_threads: int
+    gtn_threads: int
+
+    def apply(self, pin_cores=True):
+        if pin_cores:
+            os.sched_setaffinity(0, self.cores)
+        torch.set_num_threads(self.torch_threads)
+        set_gtn_num_threads(self.gtn_threads)
+
+    def __str__(self):
+        return "cores {}, torch threads {}, GTN threads {}".format(
+            ",".join(str(c) for c in self.cores), self.torch_threads, self.gtn_threads
+        )
+
+
+def make_thread_budgets(
+    world_size, cores_per_rank=None, torch_threads=None, gtn_threads=None
+):
+    """
+    Partitions the cores available to this process into contiguous disjoint
+    sets, one per rank, and returns a `ThreadBudget` for each rank. With a
+    single rank the torch intra-op threads and the GTN threads each use all of
+    the cores, since the model and the criterion run one after the other. With
+    more than one rank the cores of each rank are split evenly between the two,
+    so that the threads of all the ranks together do not exceed the cores. If
+    only one of `torch_threads` and `gtn_threads` is given, the other gets the
+    rest of the cores of the rank.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_rank is None:
+        cores_per_rank = max(len(cores) // world_size, 1)
+    if cores_per_rank * world_size > len(cores):
+        logging.warning(
+            f"Using {cores_per_rank} cores for each of {world_size} ranks "
+            f"with only {len(cores)} cores available."
+        )
+    if gtn_threads is None and torch_threads is None and world_size == 1:
+        torch_threads = gtn_threads = cores_per_rank
+    elif gtn_threads is None and torch_threads is None:
+        gtn_threads = max(cores_per_rank // 2, 1)
+    elif gtn_threads is None:
+        gtn_threads = max(cores_per_rank - torch_threads, 1)
+    if torch_threads is None:
+        torch_threads = max(cores_per_rank - gtn_threads, 1)
+    budgets = []
+    for rank in range(world_size):
+        start = rank * cores_per_rank
+        rank_cores = [cores[(start + i) % len(cores)] for i in range(cores_per_rank)]
+        budgets.append(ThreadBudget(rank_cores, torch_threads, gtn_threads))
+    return budgets
+
+
 class Subset(torch.utils.data.Subset):
     def __init__(self, dataset, indices):
         super(Subset, self).__init__(dataset, indices)
@@ -57,7 +178,7 @@ class BatchSortedSampler(torch.utils.data.Sampler):
         local_batchsize = batch_size // world_size
         widths = (in_size[0] for in_size, _ in dataset.sample_sizes())
         sorted_dataset = sorted(enumerate(widths), key=lambda x: x[1])
-        sorted_indices, _ = zip(*sorted_dataset)
+        sorted_indices = [index for index, _ in sorted_dataset]
         global_batches = [
             sorted_indices[idx : idx + local_batchsize]
             for idx in range(0, len(sorted_indices), local_batchsize)
@@ -99,10 +220,9 @@ class Meters:
     num_words = 0
     edit_distance_words = 0
 
-    def sync(self):
+    def sync(self, device):
         lst = [self.loss, self.num_samples, self.num_tokens, self.edit_distance_tokens, self.num_words, self.edit_distance_words]
-        # TODO: avoid this so that distributed cpu training also works
-        lst_tensor = torch.FloatTensor(lst).cuda()
+        lst_tensor = torch.FloatTensor(lst).to(device)
         torch.distributed.all_reduce(lst_tensor)
         (
             self.loss,
@@ -126,51 +246,142 @@ class Meters:
         return self.edit_distance_words * 100.0 / self.num_words if self.num_words > 0 else 0
 
 
-# A simple timer class inspired from `tnt.TimeMeter`
-class CudaTimer:
-    def __init__(self, keys):
-        self.keys = keys
-        self.reset()
+class EditDistance:
+    """
+    Computes token (character) and word level edit distances between batches
+    of predictions and targets directly on their integer indices, without
+    building the corresponding strings.
+
+    Args:
+        preprocessor : The dataset preprocessor. Predictions are assumed to
+            index `preprocessor.tokens` (as returned by `criterion.viterbi`)
+            and targets to be encoded as by `preprocessor.to_index`.
+    """
+
+    def __init__(self, preprocessor):
+        # Map every character to an integer so that tokens of the predictions
+        # and targets decompose into comparable integer sequences:
+        char_to_idx = {c: i for i, c in enumerate(preprocessor.graphemes)}
+
+        def encode(units):
+            return [
+                tuple(char_to_idx.setdefault(c, len(char_to_idx)) for c in u)
+                for u in units
+            ]
+
+        self.wordsep = char_to_idx.setdefault(preprocessor.wordsep, len(char_to_idx))
+        self.prediction_chars = encode(preprocessor.tokens)
+        if preprocessor.lexicon is not None:
+            self.target_chars = self.prediction_chars
+        else:
+            self.target_chars = encode(preprocessor.graphemes)
+
+    def to_chars(self, indices, encoding):
+        chars = list(itertools.chain.from_iterable(encoding[i] for i in indices))
+        # ignore preceding and trailling word separators
+        start, end = 0, len(chars)
+        while start < end and chars[start] == self.wordsep:
+            start += 1
+        while end > start and chars[end - 1] == self.wordsep:
+            end -= 1
+        return chars[start:end]
+
+    def to_words(self, chars):
+        return [
+            tuple(word)
+            for is_sep, word in itertools.groupby(chars, lambda c: c == self.wordsep)
+            if not is_sep
+        ]
 
-    def start(self, key):
-        s = torch.cuda.Event(enable_timing=True)
-        s.record()
-        self.start_events[key].append(s)
-        return self
+    def __call__(self, predictions, targets):
+        """
+        Returns a list with a tuple of (token distance, word distance,
+        number of target tokens, number of target words) for each sample.
+        """
+        B = len(targets)
+        distances = [None] * B
 
-    def stop(self, key):
-        e = torch.cuda.Event(enable_timing=True)
-        e.record()
-        self.end_events[key].append(e)
-        return self
+        def process(b):
+            p = self.to_chars(predictions[b].tolist(), self.prediction_chars)
+            t = self.to_chars(targets[b].tolist(), self.target_chars)
+            pw, tw = self.to_words(p), self.to_words(t)
+            distances[b] = (
+                editdistance.eval(p, t),
+                editdistance.eval(pw, tw),
+                len(t),
+                len(tw),
+            )
 
-    def reset(self):
-        self.start_events = collections.defaultdict(list)
-        self.end_events = collections.defaultdict(list)
-        self.running_times = collections.defaultdict(float)
-        self.n = collections.defaultdict(int)
-        return self
+        parallel_for(process, range(B))
+        return distances
+
+
+class Vocabulary:
+    """
+    The output tokens and graphemes of a dataset preprocessor. This is all the
+    criteria and the decoding need, so it is saved with the checkpoints to
+    run inference without the dataset metadata.
+    """
+
+    FILENAME = "vocabulary.json"
+
+    def __init__(self, tokens, graphemes, wordsep="▁"):
+        self.tokens = tokens
+        self.graphemes = graphemes
+        self.wordsep = wordsep
+        self.graphemes_to_index = {t: i for i, t in enumerate(self.graphemes)}
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor):
+        return cls(preprocessor.tokens, preprocessor.graphemes, preprocessor.wordsep)
+
+    @classmethod
+    def load(cls, checkpoint_path):
+        with open(os.path.join(checkpoint_path, cls.FILENAME), "r") as fid:
+            return cls(**json.load(fid))
+
+    def save(self, checkpoint_path):
+        os.makedirs(checkpoint_path, exist_ok=True)
+        with open(os.path.join(checkpoint_path, self.FILENAME), "w") as fid:
+            json.dump(
+                {
+                    "tokens": self.tokens,
+                    "graphemes": self.graphemes,
+                    "wordsep": self.wordsep,
+                },
+                fid,
+            )
 
-    def value(self):
-        self._synchronize()
-        return {k: self.running_times[k] / self.n[k] for k in self.keys}
+    @property
+    def num_tokens(self):
+        return len(self.tokens)
 
-    def _synchronize(self):
-        torch.cuda.synchronize()
-        for k in self.keys:
-            starts = self.start_events[k]
-            ends = self.end_events[k]
-            if len(starts) == 0:
-                raise ValueError("Trying to divide by zero in TimeMeter")
-            if len(ends) != len(starts):
-                raise ValueError("Call stop before checking value!")
-            time = 0
-            for start, end in zip(starts, ends):
-                time += start.elapsed_time(end)
-            self.running_times[k] += time * 1e-3
-            self.n[k] += len(starts)
-        self.start_events = collections.defaultdict(list)
-        self.end_events = collections.defaultdict(list)
+    def tokens_to_text(self, indices):
+        # ignore preceding and trailling spaces
+        return "".join(self.tokens[i] for i in indices).strip(self.wordsep)
+
+    def word_confidences(self, indices, confidences):
+        """
+        Returns the words of a hypothesis with their confidence as a list of
+        `(word, confidence)`, given the confidence of each token (e.g. as
+        returned by `criterion.viterbi(outputs, confidences=True)`). The
+        confidence of a word is the product of those of the tokens with
+        characters in it.
+        """
+        words = []
+        chars, score = [], 1.0
+        for index, confidence in zip(indices, confidences):
+            for i, piece in enumerate(self.tokens[index].split(self.wordsep)):
+                # a word separator ends the current word:
+                if i > 0 and chars:
+                    words.append(("".join(chars), score))
+                    chars, score = [], 1.0
+                if piece:
+                    chars.append(piece)
+                    score *= float(confidence)
+        if chars:
+            words.append(("".join(chars), score))
+        return words
 
 
 def pack_replabels(tokens, num_replabels):
@@ -212,33 +423,60 @@ def unpack_replabels(tokens, num_replabels):
     return new_tokens
 
 
-# Used to measure the time taken for multiple events
+# A simple timer class inspired from `tnt.TimeMeter`
 class Timer:
-    def __init__(self, keys):
+    """
+    Measures the time taken by multiple events. The total time and the count
+    of each key are accumulated across calls and the durations are sampled
+    in a fixed-size reservoir to estimate percentiles.
+
+    Args:
+        keys (list) : The names of the events.
+        reservoir_size (int) : The maximum number of durations kept per key.
+    """
+
+    def __init__(self, keys, reservoir_size=1000):
         self.keys = keys
-        self.n = {}
-        self.running_time = {}
-        self.total_time = {}
+        self.reservoir_size = reservoir_size
+        self.random = random.Random(0)
         self.reset()
 
     def start(self, key):
-        self.running_time[key] = time.time()
+        self.running_time[key] = time.perf_counter()
         return self
 
     def stop(self, key):
-        self.total_time[key] = time.time() - self.running_time[key]
-        self.n[key] += 1
+        self._add(key, time.perf_counter() - self.running_time[key])
         self.running_time[key] = None
         return self
 
     def reset(self):
-        for k in self.keys:
-            self.total_time[k] = 0
-            self.running_time[k] = None
-            self.n[k] = 0
+        self.running_time = {k: None for k in self.keys}
+        self.total_time = {k: 0.0 for k in self.keys}
+        self.n = {k: 0 for k in self.keys}
+        self.reservoirs = {k: [] for k in self.keys}
         return self
 
+    def _add(self, key, duration):
+        self.total_time[key] += duration
+        self.n[key] += 1
+        reservoir = self.reservoirs[key]
+        if len(reservoir) < self.reservoir_size:
+            reservoir.append(duration)
+        else:
+            # keep every duration with the same probability:
+            i = self.random.randrange(self.n[key])
+            if i < self.reservoir_size:
+                reservoir[i] = duration
+
+    def _synchronize(self):
+        pass
+
     def value(self):
+        """
+        Returns the average time in seconds of each key.
+        """
+        self._synchronize()
         vals = {}
         for k in self.keys:
             if self.n[k] == 0:
@@ -247,6 +485,430 @@ class Timer:
                 vals[k] = self.total_time[k] / self.n[k]
         return vals
 
+    def summary(self, percentiles=(50, 95)):
+        """
+        Returns the count, the average and the percentiles of the time in
+        seconds of each key which has been timed at least once.
+        """
+        self._synchronize()
+        summary = {}
+        for k in self.keys:
+            if self.n[k] == 0:
+                continue
+            summary[k] = {"count": self.n[k], "mean": self.total_time[k] / self.n[k]}
+            values = np.percentile(self.reservoirs[k], percentiles)
+            for p, v in zip(percentiles, values):
+                summary[k][f"p{p}"] = float(v)
+        return summary
+
+    def format_summary(self):
+        return ", ".join(
+            "{} : {:.2f}ms (p50 {:.2f}ms, p95 {:.2f}ms)".format(
+                k, s["mean"] * 1e3, s["p50"] * 1e3, s["p95"] * 1e3
+            )
+            for k, s in self.summary().items()
+        )
+
+
+class CudaTimer(Timer):
+    """
+    A `Timer` which measures the time of events on the GPU with CUDA events.
+    The events are only synchronized once `max_pending` of them are waiting
+    or when the values are read, which bounds their memory without stalling
+    the host at every step.
+
+    Args:
+        keys (list) : The names of the events.
+        reservoir_size (int) : The maximum number of durations kept per key.
+        max_pending (int) : The maximum number of unsynchronized events.
+    """
+
+    def __init__(self, keys, reservoir_size=1000, max_pending=256):
+        self.max_pending = max_pending
+        super(CudaTimer, self).__init__(keys, reservoir_size)
+
+    def start(self, key):
+        s = torch.cuda.Event(enable_timing=True)
+        s.record()
+        self.running_time[key] = s
+        return self
+
+    def stop(self, key):
+        e = torch.cuda.Event(enable_timing=True)
+        e.record()
+        self.pending.append((key, self.running_time[key], e))
+        self.running_time[key] = None
+        if len(self.pending) >= self.max_pending:
+            self._synchronize()
+        return self
+
+    def reset(self):
+        self.pending = []
+        return super(CudaTimer, self).reset()
+
+    def _synchronize(self):
+        for key, start, end in self.pending:
+            end.synchronize()
+            self._add(key, start.elapsed_time(end) * 1e-3)
+        self.pending = []
+
+
+class GTNProfiler:
+    """
+    Opt-in profiler for GTN graph operations. While enabled, the profiled
+    functions of the `gtn` module are replaced by wrappers which record the
+    time of each call and the number of nodes and arcs of the input and output
+    graphs. Records are kept in per-thread buffers so the callbacks run by
+    `gtn.parallel_for` do not contend, and are aggregated in `summary`.
+
+    Args:
+        ops (list) (optional) : The names of the `gtn` functions to profile.
+        trace (bool) : Keep every call to save as a Chrome trace.
+    """
+
+    OPS = [
+        "compose",
+        "intersect",
+        "remove",
+        "project_input",
+        "project_output",
+        "forward_score",
+        "viterbi_score",
+        "viterbi_path",
+        "negate",
+        "subtract",
+        "backward",
+    ]
+
+    def __init__(self, ops=None, trace=False):
+        self.ops = self.OPS if ops is None else ops
+        self.trace = trace
+        self.originals = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.buffers = []
+        self.events = []
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def enable(self):
+        for op in self.ops:
+            if op not in self.originals:
+                self.originals[op] = getattr(gtn, op)
+                setattr(gtn, op, self._wrap(op, self.originals[op]))
+        return self
+
+    def disable(self):
+        for op, func in self.originals.items():
+            setattr(gtn, op, func)
+        self.originals = {}
+        return self
+
+    @staticmethod
+    def _graph_sizes(graphs):
+        graphs = [g for g in graphs if isinstance(g, gtn.Graph)]
+        return (
+            sum(g.num_nodes() for g in graphs),
+            sum(g.num_arcs() for g in graphs),
+        )
+
+    def _buffer(self):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer = self.local.buffer = []
+            with self.lock:
+                self.buffers.append((threading.get_ident(), buffer))
+        return buffer
+
+    def _wrap(self, op, func):
+        def wrapper(*args, **kwargs):
+            in_sizes = self._graph_sizes(args)
+            start = time.perf_counter()
+            output = func(*args, **kwargs)
+            end = time.perf_counter()
+            out_sizes = self._graph_sizes([output])
+            self._buffer().append((op, start, end, in_sizes, out_sizes))
+            return output
+
+        return wrapper
+
+    def reset(self):
+        """
+        Clears the records and returns them grouped by thread id.
+        """
+        with self.lock:
+            records = [(tid, buffer[:]) for tid, buffer in self.buffers]
+            for _, buffer in self.buffers:
+                buffer.clear()
+        if self.trace:
+            self.events.extend(self._trace_events(records))
+        return records
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of calls, the total time and
+        the average graph sizes of each operation since the last call to
+        `summary` or `reset` and then resets the records.
+        """
+        stats = {}
+        for _, buffer in self.reset():
+            for op, start, end, in_sizes, out_sizes in buffer:
+                s = stats.setdefault(op, [0, 0.0, 0, 0, 0, 0])
+                s[0] += 1
+                s[1] += end - start
+                s[2:] = [a + b for a, b in zip(s[2:], in_sizes + out_sizes)]
+        return {
+            op: {
+                "calls": n,
+                "total_ms": total * 1e3,
+                "nodes_in": nodes_in / n,
+                "arcs_in": arcs_in / n,
+                "nodes_out": nodes_out / n,
+                "arcs_out": arcs_out / n,
+            }
+            for op, (n, total, nodes_in, arcs_in, nodes_out, arcs_out) in sorted(
+                stats.items(), key=lambda s: -s[1][1]
+            )
+        }
+
+    @staticmethod
+    def format_summary(summary):
+        return ", ".join(
+            "{} : {} calls {:.2f}ms arcs {:.0f} -> {:.0f}".format(
+                op, s["calls"], s["total_ms"], s["arcs_in"], s["arcs_out"]
+            )
+            for op, s in summary.items()
+        )
+
+    def _trace_events(self, records):
+        pid = os.getpid()
+        return [
+            {
+                "name": op,
+                "ph": "X",
+                "ts": (start - self.start_time) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {
+                    "nodes_in": in_sizes[0],
+                    "arcs_in": in_sizes[1],
+                    "nodes_out": out_sizes[0],
+                    "arcs_out": out_sizes[1],
+                },
+            }
+            for tid, buffer in records
+            for op, start, end, in_sizes, out_sizes in buffer
+        ]
+
+    def save_trace(self, path):
+        """
+        Saves the calls recorded so far in the Chrome trace format, which can
+        be viewed in `chrome://tracing`.
+        """
+        self.reset()
+        with open(path, "w") as fid:
+            json.dump({"traceEvents": self.events}, fid)
+
+
+# Estimated size in bytes of a node and of an arc of a GTN graph including
+# the adjacency lists, the arc weight and its gradient:
+GTN_NODE_BYTES = 64
+GTN_ARC_BYTES = 40
+
+
+def graph_bytes(*graphs):
+    """
+    Returns the estimated memory in bytes of the given GTN graphs.
+    """
+    return sum(
+        g.num_nodes() * GTN_NODE_BYTES + g.num_arcs() * GTN_ARC_BYTES for g in graphs
+    )
+
+
+def peak_rss_mb(reset=False):
+    """
+    Returns the peak resident set size of the process in MB. On Linux the
+    peak can be reset after reading it to measure the peak of each step,
+    otherwise it is the peak over the lifetime of the process.
+    """
+    try:
+        with open("/proc/self/status", "r") as fid:
+            peak = next(int(l.split()[1]) for l in fid if l.startswith("VmHWM"))
+        if reset:
+            with open("/proc/self/clear_refs", "w") as fid:
+                fid.write("5")
+    except (OSError, StopIteration):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # both are in KB:
+    return peak / 1024
+
+
+class GraphMemory:
+    """
+    Tracks the estimated memory of the GTN graphs which the loss functions
+    retain from the forward to the backward. If `max_mb` is set, the graphs of
+    a sample are only retained while the total retained stays under the cap,
+    otherwise they are freed after the forward and recomputed in the backward.
+    The graphs of a call are released by its backward, or when its autograd
+    context is freed if the backward never runs.
+
+    Args:
+        max_mb (float) (optional) : The cap on the retained graphs in MB.
+    """
+
+    def __init__(self, max_mb=None):
+        self.max_bytes = None if max_mb is None else max_mb * 2 ** 20
+        # reentrant since the finalizers of `release_on_free` can run in the
+        # garbage collection of any allocation:
+        self.lock = threading.RLock()
+        self.retained = 0
+        self.reset()
+
+    def reset(self):
+        self.peak_retained = self.retained
+        self.num_samples = 0
+        self.num_recomputed = 0
+
+    def record(self, nbytes):
+        """
+        Records the graphs of a sample retained for the backward.
+        """
+        with self.lock:
+            self.num_samples += 1
+            self.retained += nbytes
+            self.peak_retained = max(self.peak_retained, self.retained)
+
+    def retain(self, nbytes):
+        """
+        Returns `True` and records the graphs of a sample if they can be
+        retained for the backward under the cap, `False` if they should be
+        recomputed instead.
+        """
+        with self.lock:
+            if self.max_bytes is not None and self.retained + nbytes > self.max_bytes:
+                self.num_samples += 1
+                self.num_recomputed += 1
+                return False
+        self.record(nbytes)
+        return True
+
+    def release(self, retained_bytes, index):
+        """
+        Releases the graphs of sample `index` of a call, recorded in the list
+        `retained_bytes`, if they are still retained.
+        """
+        with self.lock:
+            self.retained -= retained_bytes[index]
+            retained_bytes[index] = 0
+
+    def release_on_free(self, owner, retained_bytes):
+        """
+        Releases the graphs of a call still retained when `owner`, the
+        autograd context which holds them, is freed. This happens if the
+        backward never runs, e.g. for a loss evaluated under grad, skipped or
+        interrupted by an exception.
+        """
+        weakref.finalize(owner, self._release_all, retained_bytes)
+
+    def _release_all(self, retained_bytes):
+        for index in range(len(retained_bytes)):
+            self.release(retained_bytes, index)
+
+    def summary(self):
+        """
+        Returns the peak retained graph memory, the number of samples and of
+        recomputed samples, and the peak RSS since the last call, then resets
+        them.
+        """
+        summary = {
+            "peak_retained_mb": self.peak_retained / 2 ** 20,
+            "num_samples": self.num_samples,
+            "num_recomputed": self.num_recomputed,
+            "peak_rss_mb": peak_rss_mb(reset=True),
+        }
+        self.reset()
+        return summary
+
+    @staticmethod
+    def format_summary(summary):
+        return (
+            "retained graphs {:.1f}MB ({}/{} samples recomputed), "
+            "peak RSS {:.1f}MB".format(
+                summary["peak_retained_mb"],
+                summary["num_recomputed"],
+                summary["num_samples"],
+                summary["peak_rss_mb"],
+            )
+        )
+
+
+# Tracks the graphs retained by the loss functions if set:
+GRAPH_MEMORY = None
+
+
+def set_graph_memory(graph_memory):
+    global GRAPH_MEMORY
+    GRAPH_MEMORY = graph_memory
+
+
+def safe_log(x):
+    # avoid nan gradients for zero entries:
+    positive = x > 0
+    x = torch.where(positive, x, torch.ones_like(x))
+    return torch.where(positive, torch.log(x), x.new_tensor(-math.inf))
+
+
+def scatter_logsumexp(scores, index, size):
+    """
+    Returns the log-sum-exp of the entries of `scores` along the last
+    dimension grouped into `size` outputs by `index`. Empty groups are `-inf`.
+    """
+    shape = scores.shape[:-1] + (size,)
+    index = index.expand(scores.shape)
+    maxes = scores.new_full(shape, -math.inf)
+    maxes = maxes.scatter_reduce(-1, index, scores.detach(), "amax")
+    maxes = torch.where(torch.isinf(maxes), torch.zeros_like(maxes), maxes)
+    sums = scores.new_zeros(shape)
+    sums = sums.scatter_add(-1, index, torch.exp(scores - maxes.gather(-1, index)))
+    return safe_log(sums) + maxes
+
+
+def scatter_max(scores, index, size):
+    """
+    Returns the maximum of the entries of `scores` along the last dimension
+    grouped into `size` outputs by `index`. Empty groups are `-inf`.
+    """
+    shape = scores.shape[:-1] + (size,)
+    maxes = scores.new_full(shape, -math.inf)
+    return maxes.scatter_reduce(-1, index.expand(scores.shape), scores, "amax")
+
+
+def masked_logsumexp(scores):
+    """
+    Returns the log-sum-exp over the last dimension of `scores` without nan
+    gradients when all the entries are `-inf`.
+    """
+    maxes = scores.detach().amax(-1, keepdim=True)
+    maxes = torch.where(torch.isinf(maxes), torch.zeros_like(maxes), maxes)
+    return safe_log(torch.exp(scores - maxes).sum(-1)) + maxes.squeeze(-1)
+
+
+def log_matmul(a, b):
+    """
+    Returns the matrix product of `a` and `b` in the log semiring.
+    """
+    max_a = a.detach().amax(-1, keepdim=True)
+    max_a = torch.where(torch.isinf(max_a), torch.zeros_like(max_a), max_a)
+    max_b = b.detach().amax(0, keepdim=True)
+    max_b = torch.where(torch.isinf(max_b), torch.zeros_like(max_b), max_b)
+    return safe_log(torch.exp(a - max_a) @ torch.exp(b - max_b)) + max_a + max_b
+
 
 class CTCLossFunction(torch.autograd.Function):
     @staticmethod
@@ -266,24 +928,41 @@ class CTCLossFunction(torch.autograd.Function):
         g_criterion.arc_sort(False)
         return g_criterion
 
+    @staticmethod
+    def create_loss_graph(log_probs, target, blank_idx, calc_grad):
+        """
+        Returns the loss graph and the emissions graph of one sample and the
+        estimated memory of the graphs retained by the loss graph.
+        """
+        T, C = log_probs.shape
+        # create emission graph
+        g_emissions = gtn.linear_graph(T, C, calc_grad)
+        # upcast on the host as the weights are read as 32-bit floats:
+        cpu_data = log_probs.cpu().float().contiguous()
+        g_emissions.set_weights(cpu_data.data_ptr())
+
+        # create criterion graph
+        g_criterion = CTCLossFunction.create_ctc_graph(target, blank_idx)
+        # compose the graphs
+        g_intersect = gtn.intersect(g_emissions, g_criterion)
+        g_loss = gtn.negate(gtn.forward_score(g_intersect))
+        return g_loss, g_emissions, graph_bytes(g_emissions, g_criterion, g_intersect)
+
     @staticmethod
     def forward(ctx, log_probs, targets, blank_idx=0, reduction="none"):
         B, T, C = log_probs.shape
         losses = [None] * B
+        loss_values = [None] * B
         scales = [None] * B
         emissions_graphs = [None] * B
+        retained_bytes = [0] * B
+        graph_memory = GRAPH_MEMORY if log_probs.requires_grad else None
+        if graph_memory is not None:
+            graph_memory.release_on_free(ctx, retained_bytes)
 
         def process(b):
-            # create emission graph
-            g_emissions = gtn.linear_graph(T, C, log_probs.requires_grad)
-            cpu_data = log_probs[b].cpu().contiguous()
-            g_emissions.set_weights(cpu_data.data_ptr())
-
-            # create criterion graph
-            g_criterion = CTCLossFunction.create_ctc_graph(targets[b], blank_idx)
-            # compose the graphs
-            g_loss = gtn.negate(
-                gtn.forward_score(gtn.intersect(g_emissions, g_criterion))
+            g_loss, g_emissions, nbytes = CTCLossFunction.create_loss_graph(
+                log_probs[b], targets[b], blank_idx, log_probs.requires_grad
             )
 
             scale = 1.0
@@ -293,34 +972,65 @@ class CTCLossFunction(torch.autograd.Function):
             elif reduction != "none":
                 raise ValueError("invalid value for reduction '" + str(reduction) + "'")
 
-            # Save for backward:
-            losses[b] = g_loss
+            # Save for backward, the graphs are recomputed if over the cap:
+            loss_values[b] = g_loss.item()
             scales[b] = scale
-            emissions_graphs[b] = g_emissions
+            if graph_memory is None or graph_memory.retain(nbytes):
+                losses[b] = g_loss
+                emissions_graphs[b] = g_emissions
+                retained_bytes[b] = nbytes
 
-        gtn.parallel_for(process, range(B))
+        parallel_for(process, range(B))
 
-        ctx.auxiliary_data = (losses, scales, emissions_graphs, log_probs.shape)
-        loss = torch.tensor([losses[b].item() * scales[b] for b in range(B)])
+        ctx.save_for_backward(log_probs)
+        ctx.auxiliary_data = (
+            losses,
+            scales,
+            emissions_graphs,
+            retained_bytes,
+            graph_memory,
+            targets,
+            blank_idx,
+        )
+        ctx.input_dtype = log_probs.dtype
+        loss = torch.tensor([loss_values[b] * scales[b] for b in range(B)])
         return torch.mean(loss.cuda() if log_probs.is_cuda else loss)
 
     @staticmethod
     def backward(ctx, grad_output):
-        losses, scales, emissions_graphs, in_shape = ctx.auxiliary_data
-        B, T, C = in_shape
+        (
+            losses,
+            scales,
+            emissions_graphs,
+            retained_bytes,
+            graph_memory,
+            targets,
+            blank_idx,
+        ) = ctx.auxiliary_data
+        (log_probs,) = ctx.saved_tensors
+        B, T, C = log_probs.shape
         input_grad = torch.empty((B, T, C))
 
         def process(b):
-            gtn.backward(losses[b], False)
-            emissions = emissions_graphs[b]
+            g_loss, emissions = losses[b], emissions_graphs[b]
+            if g_loss is None:
+                g_loss, emissions, _ = CTCLossFunction.create_loss_graph(
+                    log_probs[b].detach(), targets[b], blank_idx, True
+                )
+            gtn.backward(g_loss, False)
             grad = emissions.grad().weights_to_numpy()
             input_grad[b] = torch.from_numpy(grad).view(1, T, C) * scales[b]
+            # free the graphs of the sample:
+            losses[b] = emissions_graphs[b] = None
+            if graph_memory is not None:
+                graph_memory.release(retained_bytes, b)
 
-        gtn.parallel_for(process, range(B))
+        parallel_for(process, range(B))
 
         if grad_output.is_cuda:
             input_grad = input_grad.cuda()
         input_grad *= grad_output / B
+        input_grad = input_grad.to(ctx.input_dtype)
 
         return (
             input_grad,
@@ -364,37 +1074,70 @@ class ASGLossFunction(torch.autograd.Function):
         g_fal.arc_sort(True)
         return g_fal
 
+    @staticmethod
+    def create_loss_graph(inputs, transitions, target, calc_grad, calc_trans_grad):
+        """
+        Returns the loss graph, the emissions graph and the transitions graph
+        of one sample and the estimated memory of the graphs retained by the
+        loss graph.
+        """
+        T, C = inputs.shape
+        # create emission graph
+        g_emissions = gtn.linear_graph(T, C, calc_grad)
+        # upcast on the host as the weights are read as 32-bit floats:
+        cpu_data = inputs.cpu().float().contiguous()
+        g_emissions.set_weights(cpu_data.data_ptr())
+
+        # create transition graph
+        g_transitions = ASGLossFunction.create_transitions_graph(
+            transitions, calc_trans_grad
+        )
+
+        # create force align criterion graph
+        g_fal = ASGLossFunction.create_force_align_graph(target)
+
+        # compose the graphs
+        g_fal_trans = gtn.intersect(g_fal, g_transitions)
+        g_fal_emissions = gtn.intersect(g_fal_trans, g_emissions)
+        g_fcc_emissions = gtn.intersect(g_emissions, g_transitions)
+        g_fal_fwd = gtn.forward_score(g_fal_emissions)
+        g_fcc_fwd = gtn.forward_score(g_fcc_emissions)
+        g_loss = gtn.subtract(g_fcc_fwd, g_fal_fwd)
+        nbytes = graph_bytes(
+            g_emissions,
+            g_transitions,
+            g_fal,
+            g_fal_trans,
+            g_fal_emissions,
+            g_fcc_emissions,
+        )
+        return g_loss, g_emissions, g_transitions, nbytes
+
     @staticmethod
     def forward(ctx, inputs, transitions, targets, reduction="none"):
         B, T, C = inputs.shape
         losses = [None] * B
+        loss_values = [None] * B
         scales = [None] * B
         emissions_graphs = [None] * B
         transitions_graphs = [None] * B
+        retained_bytes = [0] * B
+        requires_grad = inputs.requires_grad or transitions.requires_grad
+        graph_memory = GRAPH_MEMORY if requires_grad else None
+        if graph_memory is not None:
+            graph_memory.release_on_free(ctx, retained_bytes)
 
         calc_trans_grad = transitions.requires_grad
-        transitions = transitions.cpu()  # avoid multiple cuda -> cpu copies
+        cpu_transitions = transitions.cpu()  # avoid multiple cuda -> cpu copies
 
         def process(b):
-            # create emission graph
-            g_emissions = gtn.linear_graph(T, C, inputs.requires_grad)
-            cpu_data = inputs[b].cpu().contiguous()
-            g_emissions.set_weights(cpu_data.data_ptr())
-
-            # create transition graph
-            g_transitions = ASGLossFunction.create_transitions_graph(
-                transitions, calc_trans_grad
-            )
-
-            # create force align criterion graph
-            g_fal = ASGLossFunction.create_force_align_graph(targets[b])
-
-            # compose the graphs
-            g_fal_fwd = gtn.forward_score(
-                gtn.intersect(gtn.intersect(g_fal, g_transitions), g_emissions)
+            g_loss, g_emissions, g_transitions, nbytes = ASGLossFunction.create_loss_graph(
+                inputs[b],
+                cpu_transitions,
+                targets[b],
+                inputs.requires_grad,
+                calc_trans_grad,
             )
-            g_fcc_fwd = gtn.forward_score(gtn.intersect(g_emissions, g_transitions))
-            g_loss = gtn.subtract(g_fcc_fwd, g_fal_fwd)
             scale = 1.0
             if reduction == "mean":
                 L = len(targets[b])
@@ -402,22 +1145,30 @@ class ASGLossFunction(torch.autograd.Function):
             elif reduction != "none":
                 raise ValueError("invalid value for reduction '" + str(reduction) + "'")
 
-            # Save for backward:
-            losses[b] = g_loss
+            # Save for backward, the graphs are recomputed if over the cap:
+            loss_values[b] = g_loss.item()
             scales[b] = scale
-            emissions_graphs[b] = g_emissions
-            transitions_graphs[b] = g_transitions
+            if graph_memory is None or graph_memory.retain(nbytes):
+                losses[b] = g_loss
+                emissions_graphs[b] = g_emissions
+                transitions_graphs[b] = g_transitions
+                retained_bytes[b] = nbytes
 
-        gtn.parallel_for(process, range(B))
+        parallel_for(process, range(B))
 
+        ctx.save_for_backward(inputs)
         ctx.auxiliary_data = (
             losses,
             scales,
             emissions_graphs,
             transitions_graphs,
-            inputs.shape,
+            retained_bytes,
+            graph_memory,
+            targets,
+            cpu_transitions.detach(),
         )
-        loss = torch.tensor([losses[b].item() * scales[b] for b in range(B)])
+        ctx.input_dtype = inputs.dtype
+        loss = torch.tensor([loss_values[b] * scales[b] for b in range(B)])
         return torch.mean(loss.cuda() if inputs.is_cuda else loss)
 
     @staticmethod
@@ -427,9 +1178,13 @@ class ASGLossFunction(torch.autograd.Function):
             scales,
             emissions_graphs,
             transitions_graphs,
-            in_shape,
+            retained_bytes,
+            graph_memory,
+            targets,
+            cpu_transitions,
         ) = ctx.auxiliary_data
-        B, T, C = in_shape
+        (inputs,) = ctx.saved_tensors
+        B, T, C = inputs.shape
         input_grad = transitions_grad = None
         if ctx.needs_input_grad[0]:
             input_grad = torch.empty((B, T, C))
@@ -437,9 +1192,18 @@ class ASGLossFunction(torch.autograd.Function):
             transitions_grad = torch.empty((B, C + 1, C))
 
         def process(b):
-            gtn.backward(losses[b], False)
+            g_loss = losses[b]
             emissions = emissions_graphs[b]
             transitions = transitions_graphs[b]
+            if g_loss is None:
+                g_loss, emissions, transitions, _ = ASGLossFunction.create_loss_graph(
+                    inputs[b].detach(),
+                    cpu_transitions,
+                    targets[b],
+                    input_grad is not None,
+                    transitions_grad is not None,
+                )
+            gtn.backward(g_loss, False)
             if input_grad is not None:
                 grad = emissions.grad().weights_to_numpy()
                 input_grad[b] = torch.from_numpy(grad).view(1, T, C) * scales[b]
@@ -448,12 +1212,17 @@ class ASGLossFunction(torch.autograd.Function):
                 transitions_grad[b] = (
                     torch.from_numpy(grad).view(1, C + 1, C) * scales[b]
                 )
+            # free the graphs of the sample:
+            losses[b] = emissions_graphs[b] = transitions_graphs[b] = None
+            if graph_memory is not None:
+                graph_memory.release(retained_bytes, b)
 
-        gtn.parallel_for(process, range(B))
+        parallel_for(process, range(B))
         if input_grad is not None:
             if grad_output.is_cuda:
                 input_grad = input_grad.cuda()
             input_grad *= grad_output / B
+            input_grad = input_grad.to(ctx.input_dtype)
         if transitions_grad is not None:
             if grad_output.is_cuda:
                 transitions_grad = transitions_grad.cuda()
@@ -468,3 +1237,63 @@ class ASGLossFunction(torch.autograd.Function):
 
 
 ASGLoss = ASGLossFunction.apply
+
+
+def asg_loss(inputs, transitions, targets, reduction="none"):
+    """
+    Computes the ASG loss with batched tensor operations on the device of the
+    inputs. The fully connected term is a dense log-semiring matrix recursion
+    over the frames and the force align term a banded recursion over the
+    target positions. Returns the same values as `ASGLoss` and the gradients
+    are given by autograd.
+
+    Args:
+        inputs (torch.Tensor) : The emissions of shape [B, T, C].
+        transitions (torch.Tensor) : The transition scores of shape
+            [C + 1, C] where row 0 scores the first token and row `i + 1`
+            the token `i` given each previous token.
+        targets (list) : The target token indices of each sample.
+        reduction (str) : If "mean", the loss of each sample is divided by
+            its target length.
+    """
+    if reduction not in ["none", "mean"]:
+        raise ValueError("invalid value for reduction '" + str(reduction) + "'")
+    B, T, C = inputs.shape
+    device = inputs.device
+    emissions = inputs.float()
+    transitions = transitions.float()
+
+    # fully connected term:
+    alpha = emissions[:, 0] + transitions[0]
+    trans = transitions[1:].t()
+    for t in range(1, T):
+        alpha = emissions[:, t] + log_matmul(alpha, trans)
+    fcc = torch.logsumexp(alpha, dim=1)
+
+    # force align term, padded to the longest target:
+    lengths = torch.tensor([len(t) for t in targets], device=device)
+    L = max(int(lengths.max()), 1) if B > 0 else 1
+    labels = torch.zeros((B, L), dtype=torch.long, device=device)
+    for b, target in enumerate(targets):
+        labels[b, : len(target)] = torch.as_tensor(target, dtype=torch.long)
+    no_path = emissions.new_tensor(-math.inf)
+    fal_emissions = emissions.gather(2, labels.unsqueeze(1).expand(B, T, L))
+    stay = transitions[labels + 1, labels]
+    move = transitions[labels[:, 1:] + 1, labels[:, :-1]]
+    move = torch.cat([no_path.expand(B, 1), move], dim=1)
+    alpha = torch.where(
+        torch.arange(L, device=device) == 0, transitions[0, labels], no_path
+    )
+    alpha = fal_emissions[:, 0] + alpha
+    for t in range(1, T):
+        prev = torch.cat([no_path.expand(B, 1), alpha[:, :-1]], dim=1)
+        scores = torch.stack([alpha + stay, prev + move], dim=2)
+        alpha = fal_emissions[:, t] + masked_logsumexp(scores)
+    # empty targets have no path:
+    last = (lengths - 1).clamp(min=0).unsqueeze(1)
+    fal = torch.where(lengths > 0, alpha.gather(1, last).squeeze(1), no_path)
+
+    losses = fcc - fal
+    if reduction == "mean":
+        losses = losses / lengths.clamp(min=1)
+    return torch.mean(losses)